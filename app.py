@@ -1,4 +1,5 @@
 import copy
+import hmac
 import json
 import os
 import logging
@@ -17,15 +18,29 @@ from quart import (
     current_app,
 )
 
-from openai import AsyncAzureOpenAI
-from azure.identity.aio import (
-    DefaultAzureCredential,
-    get_bearer_token_provider
-)
+from opentelemetry import trace
 from backend.auth.auth_utils import get_authenticated_user_details
 from backend.security.ms_defender_utils import get_msdefender_user_json
-from backend.history.cosmosdbservice import CosmosConversationClient
-from backend.foundry.client import FoundryClient
+from backend.eventloop import EventLoopWatchdog, install_blocking_call_detector
+from backend.health import HealthMonitor
+from backend.history.conversationstore import USAGE_ID_PREFIX
+from backend.metrics import metrics
+from backend.profiling import RequestProfilerMiddleware
+from backend.static_assets import StaticAssets, StaticFilesMiddleware
+from backend.timing import (
+    SERVER_TIMING_TRAILER_HEADER,
+    RequestTimings,
+    bind_timings,
+    current_timings,
+    timed,
+)
+from backend.usage import UsageTracker, WINDOWS, usage_day, usage_from_response
+from backend.tracing import (
+    tracer,
+    configure_tracing,
+    inject_trace_headers,
+    current_trace_id,
+)
 from backend.settings import (
     app_settings,
     MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION
@@ -36,6 +51,8 @@ from backend.utils import (
     format_non_streaming_response,
     convert_to_pf_format,
     format_pf_non_streaming_response,
+    parse_ndjson,
+    current_route,
 )
 
 bp = Blueprint("routes", __name__, static_folder="static", template_folder="static")
@@ -47,16 +64,98 @@ def create_app():
     app = Quart(__name__)
     app.register_blueprint(bp)
     app.config["TEMPLATES_AUTO_RELOAD"] = True
+    ## the frontend build is served before requests reach Quart; the index,
+    ## favicon and assets routes below only see paths it does not find
+    static_assets = StaticAssets(os.path.join(app.root_path, "static"))
+    static_assets.add_rendered("/", "index.html", title=app_settings.ui.title, favicon=app_settings.ui.favicon)
+    app.asgi_app = StaticFilesMiddleware(app.asgi_app, static_assets, files={"/favicon.ico": "favicon.ico"})
+    if app_settings.tracing.enabled:
+        from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
+        ## server span per request, kept open until a streamed body is fully sent;
+        ## per-message send/receive spans would add one span per stream frame
+        app.asgi_app = OpenTelemetryMiddleware(app.asgi_app, exclude_spans=["receive", "send"])
+    if app_settings.profiling.enabled:
+        app.asgi_app = RequestProfilerMiddleware(
+            app.asgi_app,
+            secret=app_settings.profiling.secret,
+            output_dir=app_settings.profiling.output_dir,
+            profiler=app_settings.profiling.profiler,
+            interval=app_settings.profiling.interval,
+        )
+
+    @app.before_request
+    async def start_request_timings():
+        bind_timings(RequestTimings())
+
+    @app.after_request
+    async def add_server_timing(response):
+        ## for streamed responses this covers the stages before the first frame;
+        ## the full breakdown is sent in the opt-in trailer frame
+        timings = current_timings()
+        if timings is not None:
+            response.headers["Server-Timing"] = timings.server_timing_header()
+        return response
     
+    @app.before_serving
+    async def init_tracing():
+        ## configured per worker, since the batch export thread does not survive a fork
+        app.tracer_provider = configure_tracing(app_settings.tracing)
+
     @app.before_serving
     async def init():
         try:
-            app.cosmos_conversation_client = await init_cosmosdb_client()
+            app.cosmos_conversation_client = await init_conversation_store()
             cosmos_db_ready.set()
         except Exception as e:
             logging.exception("Failed to initialize CosmosDB client")
             app.cosmos_conversation_client = None
             raise e
+
+    @app.before_serving
+    async def init_clients():
+        ## pooled clients are created and warmed up per worker in the background, so
+        ## the worker already accepts connections and answers /ready with 503 meanwhile
+        if app_settings.foundry and app_settings.foundry.enabled:
+            health_monitor.register("foundry", warm_up_foundry)
+        else:
+            health_monitor.register("azure_openai", warm_up_openai)
+        if app.cosmos_conversation_client:
+            health_monitor.register("chat_history", lambda: check_conversation_store(app.cosmos_conversation_client))
+        if not app_settings.health.ready_after_warmup:
+            health_monitor.ready = True
+        app.health_task = asyncio.create_task(
+            health_monitor.run(app_settings.health.check_interval, app_settings.health.warmup_timeout)
+        )
+
+    @app.before_serving
+    async def init_metrics():
+        if app_settings.base_settings.metrics_multiproc_dir:
+            metrics.enable_multiprocess(app_settings.base_settings.metrics_multiproc_dir)
+        if app_settings.event_loop.debug_blocking_calls:
+            install_blocking_call_detector()
+            ## asyncio debug mode also names the task behind each slow callback
+            loop = asyncio.get_running_loop()
+            loop.slow_callback_duration = app_settings.event_loop.lag_threshold or 0.1
+            loop.set_debug(True)
+        watchdog = EventLoopWatchdog(threshold=app_settings.event_loop.lag_threshold)
+        app.metrics_tasks = [
+            asyncio.create_task(watchdog.run()),
+            asyncio.create_task(metrics.export_snapshots()),
+            asyncio.create_task(usage_tracker.run(lambda: app.cosmos_conversation_client, app_settings.usage.flush_interval)),
+        ]
+
+    @app.after_serving
+    async def shutdown():
+        for task in [app.health_task, *app.metrics_tasks]:
+            task.cancel()
+        metrics.write_snapshot()
+        await usage_tracker.flush(app.cosmos_conversation_client)
+        await close_openai_client()
+        await close_foundry_client()
+        if app.cosmos_conversation_client:
+            await app.cosmos_conversation_client.close()
+        if app.tracer_provider:
+            app.tracer_provider.shutdown()
     
     return app
 
@@ -88,6 +187,71 @@ if DEBUG.lower() == "true":
 USER_AGENT = "GitHubSampleWebApp/AsyncAzureOpenAI/1.0.0"
 
 
+# Runtime metrics, served on /metrics
+CHAT_REQUESTS = metrics.counter(
+    "chat_requests_total",
+    "Chat requests by route, model backend and outcome",
+    ("route", "backend", "status")
+)
+CHAT_REQUEST_DURATION = metrics.histogram(
+    "chat_request_duration_seconds",
+    "Chat request latency; for streams this covers the whole response stream",
+    ("route", "backend"),
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+)
+CHAT_TIME_TO_FIRST_TOKEN = metrics.histogram(
+    "chat_time_to_first_token_seconds",
+    "Time from request start to the first streamed assistant content frame",
+    ("route", "backend"),
+    buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30)
+)
+CHAT_TOKENS_PER_SECOND = metrics.histogram(
+    "chat_tokens_per_second",
+    "Streamed completion tokens per second after the first token",
+    ("route", "backend"),
+    buckets=(1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+)
+CHAT_STREAM_FRAMES = metrics.counter(
+    "chat_stream_frames_total",
+    "NDJSON frames written to chat response streams",
+    ("route", "backend")
+)
+CHAT_STREAMS_IN_FLIGHT = metrics.gauge(
+    "chat_streams_in_flight",
+    "Chat response streams currently open",
+    ("route", "backend")
+)
+UPSTREAM_RESPONSES = metrics.counter(
+    "upstream_responses_total",
+    "Responses received from model backends by HTTP status code",
+    ("backend", "status_code")
+)
+TOOL_CALL_DURATION = metrics.histogram(
+    "tool_call_duration_seconds",
+    "Latency of remote Azure Functions tool calls",
+    ("function", "status")
+)
+
+# Per-user token usage, checked against the budgets before each chat request
+usage_tracker = UsageTracker(
+    daily_budget=app_settings.usage.daily_token_budget,
+    monthly_budget=app_settings.usage.monthly_token_budget,
+)
+
+# Cached dependency status behind /ready and /healthz
+health_monitor = HealthMonitor(timeout=app_settings.health.check_timeout)
+
+
+def record_usage(user_id, usage):
+    tokens = usage_from_response(usage)
+    if tokens is not None and user_id:
+        usage_tracker.record(user_id, *tokens)
+
+
+def request_user_id(request_headers):
+    return get_authenticated_user_details(request_headers)["user_principal_id"]
+
+
 # Frontend Settings via Environment Variables
 frontend_settings = {
     "auth_enabled": app_settings.base_settings.auth_enabled,
@@ -120,8 +284,45 @@ MS_DEFENDER_ENABLED = os.environ.get("MS_DEFENDER_ENABLED", "true").lower() == "
 azure_openai_tools = []
 azure_openai_available_tools = []
 
+## one Azure OpenAI client, and so one connection pool, per worker process
+azure_openai_client = None
+azure_openai_client_lock = asyncio.Lock()
+
+
+async def get_openai_client():
+    global azure_openai_client
+    if azure_openai_client is None:
+        async with azure_openai_client_lock:
+            if azure_openai_client is None:
+                azure_openai_client = await init_openai_client()
+    return azure_openai_client
+
+
+async def close_openai_client():
+    global azure_openai_client
+    if azure_openai_client is not None:
+        await azure_openai_client.close()
+        azure_openai_client = None
+
+async def warm_up_openai():
+    from openai import NotFoundError
+
+    client = await get_openai_client()
+    try:
+        ## acquires the Entra token and opens a pooled connection
+        await client.with_options(max_retries=0).models.list()
+    except NotFoundError:
+        ## not every API version serves the model list; the connection is open either way
+        pass
+
+
 # Initialize Azure OpenAI Client
 async def init_openai_client():
+    ## the SDKs are imported on first use, so deployments that never call
+    ## Azure OpenAI (Foundry, promptflow) do not pay for them at startup
+    from openai import AsyncAzureOpenAI
+    from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
+
     azure_openai_client = None
     
     try:
@@ -206,9 +407,21 @@ async def openai_remote_azure_function_call(function_name, function_args):
         "tool_name": function_name,
         "tool_arguments": json.loads(function_args)
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(azure_functions_tool_url, data=json.dumps(body), headers=headers)
-    response.raise_for_status()
+    status = "ok"
+    start = time.perf_counter()
+    with tracer.start_as_current_span("tool_call", kind=trace.SpanKind.CLIENT) as span:
+        span.set_attribute("tool.name", function_name)
+        try:
+            with timed("functions"):
+                async with httpx.AsyncClient() as client:
+                    response = await client.post(azure_functions_tool_url, data=json.dumps(body), headers=inject_trace_headers(headers))
+            span.set_attribute("http.response.status_code", response.status_code)
+            response.raise_for_status()
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            TOOL_CALL_DURATION.observe(time.perf_counter() - start, function=function_name, status=status)
 
     return response.text
 
@@ -220,7 +433,10 @@ async def init_cosmosdb_client():
                 f"https://{app_settings.chat_history.account}.documents.azure.com:443/"
             )
 
+            from backend.history.cosmosdbservice import CosmosConversationClient
+
             if not app_settings.chat_history.account_key:
+                from azure.identity.aio import DefaultAzureCredential
                 async with DefaultAzureCredential() as cred:
                     credential = cred
                     
@@ -233,6 +449,7 @@ async def init_cosmosdb_client():
                 database_name=app_settings.chat_history.database,
                 container_name=app_settings.chat_history.conversations_container,
                 enable_message_feedback=app_settings.chat_history.enable_feedback,
+                request_charge_log_threshold=app_settings.chat_history.request_charge_log_threshold,
             )
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization", e)
@@ -244,6 +461,25 @@ async def init_cosmosdb_client():
     return cosmos_conversation_client
 
 
+async def check_conversation_store(store):
+    ## on Cosmos DB, reads the database and container metadata the SDK caches
+    success, err = await store.ensure()
+    if not success:
+        raise RuntimeError(err)
+
+
+async def init_conversation_store():
+    if app_settings.chat_history and app_settings.chat_history.backend == "sqlite":
+        from backend.history.sqlitedbservice import SqliteConversationClient
+        logging.debug(f"Using SQLite chat history at {app_settings.chat_history.sqlite_path}")
+        return SqliteConversationClient(
+            db_path=app_settings.chat_history.sqlite_path,
+            enable_message_feedback=app_settings.chat_history.enable_feedback,
+        )
+
+    return await init_cosmosdb_client()
+
+
 async def send_foundry_request(request_body):
     """Send a request to the Foundry agent API."""
     if not app_settings.foundry or not app_settings.foundry.enabled:
@@ -255,8 +491,7 @@ async def send_foundry_request(request_body):
         if not messages:
             raise ValueError("No messages found in request")
         
-        # Initialize Foundry client
-        foundry_client = await init_foundry_client()
+        foundry_client = await get_foundry_client()
         if not foundry_client:
             raise ValueError("Failed to initialize Foundry client")
         
@@ -264,15 +499,19 @@ async def send_foundry_request(request_body):
         logging.debug(f"Sending request to Foundry endpoint")
         
         # Use non-streaming mode for now
-        foundry_response = await foundry_client.send_message_non_streaming(messages)
+        with timed("upstream"):
+            foundry_response = await foundry_client.send_message_non_streaming(messages)
+        UPSTREAM_RESPONSES.inc(backend="foundry", status_code=200)
         
         logging.debug(f"Received response from Foundry: {foundry_response}")
         
-        await foundry_client.close()
-        
         return foundry_response
         
     except httpx.HTTPError as e:
+        UPSTREAM_RESPONSES.inc(
+            backend="foundry",
+            status_code=e.response.status_code if isinstance(e, httpx.HTTPStatusError) else "error"
+        )
         logging.exception("HTTP error in Foundry request")
         raise Exception(f"Foundry API error: {str(e)}")
     except Exception as e:
@@ -280,10 +519,12 @@ async def send_foundry_request(request_body):
         raise e
 
 
-async def complete_foundry_request(request_body):
+async def complete_foundry_request(request_body, request_headers=None):
     """Complete a Foundry agent request and format the response."""
     try:
         foundry_response = await send_foundry_request(request_body)
+        if request_headers is not None and isinstance(foundry_response, dict):
+            record_usage(request_user_id(request_headers), foundry_response.get("usage"))
         
         logging.debug(f"Raw Foundry response keys: {foundry_response.keys() if isinstance(foundry_response, dict) else 'not a dict'}")
         
@@ -367,6 +608,8 @@ async def complete_foundry_request(request_body):
         raise e
 
 
+@tracer.start_as_current_span("prepare_model_args")
+@timed("payload")
 def prepare_model_args(request_body, request_headers):
     request_messages = request_body.get("messages", [])
     messages = []
@@ -419,6 +662,9 @@ def prepare_model_args(request_body, request_headers):
         "stream": app_settings.azure_openai.stream,
         "model": app_settings.azure_openai.model
     }
+    if model_args["stream"] and app_settings.azure_openai.stream_include_usage:
+        ## usage arrives in a final chunk with no choices, which format_stream_response drops
+        model_args["stream_options"] = {"include_usage": True}
 
     if len(messages) > 0:
         if messages[-1]["role"] == "user":
@@ -426,13 +672,14 @@ def prepare_model_args(request_body, request_headers):
                 model_args["tools"] = azure_openai_tools
 
             if app_settings.datasource:
-                model_args["extra_body"] = {
-                    "data_sources": [
-                        app_settings.datasource.construct_payload_configuration(
-                            request=request
-                        )
-                    ]
-                }
+                with tracer.start_as_current_span("construct_payload_configuration"):
+                    model_args["extra_body"] = {
+                        "data_sources": [
+                            app_settings.datasource.construct_payload_configuration(
+                                request=request
+                            )
+                        ]
+                    }
 
     model_args_clean = copy.deepcopy(model_args)
     if model_args_clean.get("extra_body"):
@@ -478,36 +725,45 @@ def prepare_model_args(request_body, request_headers):
 
 
 async def promptflow_request(request):
-    try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {app_settings.promptflow.api_key}",
-        }
-        # Adding timeout for scenarios where response takes longer to come back
-        logging.debug(f"Setting timeout to {app_settings.promptflow.response_timeout}")
-        async with httpx.AsyncClient(
-            timeout=float(app_settings.promptflow.response_timeout)
-        ) as client:
-            pf_formatted_obj = convert_to_pf_format(
-                request,
-                app_settings.promptflow.request_field_name,
-                app_settings.promptflow.response_field_name
-            )
-            # NOTE: This only support question and chat_history parameters
-            # If you need to add more parameters, you need to modify the request body
-            response = await client.post(
-                app_settings.promptflow.endpoint,
-                json={
-                    app_settings.promptflow.request_field_name: pf_formatted_obj[-1]["inputs"][app_settings.promptflow.request_field_name],
-                    "chat_history": pf_formatted_obj[:-1],
-                },
-                headers=headers,
-            )
-        resp = response.json()
-        resp["id"] = request["messages"][-1]["id"]
-        return resp
-    except Exception as e:
-        logging.error(f"An error occurred while making promptflow_request: {e}")
+    with tracer.start_as_current_span("promptflow_request", kind=trace.SpanKind.CLIENT) as span:
+        try:
+            headers = {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {app_settings.promptflow.api_key}",
+            }
+            # Adding timeout for scenarios where response takes longer to come back
+            logging.debug(f"Setting timeout to {app_settings.promptflow.response_timeout}")
+            async with httpx.AsyncClient(
+                timeout=float(app_settings.promptflow.response_timeout)
+            ) as client:
+                with tracer.start_as_current_span("convert_to_pf_format"):
+                    pf_formatted_obj = convert_to_pf_format(
+                        request,
+                        app_settings.promptflow.request_field_name,
+                        app_settings.promptflow.response_field_name
+                    )
+                # NOTE: This only support question and chat_history parameters
+                # If you need to add more parameters, you need to modify the request body
+                with timed("upstream"):
+                    response = await client.post(
+                        app_settings.promptflow.endpoint,
+                        json={
+                            app_settings.promptflow.request_field_name: pf_formatted_obj[-1]["inputs"][app_settings.promptflow.request_field_name],
+                            "chat_history": pf_formatted_obj[:-1],
+                        },
+                        headers=inject_trace_headers(headers),
+                    )
+            UPSTREAM_RESPONSES.inc(backend="promptflow", status_code=response.status_code)
+            span.set_attribute("http.response.status_code", response.status_code)
+            resp = response.json()
+            resp["id"] = request["messages"][-1]["id"]
+            return resp
+        except Exception as e:
+            if isinstance(e, httpx.HTTPError):
+                UPSTREAM_RESPONSES.inc(backend="promptflow", status_code="error")
+            span.record_exception(e)
+            span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
+            logging.error(f"An error occurred while making promptflow_request: {e}")
 
 
 async def process_function_call(response):
@@ -520,7 +776,8 @@ async def process_function_call(response):
             if tool_call.function.name not in azure_openai_available_tools:
                 continue
             
-            function_response = await openai_remote_azure_function_call(tool_call.function.name, tool_call.function.arguments)
+            with tracer.start_as_current_span("process_function_call"):
+                function_response = await openai_remote_azure_function_call(tool_call.function.name, tool_call.function.arguments)
 
             # adding assistant response to messages
             messages.append(
@@ -557,14 +814,29 @@ async def send_chat_request(request_body, request_headers):
     request_body['messages'] = filtered_messages
     model_args = prepare_model_args(request_body, request_headers)
 
-    try:
-        azure_openai_client = await init_openai_client()
-        raw_response = await azure_openai_client.chat.completions.with_raw_response.create(**model_args)
-        response = raw_response.parse()
-        apim_request_id = raw_response.headers.get("apim-request-id") 
-    except Exception as e:
-        logging.exception("Exception in send_chat_request")
-        raise e
+    with tracer.start_as_current_span("azure_openai.chat_completions", kind=trace.SpanKind.CLIENT) as span:
+        span.set_attribute("gen_ai.request.model", model_args["model"] or "")
+        span.set_attribute("gen_ai.request.stream", bool(model_args["stream"]))
+        span.set_attribute("gen_ai.request.message_count", len(model_args["messages"]))
+        try:
+            azure_openai_client = await get_openai_client()
+            with timed("upstream"):
+                raw_response = await azure_openai_client.chat.completions.with_raw_response.create(
+                    **model_args,
+                    extra_headers=inject_trace_headers()
+                )
+            UPSTREAM_RESPONSES.inc(backend="azure_openai", status_code=raw_response.status_code)
+            response = raw_response.parse()
+            apim_request_id = raw_response.headers.get("apim-request-id") 
+        except Exception as e:
+            UPSTREAM_RESPONSES.inc(backend="azure_openai", status_code=getattr(e, "status_code", "error"))
+            logging.exception("Exception in send_chat_request")
+            raise e
+
+        span.set_attribute("http.response.status_code", raw_response.status_code)
+        if apim_request_id:
+            span.set_attribute("azure_openai.apim_request_id", apim_request_id)
+        logging.info(f"Azure OpenAI responded {raw_response.status_code}, apim-request-id: {apim_request_id}, trace id: {current_trace_id()}")
 
     return response, apim_request_id
 
@@ -580,7 +852,9 @@ async def complete_chat_request(request_body, request_headers):
             app_settings.promptflow.citations_field_name
         )
     else:
+        user_id = request_user_id(request_headers)
         response, apim_request_id = await send_chat_request(request_body, request_headers)
+        record_usage(user_id, response.usage)
         history_metadata = request_body.get("history_metadata", {})
         non_streaming_response = format_non_streaming_response(response, history_metadata, apim_request_id)
 
@@ -591,6 +865,7 @@ async def complete_chat_request(request_body, request_headers):
                 request_body["messages"].extend(function_response)
 
                 response, apim_request_id = await send_chat_request(request_body, request_headers)
+                record_usage(user_id, response.usage)
                 history_metadata = request_body.get("history_metadata", {})
                 non_streaming_response = format_non_streaming_response(response, history_metadata, apim_request_id)
 
@@ -635,23 +910,25 @@ async def process_function_call_stream(completionChunk, function_call_stream_sta
             function_call_stream_state.current_tool_call["tool_arguments"] = function_call_stream_state.tool_arguments_stream
             function_call_stream_state.tool_calls.append(function_call_stream_state.current_tool_call)
             
-            for tool_call in function_call_stream_state.tool_calls:
-                tool_response = await openai_remote_azure_function_call(tool_call["tool_name"], tool_call["tool_arguments"])
-
-                function_call_stream_state.function_messages.append({
-                    "role": "assistant",
-                    "function_call": {
-                        "name" : tool_call["tool_name"],
-                        "arguments": tool_call["tool_arguments"]
-                    },
-                    "content": None
-                })
-                function_call_stream_state.function_messages.append({
-                    "tool_call_id": tool_call["tool_id"],
-                    "role": "function",
-                    "name": tool_call["tool_name"],
-                    "content": tool_response,
-                })
+            with tracer.start_as_current_span("process_function_call_stream") as span:
+                span.set_attribute("tool.call_count", len(function_call_stream_state.tool_calls))
+                for tool_call in function_call_stream_state.tool_calls:
+                    tool_response = await openai_remote_azure_function_call(tool_call["tool_name"], tool_call["tool_arguments"])
+
+                    function_call_stream_state.function_messages.append({
+                        "role": "assistant",
+                        "function_call": {
+                            "name" : tool_call["tool_name"],
+                            "arguments": tool_call["tool_arguments"]
+                        },
+                        "content": None
+                    })
+                    function_call_stream_state.function_messages.append({
+                        "tool_call_id": tool_call["tool_id"],
+                        "role": "function",
+                        "name": tool_call["tool_name"],
+                        "content": tool_response,
+                    })
             
             function_call_stream_state.streaming_state = "COMPLETED"
             return function_call_stream_state.streaming_state
@@ -661,8 +938,10 @@ async def process_function_call_stream(completionChunk, function_call_stream_sta
 
 
 async def stream_chat_request(request_body, request_headers):
-    response, apim_request_id = await send_chat_request(request_body, request_headers)
+    with tracer.start_as_current_span("stream_chat_request"):
+        response, apim_request_id = await send_chat_request(request_body, request_headers)
     history_metadata = request_body.get("history_metadata", {})
+    user_id = request_user_id(request_headers)
     
     async def generate(apim_request_id, history_metadata):
         if app_settings.azure_openai.function_call_azure_functions_enabled:
@@ -670,6 +949,7 @@ async def stream_chat_request(request_body, request_headers):
             function_call_stream_state = AzureOpenaiFunctionCallStreamState()
             
             async for completionChunk in response:
+                record_usage(user_id, completionChunk.usage)
                 stream_state = await process_function_call_stream(completionChunk, function_call_stream_state, request_body, request_headers, history_metadata, apim_request_id)
                 
                 # No function call, asistant response
@@ -682,36 +962,133 @@ async def stream_chat_request(request_body, request_headers):
                     request_body["messages"].extend(function_call_stream_state.function_messages)
                     function_response, apim_request_id = await send_chat_request(request_body, request_headers)
                     async for functionCompletionChunk in function_response:
+                        record_usage(user_id, functionCompletionChunk.usage)
                         yield format_stream_response(functionCompletionChunk, history_metadata, apim_request_id)
                 
         else:
             async for completionChunk in response:
+                record_usage(user_id, completionChunk.usage)
                 yield format_stream_response(completionChunk, history_metadata, apim_request_id)
 
     return generate(apim_request_id=apim_request_id, history_metadata=history_metadata)
 
 
+def chat_backend():
+    if app_settings.foundry and app_settings.foundry.enabled:
+        return "foundry"
+    if app_settings.base_settings.use_promptflow:
+        return "promptflow"
+    return "azure_openai"
+
+
+def record_chat_request(route, backend, start, status):
+    CHAT_REQUESTS.inc(route=route, backend=backend, status=status)
+    CHAT_REQUEST_DURATION.observe(time.perf_counter() - start, route=route, backend=backend)
+
+
+def frame_has_content(frame):
+    choices = frame.get("choices") if isinstance(frame, dict) else None
+    return bool(choices) and any(
+        message.get("role") == "assistant" and message.get("content")
+        for message in choices[0].get("messages", [])
+    )
+
+
+def wants_timing_trailer(request_headers):
+    return request_headers.get(SERVER_TIMING_TRAILER_HEADER, "").lower() == "true"
+
+
+def timing_trailer(timings, first_token_at, tokens):
+    server_timing = timings.as_dict()
+    if first_token_at is not None:
+        server_timing["ttft"] = round((first_token_at - timings.start) * 1000, 2)
+    return {"object": "server_timing", "server_timing": server_timing, "tokens": {"completion": tokens}}
+
+
+async def instrument_stream(stream, route, backend, start, span, timings=None):
+    # Stream chunks carry roughly one token each, so content frames approximate completion tokens.
+    # With `timings`, a final server_timing frame is sent after the last chunk.
+    CHAT_STREAMS_IN_FLIGHT.inc(route=route, backend=backend)
+    status = "ok"
+    first_token_at = None
+    tokens = 0
+    try:
+        while True:
+            ## the span is re-entered for each step rather than held across yields,
+            ## so spans started while producing a frame still nest under it
+            with trace.use_span(span, end_on_exit=False):
+                try:
+                    frame = await stream.__anext__()
+                except StopAsyncIteration:
+                    break
+            CHAT_STREAM_FRAMES.inc(route=route, backend=backend)
+            if frame_has_content(frame):
+                tokens += 1
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    CHAT_TIME_TO_FIRST_TOKEN.observe(first_token_at - start, route=route, backend=backend)
+                    span.add_event("first_token")
+            yield frame
+        if timings is not None:
+            yield timing_trailer(timings, first_token_at, tokens)
+    except (GeneratorExit, asyncio.CancelledError):
+        status = "cancelled"
+        raise
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        end = time.perf_counter()
+        CHAT_STREAMS_IN_FLIGHT.dec(route=route, backend=backend)
+        record_chat_request(route, backend, start, status)
+        if first_token_at is not None and tokens > 1 and end > first_token_at:
+            CHAT_TOKENS_PER_SECOND.observe((tokens - 1) / (end - first_token_at), route=route, backend=backend)
+        span.set_attribute("chat.stream.status", status)
+        span.set_attribute("chat.stream.content_frames", tokens)
+        span.end()
+
+
 async def conversation_internal(request_body, request_headers):
+    route = current_route()
+    backend = chat_backend()
+    start = time.perf_counter()
+    if any(budget is not None for budget in usage_tracker.budgets.values()):
+        user_id = request_user_id(request_headers)
+        await usage_tracker.seed(user_id, current_app.cosmos_conversation_client)
+        window = usage_tracker.exceeded_budget(user_id)
+        if window:
+            record_chat_request(route, backend, start, "over_budget")
+            return jsonify({"error": f"The {window} token budget of {usage_tracker.budgets[window]} tokens has been used up"}), 429
+    ## for streams the span is ended by instrument_stream once the last frame is sent
+    span = tracer.start_span("conversation_internal", attributes={"chat.route": route, "chat.backend": backend})
     try:
-        # Check if Foundry is enabled and should be used
-        if app_settings.foundry and app_settings.foundry.enabled:
-            # Use Foundry agent
-            logging.debug("Routing request to Foundry agent")
-            result = await complete_foundry_request(request_body)
-            return jsonify(result)
-        
-        # Use Azure OpenAI (default behavior)
-        if app_settings.azure_openai.stream and not app_settings.base_settings.use_promptflow:
-            result = await stream_chat_request(request_body, request_headers)
-            response = await make_response(format_as_ndjson(result))
-            response.timeout = None
-            response.mimetype = "application/json-lines"
-            return response
-        else:
-            result = await complete_chat_request(request_body, request_headers)
-            return jsonify(result)
+        with trace.use_span(span, end_on_exit=False):
+            # Check if Foundry is enabled and should be used
+            if app_settings.foundry and app_settings.foundry.enabled:
+                # Use Foundry agent
+                logging.debug("Routing request to Foundry agent")
+                result = await complete_foundry_request(request_body, request_headers)
+                record_chat_request(route, backend, start, "ok")
+                span.end()
+                return jsonify(result)
+            
+            # Use Azure OpenAI (default behavior)
+            if app_settings.azure_openai.stream and not app_settings.base_settings.use_promptflow:
+                result = await stream_chat_request(request_body, request_headers)
+                timings = current_timings() if wants_timing_trailer(request_headers) else None
+                response = await make_response(format_as_ndjson(instrument_stream(result, route, backend, start, span, timings)))
+                response.timeout = None
+                response.mimetype = "application/json-lines"
+                return response
+            else:
+                result = await complete_chat_request(request_body, request_headers)
+                record_chat_request(route, backend, start, "ok")
+                span.end()
+                return jsonify(result)
 
     except Exception as ex:
+        record_chat_request(route, backend, start, "error")
+        span.end()
         logging.exception(ex)
         if hasattr(ex, "status_code"):
             return jsonify({"error": str(ex)}), ex.status_code
@@ -737,6 +1114,66 @@ def get_frontend_settings():
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/metrics", methods=["GET"])
+async def get_metrics():
+    ## only served to scrapers presenting METRICS_TOKEN, route labels and usage counters are not public
+    token = app_settings.base_settings.metrics_token
+    if not token:
+        return jsonify({"error": "Not Found"}), 404
+    if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    response = await make_response(await metrics.render_async())
+    response.mimetype = "text/plain"
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
+
+@bp.route("/ready", methods=["GET"])
+async def ready():
+    ## for the load balancer: 503 until this worker has warmed up its clients
+    if not health_monitor.ready:
+        return jsonify({"status": "warming_up"}), 503
+    return jsonify({"status": "ready"}), 200
+
+
+@bp.route("/healthz", methods=["GET"])
+async def healthz():
+    ## cached dependency status, so probes never call Cosmos DB or Azure OpenAI themselves
+    return jsonify(health_monitor.snapshot()), 200
+
+
+@bp.route("/admin/usage", methods=["GET"])
+async def get_usage():
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    if authenticated_user["user_principal_id"] not in app_settings.usage.admin_user_ids:
+        return jsonify({"error": "Forbidden"}), 403
+
+    user_id = request.args.get("user_id")
+    days = request.args.get("days", 30, type=int)
+    try:
+        ## persist what this worker has counted so far, so the store is up to date
+        await usage_tracker.flush(current_app.cosmos_conversation_client)
+        history = []
+        if current_app.cosmos_conversation_client:
+            history = await current_app.cosmos_conversation_client.get_usage(
+                user_id=user_id, since_day=usage_day(time.time() - days * 86400)
+            )
+        user_ids = [user_id] if user_id else list(usage_tracker.windows)
+        return jsonify({
+            "budgets": usage_tracker.budgets,
+            ## the sliding windows this worker checks budgets against
+            "windows": {
+                uid: {window: usage_tracker.usage(uid, window) for window in WINDOWS}
+                for uid in user_ids
+            },
+            "history": history,
+        }), 200
+    except Exception as e:
+        logging.exception("Exception in /admin/usage")
+        return jsonify({"error": str(e)}), 500
+
+
 ## Conversation History API ##
 @bp.route("/history/generate", methods=["POST"])
 async def add_conversation():
@@ -756,7 +1193,7 @@ async def add_conversation():
         # check for the conversation_id, if the conversation is not set, we will create a new one
         history_metadata = {}
         if not conversation_id:
-            title = await generate_title(request_json["messages"])
+            title = await generate_title(request_json["messages"], user_id)
             conversation_dict = await current_app.cosmos_conversation_client.create_conversation(
                 user_id=user_id, title=title
             )
@@ -1133,6 +1570,104 @@ async def clear_messages():
         return jsonify({"error": str(e)}), 500
 
 
+HISTORY_EXPORT_PAGE_SIZE = 100
+HISTORY_IMPORT_BATCH_SIZE = 100
+HISTORY_IMPORT_MAX_INFLIGHT_BATCHES = 4
+HISTORY_IMPORT_REQUIRED_FIELDS = {
+    "conversation": ("id", "createdAt", "updatedAt"),
+    "message": ("id", "conversationId", "createdAt", "role", "content"),
+}
+
+
+@bp.route("/history/export", methods=["GET"])
+async def export_conversations():
+    await cosmos_db_ready.wait()
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user["user_principal_id"]
+    continuation = request.args.get("continuation", None)
+
+    ## make sure cosmos is configured
+    if not current_app.cosmos_conversation_client:
+        raise Exception("CosmosDB is not configured or not working")
+
+    conversation_client = current_app.cosmos_conversation_client
+
+    ## stream pages straight from the query iterator; after every page emit the
+    ## continuation token so an interrupted export can be resumed with ?continuation=
+    async def generate():
+        async for documents, continuation_token in conversation_client.export_documents(
+            user_id, continuation=continuation, page_size=HISTORY_EXPORT_PAGE_SIZE
+        ):
+            for document in documents:
+                yield document
+            yield {"type": "continuation", "continuation": continuation_token}
+
+    response = await make_response(format_as_ndjson(generate()))
+    response.timeout = None
+    response.mimetype = "application/json-lines"
+    return response
+
+
+@bp.route("/history/import", methods=["POST"])
+async def import_conversations():
+    await cosmos_db_ready.wait()
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user["user_principal_id"]
+    in_flight = set()
+
+    try:
+        ## make sure cosmos is configured
+        if not current_app.cosmos_conversation_client:
+            raise Exception("CosmosDB is not configured or not working")
+
+        conversation_client = current_app.cosmos_conversation_client
+        imported = 0
+        skipped = 0
+        batch = []
+
+        async def drain(return_when):
+            nonlocal imported
+            done, _ = await asyncio.wait(in_flight, return_when=return_when)
+            for task in done:
+                in_flight.discard(task)
+                imported += task.result()
+
+        ## the body is consumed incrementally so memory stays bounded by the
+        ## in-flight batches rather than the size of the upload
+        async for document in parse_ndjson(request.body):
+            if (
+                not isinstance(document, dict)
+                or document.get("type") not in HISTORY_IMPORT_REQUIRED_FIELDS
+                or not all(field in document for field in HISTORY_IMPORT_REQUIRED_FIELDS[document["type"]])
+                ## ids reserved for the store's own documents, such as the daily usage totals
+                or str(document["id"]).startswith(USAGE_ID_PREFIX)
+            ):
+                skipped += 1
+                continue
+
+            ## documents are always imported into the caller's own partition
+            document["userId"] = user_id
+            batch.append(document)
+            if len(batch) >= HISTORY_IMPORT_BATCH_SIZE:
+                if len(in_flight) >= HISTORY_IMPORT_MAX_INFLIGHT_BATCHES:
+                    await drain(asyncio.FIRST_COMPLETED)
+                in_flight.add(asyncio.create_task(conversation_client.import_documents(user_id, batch)))
+                batch = []
+
+        if batch:
+            in_flight.add(asyncio.create_task(conversation_client.import_documents(user_id, batch)))
+        if in_flight:
+            await drain(asyncio.ALL_COMPLETED)
+
+        return jsonify({"imported": imported, "skipped": skipped}), 200
+
+    except Exception as e:
+        for task in in_flight:
+            task.cancel()
+        logging.exception("Exception in /history/import")
+        return jsonify({"error": str(e)}), 500
+
+
 @bp.route("/history/ensure", methods=["GET"])
 async def ensure_cosmos():
     await cosmos_db_ready.wait()
@@ -1174,7 +1709,7 @@ async def ensure_cosmos():
             return jsonify({"error": "CosmosDB is not working"}), 500
 
 
-async def generate_title(conversation_messages) -> str:
+async def generate_title(conversation_messages, user_id=None) -> str:
     ## make sure the messages are sorted by _ts descending
     title_prompt = "Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Do not include any other commentary or description."
 
@@ -1185,10 +1720,12 @@ async def generate_title(conversation_messages) -> str:
     messages.append({"role": "user", "content": title_prompt})
 
     try:
-        azure_openai_client = await init_openai_client()
-        response = await azure_openai_client.chat.completions.create(
-            model=app_settings.azure_openai.model, messages=messages, temperature=1, max_tokens=64
-        )
+        azure_openai_client = await get_openai_client()
+        with timed("upstream"):
+            response = await azure_openai_client.chat.completions.create(
+                model=app_settings.azure_openai.model, messages=messages, temperature=1, max_tokens=64
+            )
+        record_usage(user_id, response.usage)
 
         title = response.choices[0].message.content
         return title
@@ -1197,6 +1734,34 @@ async def generate_title(conversation_messages) -> str:
         return messages[-2]["content"]
 
 
+## one Foundry client, with its connection pool and credential, per worker process
+foundry_client = None
+foundry_client_lock = asyncio.Lock()
+
+
+async def get_foundry_client():
+    global foundry_client
+    if foundry_client is None:
+        async with foundry_client_lock:
+            if foundry_client is None:
+                foundry_client = await init_foundry_client()
+    return foundry_client
+
+
+async def close_foundry_client():
+    global foundry_client
+    if foundry_client is not None:
+        await foundry_client.close()
+        foundry_client = None
+
+
+async def warm_up_foundry():
+    client = await get_foundry_client()
+    if not client:
+        raise ValueError("Failed to initialize Foundry client")
+    await client.warm_up()
+
+
 # Initialize Foundry Client
 async def init_foundry_client():
     """Initialize Foundry Agent client"""
@@ -1219,6 +1784,7 @@ async def init_foundry_client():
             logging.warning("Foundry is enabled but neither FOUNDRY_BEARER_TOKEN nor FOUNDRY_USE_AZURE_IDENTITY is set")
             return None
         
+        from backend.foundry.client import FoundryClient
         client = FoundryClient(
             endpoint=endpoint,
             bearer_token=bearer_token if not app_settings.foundry.use_azure_identity else None,
@@ -1248,8 +1814,7 @@ async def foundry_conversation():
         if not messages:
             return jsonify({"error": "messages is required"}), 400
         
-        # Initialize Foundry client
-        foundry_client = await init_foundry_client()
+        foundry_client = await get_foundry_client()
         if not foundry_client:
             return jsonify({"error": "Failed to initialize Foundry client"}), 500
         
@@ -1258,17 +1823,24 @@ async def foundry_conversation():
         
         if stream:
             # Streaming response
+            timings = current_timings() if wants_timing_trailer(request.headers) else None
+
             async def generate():
+                first_token_at = None
+                chunks = 0
                 try:
                     async for chunk in foundry_client.send_message(messages, stream=True):
+                        chunks += 1
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
                         yield f"data: {chunk}\n\n"
+                    if timings is not None:
+                        yield f"data: {json.dumps(timing_trailer(timings, first_token_at, chunks))}\n\n"
                     yield "data: [DONE]\n\n"
                 except Exception as e:
                     logging.exception("Error during Foundry streaming")
                     error_response = {"error": str(e)}
                     yield f"data: {json.dumps(error_response)}\n\n"
-                finally:
-                    await foundry_client.close()
             
             response = await make_response(generate())
             response.headers["Content-Type"] = "text/event-stream"
@@ -1278,13 +1850,14 @@ async def foundry_conversation():
         else:
             # Non-streaming response
             try:
-                result = await foundry_client.send_message_non_streaming(messages)
+                with timed("upstream"):
+                    result = await foundry_client.send_message_non_streaming(messages)
+                if isinstance(result, dict):
+                    record_usage(request_user_id(request.headers), result.get("usage"))
                 return jsonify(result), 200
             except Exception as e:
                 logging.exception("Error during Foundry non-streaming request")
                 return jsonify({"error": str(e)}), 500
-            finally:
-                await foundry_client.close()
                 
     except Exception as e:
         logging.exception("Exception in /foundry/conversation")
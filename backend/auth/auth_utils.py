@@ -1,3 +1,9 @@
+from backend.timing import timed
+from backend.tracing import tracer
+
+
+@tracer.start_as_current_span("get_authenticated_user_details")
+@timed("auth")
 def get_authenticated_user_details(request_headers):
     user_object = {}
 
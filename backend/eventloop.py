@@ -0,0 +1,145 @@
+"""Event loop health: lag monitoring, stall stack capture and blocking call detection.
+
+`EventLoopWatchdog.run` samples how late the loop wakes up from a timed sleep
+and records it in event_loop_lag_seconds. With a threshold, a watchdog thread
+also notices when the loop has not woken up for longer than that, captures
+the stack of whatever is running on the loop thread at that moment, and the
+stall is logged with that stack once the loop recovers.
+
+`install_blocking_call_detector` is a debugging aid: it wraps blocking socket
+operations, DNS lookups and time.sleep so that calling them from a running
+event loop is logged with its call stack and counted.
+"""
+import asyncio
+import logging
+import socket
+import ssl
+import sys
+import threading
+import time
+import traceback
+
+from backend.metrics import metrics
+
+EVENT_LOOP_LAG = metrics.histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop woke up from a timed sleep",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+EVENT_LOOP_STALLS = metrics.counter(
+    "event_loop_stalls_total",
+    "Times the event loop was blocked for longer than the watchdog threshold"
+)
+BLOCKING_CALLS = metrics.counter(
+    "event_loop_blocking_calls_total",
+    "Blocking calls made from the event loop thread (blocking call detector only)",
+    ("call",)
+)
+
+
+class EventLoopWatchdog():
+    def __init__(self, threshold: float = None, interval: float = 0.5):
+        self.threshold = threshold
+        self.interval = interval
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        ## (heartbeat the stall started after, stack of the blocking code)
+        self.stall = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _watch(self):
+        poll = min(self.interval, self.threshold) / 2
+        stalled_since = None
+        while not self._stop.wait(poll):
+            heartbeat = self.heartbeat
+            if time.monotonic() - heartbeat - self.interval < self.threshold or stalled_since == heartbeat:
+                continue
+            ## the loop is still blocked: what it is running now is what blocks it
+            stalled_since = heartbeat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                self.stall = (heartbeat, "".join(traceback.format_stack(frame)))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        if self.threshold:
+            self._thread = threading.Thread(target=self._watch, name="event-loop-watchdog", daemon=True)
+            self._thread.start()
+        try:
+            while True:
+                start = loop.time()
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, loop.time() - start - self.interval)
+                previous_heartbeat, self.heartbeat = self.heartbeat, time.monotonic()
+                EVENT_LOOP_LAG.observe(lag)
+                if self.threshold and lag >= self.threshold:
+                    EVENT_LOOP_STALLS.inc()
+                    stall = self.stall
+                    stack = stall[1] if stall and stall[0] == previous_heartbeat else None
+                    logging.warning(
+                        f"Event loop was blocked for {lag:.3f}s"
+                        + (f", blocking code:\n{stack}" if stack else "")
+                    )
+        finally:
+            self._stop.set()
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+_detector_originals = []
+
+
+def install_blocking_call_detector():
+    """Log and count blocking socket, DNS and sleep calls made from a running event loop."""
+    if _detector_originals:
+        return
+    reported = set()
+
+    def report(call):
+        BLOCKING_CALLS.inc(call=call)
+        ## drop this frame and the wrapper
+        stack = traceback.extract_stack()[:-2]
+        call_site = (call, tuple((f.filename, f.lineno) for f in stack))
+        if call_site in reported:
+            return
+        reported.add(call_site)
+        logging.warning(f"Blocking call {call} on the event loop thread:\n{''.join(traceback.format_list(stack))}")
+
+    def wrap(owner, name, call, check_socket=False):
+        original = getattr(owner, name)
+        ## socket.socket inherits most methods from _socket.socket
+        _detector_originals.append((owner, name, original if name in vars(owner) else None))
+
+        def wrapper(*args, **kwargs):
+            ## asyncio drives its own sockets in non-blocking mode
+            if _on_event_loop() and not (check_socket and args[0].gettimeout() == 0.0):
+                report(call)
+            return original(*args, **kwargs)
+
+        setattr(owner, name, wrapper)
+
+    wrap(time, "sleep", "time.sleep")
+    wrap(socket, "getaddrinfo", "socket.getaddrinfo")
+    wrap(socket, "gethostbyname", "socket.gethostbyname")
+    for cls in (socket.socket, ssl.SSLSocket):
+        for name in ("connect", "recv", "recv_into", "send", "sendall"):
+            if name in vars(cls) or cls is socket.socket:
+                wrap(cls, name, f"socket.{name}", check_socket=True)
+
+
+def uninstall_blocking_call_detector():
+    while _detector_originals:
+        owner, name, original = _detector_originals.pop()
+        if original is None:
+            delattr(owner, name)
+        else:
+            setattr(owner, name, original)
@@ -8,6 +8,9 @@ import logging
 import httpx
 from typing import AsyncGenerator, Optional, Dict, Any
 import json
+from opentelemetry import trace
+
+from backend.tracing import tracer, inject_trace_headers
 
 logger = logging.getLogger(__name__)
 
@@ -41,7 +44,19 @@ class FoundryClient:
     async def close(self):
         """Close the HTTP client"""
         await self._client.aclose()
-    
+        if self.credential:
+            await self.credential.close()
+
+    async def warm_up(self):
+        """
+        Acquire a token and open a pooled connection to the endpoint.
+
+        Any HTTP response counts, since only the connection is of interest;
+        transport and authentication errors are raised.
+        """
+        headers = {"Authorization": f"Bearer {await self._get_bearer_token()}"}
+        await self._client.options(self.endpoint, headers=headers)
+
     async def _get_bearer_token(self) -> str:
         """Get bearer token either from static token or Azure credential"""
         if self.bearer_token:
@@ -131,6 +146,11 @@ class FoundryClient:
         logger.debug(f"Sending request to Foundry: {self.endpoint}")
         logger.debug(f"Conversation history: {len(conversation_history)} messages")
         
+        # Not made current: the context must not be held across yields of this generator
+        span = tracer.start_span("foundry.send_message", kind=trace.SpanKind.CLIENT)
+        span.set_attribute("foundry.stream", stream)
+        span.set_attribute("foundry.history_length", len(conversation_history))
+        inject_trace_headers(headers, span)
         try:
             if stream:
                 async with self._client.stream(
@@ -139,6 +159,7 @@ class FoundryClient:
                     json=payload,
                     headers=headers
                 ) as response:
+                    span.set_attribute("http.response.status_code", response.status_code)
                     response.raise_for_status()
                     
                     async for line in response.aiter_lines():
@@ -157,18 +178,24 @@ class FoundryClient:
                     json=payload,
                     headers=headers
                 )
+                span.set_attribute("http.response.status_code", response.status_code)
                 response.raise_for_status()
                 yield response.text
                 
         except httpx.HTTPStatusError as e:
             logger.error(f"HTTP error occurred: {e.response.status_code} - {e.response.text}")
+            span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
             raise
         except httpx.RequestError as e:
             logger.error(f"Request error occurred: {str(e)}")
+            span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
             raise
         except Exception as e:
             logger.error(f"Unexpected error: {str(e)}")
+            span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
             raise
+        finally:
+            span.end()
     
     async def send_message_non_streaming(
         self,
@@ -234,21 +261,24 @@ class FoundryClient:
         
         logger.debug(f"Sending non-streaming request to Foundry: {self.endpoint}")
         
-        try:
-            response = await self._client.post(
-                self.endpoint,
-                json=payload,
-                headers=headers
-            )
-            response.raise_for_status()
-            return response.json()
-            
-        except httpx.HTTPStatusError as e:
-            logger.error(f"HTTP error occurred: {e.response.status_code} - {e.response.text}")
-            raise
-        except httpx.RequestError as e:
-            logger.error(f"Request error occurred: {str(e)}")
-            raise
-        except Exception as e:
-            logger.error(f"Unexpected error: {str(e)}")
-            raise
+        with tracer.start_as_current_span("foundry.send_message_non_streaming", kind=trace.SpanKind.CLIENT) as span:
+            span.set_attribute("foundry.history_length", len(conversation_history))
+            try:
+                response = await self._client.post(
+                    self.endpoint,
+                    json=payload,
+                    headers=inject_trace_headers(headers)
+                )
+                span.set_attribute("http.response.status_code", response.status_code)
+                response.raise_for_status()
+                return response.json()
+                
+            except httpx.HTTPStatusError as e:
+                logger.error(f"HTTP error occurred: {e.response.status_code} - {e.response.text}")
+                raise
+            except httpx.RequestError as e:
+                logger.error(f"Request error occurred: {str(e)}")
+                raise
+            except Exception as e:
+                logger.error(f"Unexpected error: {str(e)}")
+                raise
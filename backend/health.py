@@ -0,0 +1,97 @@
+"""Startup warm-up, readiness and cached dependency health.
+
+`HealthMonitor` runs one async check per dependency (Azure OpenAI, chat
+history, Foundry) and caches the outcome. The first round runs as the
+worker's warm-up right after startup: each check goes through the same
+pooled client the request path uses, so DNS resolution, the TLS handshake,
+the Entra token and any metadata the SDK caches are already in place when
+the first user arrives. The worker reports ready once warm-up has finished,
+whether or not every dependency answered; a dependency outage shows in the
+cached status rather than taking every instance out of rotation.
+
+After warm-up `run` repeats the checks every `interval` seconds, so health
+probes read the cached status and never call a dependency themselves.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from backend.metrics import metrics
+
+DEPENDENCY_UP = metrics.gauge(
+    "dependency_up",
+    "1 if the last check of the dependency succeeded, 0 otherwise",
+    ["dependency"]
+)
+DEPENDENCY_CHECK_DURATION = metrics.histogram(
+    "dependency_check_duration_seconds",
+    "Duration of dependency health checks",
+    ["dependency"]
+)
+
+
+class HealthMonitor():
+    def __init__(self, timeout: float = 10.0):
+        self.timeout = timeout
+        self.checks: Dict[str, Callable[[], Awaitable]] = {}
+        self.status: Dict[str, dict] = {}
+        self.ready = False
+        self.warmup_seconds: Optional[float] = None
+
+    def register(self, name: str, check: Callable[[], Awaitable]):
+        """Add a check; it passes unless it raises or times out."""
+        self.checks[name] = check
+
+    async def _check(self, name, check):
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(check(), self.timeout)
+            status = {"status": "ok"}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Health check {name} failed: {type(e).__name__}: {e}")
+            status = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+        duration = time.perf_counter() - start
+        status.update(latency_ms=round(duration * 1000, 1), checked_at=time.time())
+        self.status[name] = status
+        DEPENDENCY_UP.set(1 if status["status"] == "ok" else 0, dependency=name)
+        DEPENDENCY_CHECK_DURATION.observe(duration, dependency=name)
+
+    async def check_all(self):
+        await asyncio.gather(*(self._check(name, check) for name, check in self.checks.items()))
+
+    async def warm_up(self, timeout: float = 30.0):
+        """Run every check once, then report ready, even if checks failed or ran out of time."""
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.check_all(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Warm-up did not finish within {timeout}s")
+            for name in self.checks.keys() - self.status.keys():
+                self.status[name] = {"status": "error", "error": "timed out during warm-up", "checked_at": time.time()}
+                DEPENDENCY_UP.set(0, dependency=name)
+        self.warmup_seconds = time.perf_counter() - start
+        self.ready = True
+        logging.info(f"Warm-up finished in {self.warmup_seconds:.2f}s: {self.summary()}")
+
+    async def run(self, interval: float, warmup_timeout: float = 30.0):
+        """Warm up, then refresh the cached status every `interval` seconds."""
+        await self.warm_up(warmup_timeout)
+        while True:
+            await asyncio.sleep(interval)
+            await self.check_all()
+
+    def summary(self) -> str:
+        if any(status["status"] != "ok" for status in self.status.values()):
+            return "degraded"
+        return "ok"
+
+    def snapshot(self) -> dict:
+        return {
+            "status": self.summary(),
+            "ready": self.ready,
+            "warmup_seconds": round(self.warmup_seconds, 3) if self.warmup_seconds is not None else None,
+            "dependencies": self.status,
+        }
@@ -0,0 +1,68 @@
+from typing import AsyncIterator, List, Optional, Protocol, Tuple, runtime_checkable
+
+## ids of the documents a store keeps for itself next to the conversations,
+## such as the daily usage totals; imported documents may not use them
+USAGE_ID_PREFIX = "usage-"
+
+
+@runtime_checkable
+class ConversationStore(Protocol):
+    """Interface implemented by every chat history backend.
+
+    The method signatures and return values mirror CosmosConversationClient,
+    which is the reference implementation; app.py only talks to this
+    interface so any backend can be selected through _ChatHistorySettings.
+    """
+
+    async def ensure(self) -> tuple:
+        ...
+
+    async def create_conversation(self, user_id, title='') -> dict:
+        ...
+
+    async def upsert_conversation(self, conversation: dict) -> dict:
+        ...
+
+    async def delete_conversation(self, user_id, conversation_id):
+        ...
+
+    async def delete_messages(self, conversation_id, user_id) -> Optional[list]:
+        ...
+
+    async def get_conversations(self, user_id, limit, sort_order='DESC', offset=0) -> List[dict]:
+        ...
+
+    async def get_conversation(self, user_id, conversation_id) -> Optional[dict]:
+        ...
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        ...
+
+    async def update_message_feedback(self, user_id, message_id, feedback):
+        ...
+
+    async def get_messages(self, user_id, conversation_id) -> List[dict]:
+        ...
+
+    def export_documents(self, user_id, continuation=None, page_size=100) -> AsyncIterator[Tuple[List[dict], Optional[str]]]:
+        """Yield (documents, continuation_token) pages of every conversation
+        and message owned by the user. Passing a yielded token back in
+        resumes the export after that page."""
+        ...
+
+    async def import_documents(self, user_id, documents: List[dict], max_concurrency=8) -> int:
+        """Upsert a batch of exported conversation/message documents.
+        Documents with an id reserved by the store (USAGE_ID_PREFIX) are not
+        imported. Returns the number of documents imported."""
+        ...
+
+    async def record_usage(self, user_id, day, prompt_tokens, completion_tokens, requests):
+        """Add token usage to the user's totals for a UTC day (YYYY-MM-DD)."""
+        ...
+
+    async def get_usage(self, user_id=None, since_day=None) -> List[dict]:
+        """Daily usage documents from `since_day` on, for one user or all users."""
+        ...
+
+    async def close(self):
+        ...
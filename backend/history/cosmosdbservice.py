@@ -1,16 +1,91 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import time
 import uuid
 from datetime import datetime
+from azure.core.async_paging import AsyncItemPaged
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
+from azure.cosmos.http_constants import HttpHeaders
+from opentelemetry import trace
+
+from backend.history.conversationstore import USAGE_ID_PREFIX
+from backend.metrics import metrics
+from backend.timing import timed
+from backend.tracing import tracer
+from backend.utils import current_route
+
+COSMOS_SYSTEM_PROPERTIES = ('_rid', '_self', '_etag', '_attachments', '_ts')
+
+COSMOS_REQUEST_CHARGE = metrics.histogram(
+    "cosmos_request_charge",
+    "Request units consumed per chat history operation",
+    ("operation", "route"),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+)
+COSMOS_OPERATION_DURATION = metrics.histogram(
+    "cosmos_operation_duration_seconds",
+    "Latency of chat history operations, including SDK retries",
+    ("operation", "route")
+)
+COSMOS_OPERATION_ITEMS = metrics.histogram(
+    "cosmos_operation_items",
+    "Documents read or written per chat history operation",
+    ("operation", "route"),
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 1000)
+)
+COSMOS_OPERATIONS = metrics.counter(
+    "cosmos_operations_total",
+    "Chat history operations by outcome",
+    ("operation", "route", "status")
+)
+COSMOS_THROTTLE_RETRIES = metrics.counter(
+    "cosmos_throttle_retries_total",
+    "429 retries performed by the Cosmos SDK on behalf of chat history operations",
+    ("operation", "route")
+)
+
+## the operation that owns the Cosmos calls made by the current task, so that
+## nested calls (e.g. create_message -> get_conversation) roll up into it
+_current_operation = contextvars.ContextVar("cosmos_current_operation", default=None)
+
+
+class CosmosOperationStats():
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.request_charge = 0.0
+        self.retries = 0
+        self.items = 0
+        self.requests = 0
+
+    def response_hook(self, headers, result):
+        ## query_items also fires the hook once before any page is fetched,
+        ## with the headers of whatever request the connection made last
+        if isinstance(result, AsyncItemPaged):
+            return
+        headers = headers or {}
+        self.requests += 1
+        self.request_charge += float(headers.get(HttpHeaders.RequestCharge) or 0)
+        self.retries += int(headers.get(HttpHeaders.ThrottleRetryCount) or 0)
+        if isinstance(result, dict) and 'Documents' in result:
+            self.items += len(result['Documents'])
+        elif result:
+            self.items += 1
+
   
 class CosmosConversationClient():
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False, request_charge_log_threshold: float = None):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
+        self.request_charge_log_threshold = request_charge_log_threshold
         try:
             self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
         except exceptions.CosmosHttpResponseError as e:
@@ -30,18 +105,66 @@ class CosmosConversationClient():
             raise ValueError("Invalid CosmosDB container name") 
         
 
+    def _record(self, operation, stats, duration, status):
+        route = current_route()
+        COSMOS_REQUEST_CHARGE.observe(stats.request_charge, operation=operation, route=route)
+        COSMOS_OPERATION_DURATION.observe(duration, operation=operation, route=route)
+        COSMOS_OPERATION_ITEMS.observe(stats.items, operation=operation, route=route)
+        COSMOS_OPERATIONS.inc(operation=operation, route=route, status=status)
+        if stats.retries:
+            COSMOS_THROTTLE_RETRIES.inc(stats.retries, operation=operation, route=route)
+
+        if (
+            self.request_charge_log_threshold is not None
+            and stats.request_charge >= self.request_charge_log_threshold
+        ):
+            logging.info(
+                f"CosmosDB {operation} on {route}: {stats.request_charge:.2f} RU, "
+                f"{duration * 1000:.1f} ms, {stats.requests} requests, {stats.retries} retries, {stats.items} items"
+            )
+
+    @contextlib.asynccontextmanager
+    async def _instrument(self, operation):
+        stats = _current_operation.get()
+        if stats is not None:
+            yield stats
+            return
+
+        stats = CosmosOperationStats()
+        token = _current_operation.set(stats)
+        status = "ok"
+        start = time.perf_counter()
+        with timed("history"), tracer.start_as_current_span(f"cosmosdb.{operation}", kind=trace.SpanKind.CLIENT) as span:
+            span.set_attribute("db.system", "cosmosdb")
+            span.set_attribute("db.operation", operation)
+            try:
+                yield stats
+            except BaseException:
+                status = "error"
+                raise
+            finally:
+                _current_operation.reset(token)
+                self._record(operation, stats, time.perf_counter() - start, status)
+                span.set_attribute("db.cosmosdb.request_charge", stats.request_charge)
+                span.set_attribute("db.cosmosdb.throttle_retries", stats.retries)
+                span.set_attribute("db.cosmosdb.item_count", stats.items)
+
+    async def close(self):
+        await self.cosmosdb_client.close()
+
     async def ensure(self):
         if not self.cosmosdb_client or not self.database_client or not self.container_client:
             return False, "CosmosDB client not initialized correctly"
-        try:
-            database_info = await self.database_client.read()
-        except:
-            return False, f"CosmosDB database {self.database_name} on account {self.cosmosdb_endpoint} not found"
+        async with self._instrument("ensure") as stats:
+            try:
+                database_info = await self.database_client.read(response_hook=stats.response_hook)
+            except:
+                return False, f"CosmosDB database {self.database_name} on account {self.cosmosdb_endpoint} not found"
         
-        try:
-            container_info = await self.container_client.read()
-        except:
-            return False, f"CosmosDB container {self.container_name} not found"
+            try:
+                container_info = await self.container_client.read(response_hook=stats.response_hook)
+            except:
+                return False, f"CosmosDB container {self.container_name} not found"
             
         return True, "CosmosDB client initialized successfully"
 
@@ -55,37 +178,41 @@ class CosmosConversationClient():
             'title': title
         }
         ## TODO: add some error handling based on the output of the upsert_item call
-        resp = await self.container_client.upsert_item(conversation)  
+        async with self._instrument("create_conversation") as stats:
+            resp = await self.container_client.upsert_item(conversation, response_hook=stats.response_hook)
         if resp:
             return resp
         else:
             return False
     
     async def upsert_conversation(self, conversation):
-        resp = await self.container_client.upsert_item(conversation)
+        async with self._instrument("upsert_conversation") as stats:
+            resp = await self.container_client.upsert_item(conversation, response_hook=stats.response_hook)
         if resp:
             return resp
         else:
             return False
 
     async def delete_conversation(self, user_id, conversation_id):
-        conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
-        if conversation:
-            resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
-            return resp
-        else:
-            return True
+        async with self._instrument("delete_conversation") as stats:
+            conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id, response_hook=stats.response_hook)
+            if conversation:
+                resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id, response_hook=stats.response_hook)
+                return resp
+            else:
+                return True
 
         
     async def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = await self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = await self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
+        async with self._instrument("delete_messages") as stats:
+            ## get a list of all the messages in the conversation
+            messages = await self.get_messages(user_id, conversation_id)
+            response_list = []
+            if messages:
+                for message in messages:
+                    resp = await self.container_client.delete_item(item=message['id'], partition_key=user_id, response_hook=stats.response_hook)
+                    response_list.append(resp)
+                return response_list
 
 
     async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
@@ -100,8 +227,9 @@ class CosmosConversationClient():
             query += f" offset {offset} limit {limit}" 
         
         conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
+        async with self._instrument("get_conversations") as stats:
+            async for item in self.container_client.query_items(query=query, parameters=parameters, response_hook=stats.response_hook):
+                conversations.append(item)
         
         return conversations
 
@@ -118,8 +246,9 @@ class CosmosConversationClient():
         ]
         query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
         conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
+        async with self._instrument("get_conversation") as stats:
+            async for item in self.container_client.query_items(query=query, parameters=parameters, response_hook=stats.response_hook):
+                conversations.append(item)
 
         ## if no conversations are found, return None
         if len(conversations) == 0:
@@ -142,26 +271,28 @@ class CosmosConversationClient():
         if self.enable_message_feedback:
             message['feedback'] = ''
         
-        resp = await self.container_client.upsert_item(message)  
-        if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
-                return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
-            return resp
-        else:
-            return False
+        async with self._instrument("create_message") as stats:
+            resp = await self.container_client.upsert_item(message, response_hook=stats.response_hook)
+            if resp:
+                ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
+                conversation = await self.get_conversation(user_id, conversation_id)
+                if not conversation:
+                    return "Conversation not found"
+                conversation['updatedAt'] = message['createdAt']
+                await self.upsert_conversation(conversation)
+                return resp
+            else:
+                return False
     
     async def update_message_feedback(self, user_id, message_id, feedback):
-        message = await self.container_client.read_item(item=message_id, partition_key=user_id)
-        if message:
-            message['feedback'] = feedback
-            resp = await self.container_client.upsert_item(message)
-            return resp
-        else:
-            return False
+        async with self._instrument("update_message_feedback") as stats:
+            message = await self.container_client.read_item(item=message_id, partition_key=user_id, response_hook=stats.response_hook)
+            if message:
+                message['feedback'] = feedback
+                resp = await self.container_client.upsert_item(message, response_hook=stats.response_hook)
+                return resp
+            else:
+                return False
 
     async def get_messages(self, user_id, conversation_id):
         parameters = [
@@ -176,8 +307,104 @@ class CosmosConversationClient():
         ]
         query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
         messages = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            messages.append(item)
+        async with self._instrument("get_messages") as stats:
+            async for item in self.container_client.query_items(query=query, parameters=parameters, response_hook=stats.response_hook):
+                messages.append(item)
 
         return messages
 
+    async def export_documents(self, user_id, continuation=None, page_size=100):
+        ## stream every conversation and message document in the user's partition, one page at a time
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = "SELECT * FROM c WHERE c.userId = @userId AND c.type IN ('conversation', 'message')"
+        ## this is an async generator, so each page is recorded on its own
+        ## instead of holding an operation open across yields
+        stats = CosmosOperationStats()
+        pager = self.container_client.query_items(
+            query=query,
+            parameters=parameters,
+            partition_key=user_id,
+            max_item_count=page_size,
+            response_hook=stats.response_hook
+        ).by_page(continuation)
+        while True:
+            start = time.perf_counter()
+            try:
+                page = await pager.__anext__()
+                documents = []
+                async for item in page:
+                    documents.append({k: v for k, v in item.items() if k not in COSMOS_SYSTEM_PROPERTIES})
+            except StopAsyncIteration:
+                break
+            except BaseException:
+                self._record("export_documents", stats, time.perf_counter() - start, "error")
+                raise
+            self._record("export_documents", stats, time.perf_counter() - start, "ok")
+            stats.reset()
+            yield documents, pager.continuation_token
+
+    async def import_documents(self, user_id, documents, max_concurrency=8):
+        ## an upsert with a usage document's id would replace the day's totals the budgets are checked against
+        documents = [document for document in documents if not str(document['id']).startswith(USAGE_ID_PREFIX)]
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async with self._instrument("import_documents") as stats:
+            async def upsert(document):
+                async with semaphore:
+                    return await self.container_client.upsert_item(document, response_hook=stats.response_hook)
+
+            await asyncio.gather(*[upsert(document) for document in documents])
+        return len(documents)
+
+    async def record_usage(self, user_id, day, prompt_tokens, completion_tokens, requests):
+        ## one document per user and day; incr patches keep concurrent writers from losing updates
+        usage_id = f"{USAGE_ID_PREFIX}{day}"
+        patch_operations = [
+            {'op': 'incr', 'path': '/prompt_tokens', 'value': prompt_tokens},
+            {'op': 'incr', 'path': '/completion_tokens', 'value': completion_tokens},
+            {'op': 'incr', 'path': '/requests', 'value': requests},
+        ]
+        async with self._instrument("record_usage") as stats:
+            try:
+                await self.container_client.patch_item(item=usage_id, partition_key=user_id, patch_operations=patch_operations, response_hook=stats.response_hook)
+                return
+            except exceptions.CosmosResourceNotFoundError:
+                pass
+
+            usage = {
+                'id': usage_id,
+                'type': 'usage',
+                'userId': user_id,
+                'day': day,
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'requests': requests
+            }
+            try:
+                await self.container_client.create_item(usage, response_hook=stats.response_hook)
+            except exceptions.CosmosResourceExistsError:
+                ## another worker created the day's document first
+                await self.container_client.patch_item(item=usage_id, partition_key=user_id, patch_operations=patch_operations, response_hook=stats.response_hook)
+
+    async def get_usage(self, user_id=None, since_day=None):
+        conditions = ["c.type = 'usage'"]
+        parameters = []
+        if user_id is not None:
+            conditions.append("c.userId = @userId")
+            parameters.append({'name': '@userId', 'value': user_id})
+        if since_day is not None:
+            conditions.append("c.day >= @sinceDay")
+            parameters.append({'name': '@sinceDay', 'value': since_day})
+        query = f"SELECT * FROM c WHERE {' AND '.join(conditions)} ORDER BY c.day ASC"
+
+        usage = []
+        async with self._instrument("get_usage") as stats:
+            async for item in self.container_client.query_items(query=query, parameters=parameters, response_hook=stats.response_hook):
+                usage.append({k: v for k, v in item.items() if k not in COSMOS_SYSTEM_PROPERTIES})
+
+        return usage
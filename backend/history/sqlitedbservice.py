@@ -0,0 +1,340 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from backend.history.conversationstore import USAGE_ID_PREFIX
+from backend.timing import timed
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT NOT NULL,
+    userId TEXT NOT NULL,
+    createdAt TEXT NOT NULL,
+    updatedAt TEXT NOT NULL,
+    doc TEXT NOT NULL,
+    PRIMARY KEY (userId, id)
+);
+CREATE INDEX IF NOT EXISTS ix_conversations_user_updated
+    ON conversations (userId, updatedAt);
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT NOT NULL,
+    userId TEXT NOT NULL,
+    conversationId TEXT NOT NULL,
+    createdAt TEXT NOT NULL,
+    doc TEXT NOT NULL,
+    PRIMARY KEY (userId, id)
+);
+CREATE INDEX IF NOT EXISTS ix_messages_conversation_created
+    ON messages (conversationId, createdAt);
+CREATE TABLE IF NOT EXISTS usage (
+    userId TEXT NOT NULL,
+    day TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    requests INTEGER NOT NULL,
+    PRIMARY KEY (userId, day)
+);
+"""
+
+UPSERT_CONVERSATION = (
+    "INSERT INTO conversations (id, userId, createdAt, updatedAt, doc) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT (userId, id) DO UPDATE SET updatedAt = excluded.updatedAt, doc = excluded.doc"
+)
+UPSERT_MESSAGE = (
+    "INSERT INTO messages (id, userId, conversationId, createdAt, doc) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT (userId, id) DO UPDATE SET conversationId = excluded.conversationId, doc = excluded.doc"
+)
+RECORD_USAGE = (
+    "INSERT INTO usage (userId, day, prompt_tokens, completion_tokens, requests) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT (userId, day) DO UPDATE SET prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+    "completion_tokens = completion_tokens + excluded.completion_tokens, requests = requests + excluded.requests"
+)
+
+
+class SqliteConversationClient():
+    """Chat history store backed by a local SQLite database.
+
+    SQLite connections are not safe to share between threads, so every
+    statement runs on one dedicated worker thread. Writes issued while a
+    commit is in flight are queued and committed together in a single
+    transaction (group commit), which keeps the number of fsyncs per
+    second bounded under concurrent load. The database runs in WAL mode so
+    readers never block on the writer.
+    """
+
+    def __init__(self, db_path: str, enable_message_feedback: bool = False, write_batch_size: int = 128):
+        self.db_path = db_path
+        self.enable_message_feedback = enable_message_feedback
+        self.write_batch_size = write_batch_size
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-history")
+        self._connection = None
+        self._pending_writes = []
+        self._flush_task = None
+
+    ## Everything below runs on the dedicated SQLite thread
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=OFF")
+            connection.executescript(SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def _fetch_docs(self, query, parameters):
+        rows = self._get_connection().execute(query, parameters).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _commit_batch(self, batch):
+        connection = self._get_connection()
+        errors = []
+        connection.execute("BEGIN")
+        try:
+            for statements, _ in batch:
+                connection.execute("SAVEPOINT item")
+                try:
+                    for query, parameters in statements:
+                        connection.execute(query, parameters)
+                    connection.execute("RELEASE item")
+                    errors.append(None)
+                except sqlite3.Error as e:
+                    connection.execute("ROLLBACK TO item")
+                    connection.execute("RELEASE item")
+                    errors.append(e)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return errors
+
+    def _close_connection(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    ## Async facade
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def _read(self, query, parameters=()):
+        with timed("history"):
+            return await self._run(self._fetch_docs, query, parameters)
+
+    async def _write(self, statements):
+        future = asyncio.get_running_loop().create_future()
+        self._pending_writes.append((statements, future))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+        with timed("history"):
+            await future
+
+    async def _flush(self):
+        while self._pending_writes:
+            batch = self._pending_writes[:self.write_batch_size]
+            del self._pending_writes[:self.write_batch_size]
+            try:
+                errors = await self._run(self._commit_batch, batch)
+            except Exception as e:
+                logging.exception("SQLite history batch commit failed")
+                errors = [e] * len(batch)
+
+            for (_, future), error in zip(batch, errors):
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+    async def close(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._run(self._close_connection)
+        self._executor.shutdown(wait=True)
+
+    async def ensure(self):
+        try:
+            await self._run(lambda: self._get_connection().execute("SELECT 1").fetchone())
+        except sqlite3.Error:
+            return False, f"SQLite database {self.db_path} could not be opened"
+
+        return True, "SQLite client initialized successfully"
+
+    def _upsert_conversation_statement(self, conversation):
+        return (
+            UPSERT_CONVERSATION,
+            (
+                conversation['id'],
+                conversation['userId'],
+                conversation['createdAt'],
+                conversation['updatedAt'],
+                json.dumps(conversation),
+            )
+        )
+
+    async def create_conversation(self, user_id, title = ''):
+        conversation = {
+            'id': str(uuid.uuid4()),
+            'type': 'conversation',
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'userId': user_id,
+            'title': title
+        }
+        await self._write([self._upsert_conversation_statement(conversation)])
+        return conversation
+
+    async def upsert_conversation(self, conversation):
+        await self._write([self._upsert_conversation_statement(conversation)])
+        return conversation
+
+    async def delete_conversation(self, user_id, conversation_id):
+        await self._write([
+            ("DELETE FROM conversations WHERE userId = ? AND id = ?", (user_id, conversation_id))
+        ])
+        return True
+
+    async def delete_messages(self, conversation_id, user_id):
+        messages = await self.get_messages(user_id, conversation_id)
+        if messages:
+            await self._write([
+                ("DELETE FROM messages WHERE userId = ? AND conversationId = ?", (user_id, conversation_id))
+            ])
+            return [None] * len(messages)
+
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        sort_order = 'ASC' if str(sort_order).upper() == 'ASC' else 'DESC'
+        query = f"SELECT doc FROM conversations WHERE userId = ? ORDER BY updatedAt {sort_order}"
+        parameters = [user_id]
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            parameters.extend([int(limit), int(offset)])
+
+        return await self._read(query, parameters)
+
+    async def get_conversation(self, user_id, conversation_id):
+        conversations = await self._read(
+            "SELECT doc FROM conversations WHERE userId = ? AND id = ?",
+            (user_id, conversation_id)
+        )
+
+        ## if no conversations are found, return None
+        if len(conversations) == 0:
+            return None
+        else:
+            return conversations[0]
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        message = {
+            'id': uuid,
+            'type': 'message',
+            'userId' : user_id,
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'conversationId' : conversation_id,
+            'role': input_message['role'],
+            'content': input_message['content']
+        }
+
+        if self.enable_message_feedback:
+            message['feedback'] = ''
+
+        conversation = await self.get_conversation(user_id, conversation_id)
+        if not conversation:
+            return "Conversation not found"
+
+        ## write the message and bump the parent conversation's updatedAt in one transaction
+        conversation['updatedAt'] = message['createdAt']
+        await self._write([
+            (
+                UPSERT_MESSAGE,
+                (message['id'], user_id, conversation_id, message['createdAt'], json.dumps(message))
+            ),
+            self._upsert_conversation_statement(conversation),
+        ])
+        return message
+
+    async def update_message_feedback(self, user_id, message_id, feedback):
+        messages = await self._read(
+            "SELECT doc FROM messages WHERE userId = ? AND id = ?",
+            (user_id, message_id)
+        )
+        if messages:
+            message = messages[0]
+            message['feedback'] = feedback
+            await self._write([
+                (
+                    "UPDATE messages SET doc = ? WHERE userId = ? AND id = ?",
+                    (json.dumps(message), user_id, message_id)
+                )
+            ])
+            return message
+        else:
+            return False
+
+    async def get_messages(self, user_id, conversation_id):
+        return await self._read(
+            "SELECT doc FROM messages WHERE conversationId = ? AND userId = ? ORDER BY createdAt ASC",
+            (conversation_id, user_id)
+        )
+
+    async def export_documents(self, user_id, continuation=None, page_size=100):
+        ## continuation tokens are keyset cursors of the form "<table>:<rowid>"
+        tables = ['conversations', 'messages']
+        table, last_rowid = 'conversations', 0
+        if continuation:
+            table, _, last_rowid = continuation.partition(':')
+            if table not in tables:
+                raise ValueError(f"Invalid continuation token: {continuation}")
+            last_rowid = int(last_rowid)
+
+        for current_table in tables[tables.index(table):]:
+            while True:
+                rows = await self._run(
+                    lambda: self._get_connection().execute(
+                        f"SELECT rowid, doc FROM {current_table} WHERE userId = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                        (user_id, last_rowid, page_size)
+                    ).fetchall()
+                )
+                if not rows:
+                    break
+                last_rowid = rows[-1][0]
+                yield [json.loads(row[1]) for row in rows], f"{current_table}:{last_rowid}"
+                if len(rows) < page_size:
+                    break
+            last_rowid = 0
+
+    async def import_documents(self, user_id, documents, max_concurrency=8):
+        documents = [document for document in documents if not str(document['id']).startswith(USAGE_ID_PREFIX)]
+        statements = []
+        for document in documents:
+            if document['type'] == 'conversation':
+                statements.append(self._upsert_conversation_statement(document))
+            else:
+                statements.append((
+                    UPSERT_MESSAGE,
+                    (document['id'], user_id, document['conversationId'], document['createdAt'], json.dumps(document))
+                ))
+        ## one transaction per batch, the SQLite thread serializes writers anyway
+        await self._write(statements)
+        return len(documents)
+
+    async def record_usage(self, user_id, day, prompt_tokens, completion_tokens, requests):
+        await self._write([
+            (RECORD_USAGE, (user_id, day, prompt_tokens, completion_tokens, requests))
+        ])
+
+    async def get_usage(self, user_id=None, since_day=None):
+        ## shaped like the Cosmos usage documents
+        query = (
+            "SELECT json_object('id', 'usage-' || day, 'type', 'usage', 'userId', userId, 'day', day, "
+            "'prompt_tokens', prompt_tokens, 'completion_tokens', completion_tokens, 'requests', requests) "
+            "FROM usage WHERE (? IS NULL OR userId = ?) AND (? IS NULL OR day >= ?) ORDER BY day ASC"
+        )
+        return await self._read(query, (user_id, user_id, since_day, since_day))
@@ -0,0 +1,230 @@
+"""In-process metrics registry rendered in the Prometheus text format.
+
+Metrics are only ever recorded from the event loop thread, so recording is a
+plain dict update with no locking.
+
+When the app runs under several worker processes (gunicorn), each worker
+periodically writes a snapshot of its registry to a shared directory and
+/metrics merges every snapshot at scrape time: counters and histograms are
+summed across all workers that ever wrote one, gauges only across workers
+that are still alive.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+from bisect import bisect_left
+from typing import Dict, Iterable, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_names: Tuple[str, ...], label_values: Tuple, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter():
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        for key, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        self.values[key] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram():
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> [per-bucket counts..., sum, count]
+        self.values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [0] * (len(self.buckets) + 2)
+        state[bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def render(self):
+        for key, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, ("le", _format_value(bound)))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {_format_value(state[-2])}"
+            yield f"{self.name}_count{labels} {state[-1]}"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MetricsRegistry():
+    def __init__(self):
+        self.metrics = {}
+        self.multiprocess_dir = None
+
+    def _register(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, label_names=()) -> Counter:
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()) -> Gauge:
+        return self._register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def enable_multiprocess(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.multiprocess_dir = directory
+
+    def snapshot(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "metrics": {
+                metric.name: {
+                    "type": metric.type_name,
+                    "documentation": metric.documentation,
+                    "label_names": list(metric.label_names),
+                    "buckets": [b for b in getattr(metric, "buckets", ()) if b != math.inf],
+                    ## histogram states are copied so the snapshot can be written from another thread
+                    "values": [[list(key), list(value) if isinstance(value, list) else value] for key, value in metric.values.items()],
+                }
+                for metric in self.metrics.values()
+            },
+        }
+
+    def write_snapshot(self, snapshot: Optional[dict] = None):
+        if not self.multiprocess_dir:
+            return
+        path = os.path.join(self.multiprocess_dir, f"metrics_{os.getpid()}.json")
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(snapshot or self.snapshot(), f)
+        os.replace(temp_path, path)
+
+    async def export_snapshots(self, interval: float = 5.0):
+        while True:
+            try:
+                ## the snapshot is taken on the loop, the file is written off it
+                await asyncio.to_thread(self.write_snapshot, self.snapshot())
+            except OSError:
+                logging.exception("Failed to write metrics snapshot")
+            await asyncio.sleep(interval)
+
+    def _read_snapshots(self):
+        snapshots = []
+        for file_name in os.listdir(self.multiprocess_dir):
+            if not file_name.startswith("metrics_") or not file_name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.multiprocess_dir, file_name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                logging.warning(f"Skipping unreadable metrics snapshot {file_name}")
+        return snapshots
+
+    def _merged_metrics(self, snapshot: Optional[dict] = None):
+        self.write_snapshot(snapshot)
+        merged = {}
+        for snapshot in self._read_snapshots():
+            alive = snapshot["pid"] == os.getpid() or _pid_alive(snapshot["pid"])
+            for name, data in snapshot["metrics"].items():
+                metric = merged.get(name)
+                if metric is None:
+                    if data["type"] == "histogram":
+                        metric = Histogram(name, data["documentation"], data["label_names"], data["buckets"])
+                    elif data["type"] == "gauge":
+                        metric = Gauge(name, data["documentation"], data["label_names"])
+                    else:
+                        metric = Counter(name, data["documentation"], data["label_names"])
+                    merged[name] = metric
+                if data["type"] == "gauge" and not alive:
+                    continue
+                for key, value in data["values"]:
+                    key = tuple(key)
+                    if data["type"] == "histogram":
+                        state = metric.values.setdefault(key, [0] * len(value))
+                        for i, v in enumerate(value):
+                            state[i] += v
+                    else:
+                        metric.values[key] = metric.values.get(key, 0) + value
+        return merged.values()
+
+    def render(self) -> str:
+        return self._render(self._merged_metrics() if self.multiprocess_dir else self.metrics.values())
+
+    async def render_async(self) -> str:
+        """Like render, but writes and reads the worker snapshots in a thread instead of on the event loop."""
+        if not self.multiprocess_dir:
+            return self.render()
+        merged = await asyncio.to_thread(self._merged_metrics, self.snapshot())
+        return self._render(merged)
+
+    def _render(self, metrics) -> str:
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,145 @@
+"""Opt-in profiling of single requests.
+
+When PROFILING_ENABLED is set, the ASGI app is wrapped in
+`RequestProfilerMiddleware`. A request is profiled only if it carries an
+`X-Profile-Request` header signed with PROFILING_SECRET, and the profile
+covers the whole ASGI call, including every frame of a streamed response.
+The profile is written to PROFILING_OUTPUT_DIR and its file name is returned
+in the `X-Profile-Id` response header. When profiling is disabled the
+middleware is not installed at all.
+
+Generate a header value for a path with:
+
+    python -m backend.profiling /conversation
+"""
+import hashlib
+import hmac
+import logging
+import os
+import sys
+import time
+import uuid
+
+PROFILE_REQUEST_HEADER = b"x-profile-request"
+PROFILE_ID_HEADER = b"x-profile-id"
+SIGNATURE_MAX_AGE_SECONDS = 300
+
+
+def sign_profile_request(secret: str, path: str, timestamp: int = None) -> str:
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f"{timestamp}:{path}".encode(), hashlib.sha256).hexdigest()
+    return f"{timestamp}.{signature}"
+
+
+def verify_profile_request(secret: str, path: str, header_value: str, now: float = None) -> bool:
+    try:
+        timestamp, _ = header_value.split(".", 1)
+        timestamp = int(timestamp)
+    except ValueError:
+        return False
+    now = time.time() if now is None else now
+    if abs(now - timestamp) > SIGNATURE_MAX_AGE_SECONDS:
+        return False
+    return hmac.compare_digest(sign_profile_request(secret, path, timestamp), header_value)
+
+
+class _PyinstrumentSession():
+    extension = "speedscope.json"
+
+    def __init__(self, interval):
+        from pyinstrument import Profiler
+        ## async_mode="enabled" only samples the request's own context, not the
+        ## other requests that share the event loop
+        self.profiler = Profiler(interval=interval, async_mode="enabled")
+
+    def start(self):
+        self.profiler.start()
+
+    def stop(self, path):
+        from pyinstrument.renderers import SpeedscopeRenderer
+        self.profiler.stop()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.profiler.output(SpeedscopeRenderer()))
+
+
+class _CProfileSession():
+    ## cProfile traces the whole thread, so concurrent requests on the same
+    ## event loop show up in the profile too
+    extension = "pstats"
+
+    def __init__(self, interval):
+        import cProfile
+        self.profiler = cProfile.Profile()
+
+    def start(self):
+        self.profiler.enable()
+
+    def stop(self, path):
+        self.profiler.disable()
+        self.profiler.dump_stats(path)
+
+
+PROFILERS = {
+    "pyinstrument": _PyinstrumentSession,
+    "cprofile": _CProfileSession,
+}
+
+
+class RequestProfilerMiddleware():
+    def __init__(self, app, secret: str, output_dir: str, profiler: str = "pyinstrument", interval: float = 0.001):
+        if not secret:
+            raise ValueError("PROFILING_SECRET is required when profiling is enabled")
+        if profiler == "pyinstrument":
+            try:
+                import pyinstrument
+            except ImportError as e:
+                raise ValueError("PROFILING_PROFILER=pyinstrument requires the pyinstrument package") from e
+        self.app = app
+        self.secret = secret
+        self.output_dir = output_dir
+        self.session_class = PROFILERS[profiler]
+        self.interval = interval
+        ## profilers hook the interpreter globally, so only one request is profiled at a time
+        self.active = False
+
+    def _requested(self, scope) -> bool:
+        if scope["type"] != "http":
+            return False
+        for name, value in scope["headers"]:
+            if name == PROFILE_REQUEST_HEADER:
+                if verify_profile_request(self.secret, scope["path"], value.decode("latin-1")):
+                    return True
+                logging.warning(f"Rejected profile request for {scope['path']}: invalid signature")
+                return False
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if self.active or not self._requested(scope):
+            await self.app(scope, receive, send)
+            return
+
+        session = self.session_class(self.interval)
+        profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}.{session.extension}"
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", []), (PROFILE_ID_HEADER, profile_id.encode())]}
+            await send(message)
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.active = True
+        session.start()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            session.stop(os.path.join(self.output_dir, profile_id))
+            self.active = False
+            logging.info(f"Profiled {scope['method']} {scope['path']} in {time.perf_counter() - start:.3f}s: {profile_id}")
+
+
+if __name__ == "__main__":
+    secret = os.environ.get("PROFILING_SECRET")
+    if not secret or len(sys.argv) != 2:
+        sys.exit("usage: PROFILING_SECRET=... python -m backend.profiling <path>")
+    print(f"X-Profile-Request: {sign_profile_request(secret, sys.argv[1])}")
@@ -0,0 +1,62 @@
+"""Production serving with gunicorn and uvicorn workers.
+
+`gunicorn app:app` run from the repository root picks up gunicorn.conf.py,
+which starts one `UvicornWorker` per available core. Each worker runs its
+own event loop, on uvloop with the httptools parser when those are
+installed, and creates its own Azure OpenAI, chat history and tracing
+clients in the app's before_serving hooks, since none of them survive a
+fork.
+
+On SIGTERM gunicorn stops accepting connections and each worker waits for
+its in-flight requests, including open response streams, to finish. After
+`graceful_timeout` minus `DRAIN_MARGIN_SECONDS`, uvicorn cancels whatever is
+still running and runs the app's after_serving hooks, before gunicorn would
+kill the worker.
+"""
+import math
+import os
+
+from uvicorn.workers import UvicornWorker as _UvicornWorker
+
+DRAIN_MARGIN_SECONDS = 5
+
+
+def _cgroup_cpu_limit():
+    ## cgroup v2, then v1; containers often see every host core in sched_getaffinity
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cpus() -> int:
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, math.ceil(limit))
+    return max(1, cpus)
+
+
+class UvicornWorker(_UvicornWorker):
+    ## uvloop and httptools when installed, asyncio and h11 otherwise
+    CONFIG_KWARGS = {"loop": "auto", "http": "auto"}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config.timeout_graceful_shutdown = max(1, self.cfg.graceful_timeout - DRAIN_MARGIN_SECONDS)
@@ -3,6 +3,7 @@ import os
 import json
 import logging
 from abc import ABC, abstractmethod
+from functools import cached_property, lru_cache
 from pydantic import (
     BaseModel,
     confloat,
@@ -17,10 +18,11 @@ from pydantic import (
 )
 from pydantic.alias_generators import to_snake
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from pydantic_settings.sources import DotEnvSettingsSource, read_env_file
 from typing import List, Literal, Optional
 from typing_extensions import Self
 from quart import Request
-from backend.utils import parse_multi_columns, generateFilterString
+from backend.utils import comma_separated_string_to_list, parse_multi_columns, generateFilterString
 
 DOTENV_PATH = os.environ.get(
     "DOTENV_PATH",
@@ -34,10 +36,62 @@ DOTENV_PATH = os.environ.get(
 MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION = "2024-05-01-preview"
 
 
-class _UiSettings(BaseSettings):
+@lru_cache(maxsize=None)
+def _read_dotenv(path: str, mtime_ns: int, case_sensitive: bool, ignore_empty: bool, parse_none_str: Optional[str]):
+    ## keyed on the modification time so an edited file is read again
+    return read_env_file(
+        path,
+        case_sensitive=case_sensitive,
+        ignore_empty=ignore_empty,
+        parse_none_str=parse_none_str
+    )
+
+
+class _SharedDotEnvSettingsSource(DotEnvSettingsSource):
+    """Reads DOTENV_PATH through a cache shared by every settings class."""
+
+    def _read_env_files(self):
+        try:
+            mtime_ns = os.stat(self.env_file).st_mtime_ns
+        except (OSError, TypeError):
+            return {}
+
+        return _read_dotenv(
+            self.env_file,
+            mtime_ns,
+            self.case_sensitive,
+            self.env_ignore_empty,
+            self.env_parse_none_str
+        )
+
+
+class _DotEnvSettings(BaseSettings):
+    ## validators are built when a class is first instantiated, so the
+    ## datasources a deployment does not use cost nothing at import
+    model_config = SettingsConfigDict(defer_build=True)
+
+    ## pydantic-settings would parse the .env file again for every settings class
+    ## and every instance; they all read it through one cached parse instead
+    @classmethod
+    def settings_customise_sources(
+        cls,
+        settings_cls,
+        init_settings,
+        env_settings,
+        dotenv_settings,
+        file_secret_settings
+    ):
+        return (
+            init_settings,
+            env_settings,
+            _SharedDotEnvSettingsSource(settings_cls, env_file=DOTENV_PATH),
+            file_secret_settings
+        )
+
+
+class _UiSettings(_DotEnvSettings):
     model_config = SettingsConfigDict(
         env_prefix="UI_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -52,25 +106,112 @@ class _UiSettings(BaseSettings):
     show_chat_history_button: bool = True
 
 
-class _ChatHistorySettings(BaseSettings):
+class _ChatHistorySettings(_DotEnvSettings):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_COSMOSDB_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
 
-    database: str
-    account: str
+    backend: Literal["cosmosdb", "sqlite"] = Field(
+        default="cosmosdb",
+        validation_alias="CHAT_HISTORY_BACKEND"
+    )
+    sqlite_path: str = Field(
+        default="chat_history.db",
+        validation_alias="CHAT_HISTORY_SQLITE_PATH"
+    )
+    database: Optional[str] = None
+    account: Optional[str] = None
     account_key: Optional[str] = None
-    conversations_container: str
+    conversations_container: Optional[str] = None
     enable_feedback: bool = False
+    request_charge_log_threshold: Optional[float] = None
+
+    @model_validator(mode="after")
+    def ensure_cosmosdb_settings(self) -> Self:
+        if self.backend == "cosmosdb" and not (
+            self.database and self.account and self.conversations_container
+        ):
+            raise ValueError(
+                "AZURE_COSMOSDB_ACCOUNT, AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER are required for the cosmosdb chat history backend"
+            )
+
+        return self
+
+
+class _TracingSettings(_DotEnvSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="TRACING_",
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    exporter: Literal["console", "file", "otlp"] = "console"
+    file_path: str = "traces.jsonl"
+    service_name: str = "sample-app-aoai-chatgpt"
+    sample_ratio: confloat(ge=0.0, le=1.0) = 1.0
+
+
+class _ProfilingSettings(_DotEnvSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="PROFILING_",
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    secret: Optional[str] = None
+    output_dir: str = "profiles"
+    profiler: Literal["pyinstrument", "cprofile"] = "pyinstrument"
+    interval: confloat(gt=0) = 0.001
+
+
+class _EventLoopSettings(_DotEnvSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="EVENT_LOOP_",
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    lag_threshold: confloat(ge=0) = 0.25
+    debug_blocking_calls: bool = False
+
+
+class _UsageSettings(_DotEnvSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="USAGE_",
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    daily_token_budget: Optional[conint(ge=1)] = None
+    monthly_token_budget: Optional[conint(ge=1)] = None
+    flush_interval: confloat(gt=0) = 60
+    admin_users: Optional[str] = None
+
+    @property
+    def admin_user_ids(self) -> List[str]:
+        return comma_separated_string_to_list(self.admin_users) if self.admin_users else []
+
+
+class _HealthSettings(_DotEnvSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="HEALTH_",
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    ready_after_warmup: bool = True
+    warmup_timeout: confloat(gt=0) = 30
+    check_interval: confloat(gt=0) = 60
+    check_timeout: confloat(gt=0) = 10
 
 
-class _PromptflowSettings(BaseSettings):
+class _PromptflowSettings(_DotEnvSettings):
     model_config = SettingsConfigDict(
         env_prefix="PROMPTFLOW_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -86,10 +227,9 @@ class _PromptflowSettings(BaseSettings):
 
 
 
-class _FoundrySettings(BaseSettings):
+class _FoundrySettings(_DotEnvSettings):
     model_config = SettingsConfigDict(
         env_prefix="FOUNDRY_",
-        env_file=DOTENV_PATH,
         extra="ignore",
     env_ignore_empty=True
     )
@@ -124,10 +264,9 @@ class _AzureOpenAITool(BaseModel):
     function: _AzureOpenAIFunction
     
 
-class _AzureOpenAISettings(BaseSettings):
+class _AzureOpenAISettings(_DotEnvSettings):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_OPENAI_",
-        env_file=DOTENV_PATH,
         extra='ignore',
         env_ignore_empty=True
     )
@@ -159,7 +298,15 @@ class _AzureOpenAISettings(BaseSettings):
     function_call_azure_functions_tools_base_url: Optional[str] = None
     function_call_azure_functions_tool_key: Optional[str] = None
     function_call_azure_functions_tool_base_url: Optional[str] = None
+    stream_include_usage: Optional[bool] = None
     
+    @model_validator(mode="after")
+    def set_stream_include_usage(self) -> Self:
+        ## stream_options is only accepted from the 2024-09-01-preview API version on
+        if self.stream_include_usage is None:
+            self.stream_include_usage = self.preview_api_version >= "2024-09-01"
+        return self
+
     @field_validator('tools', mode='before')
     @classmethod
     def deserialize_tools(cls, tools_json_str: str) -> List[_AzureOpenAITool]:
@@ -233,10 +380,9 @@ class _AzureOpenAISettings(BaseSettings):
             return None
     
 
-class _SearchCommonSettings(BaseSettings):
+class _SearchCommonSettings(_DotEnvSettings):
     model_config = SettingsConfigDict(
         env_prefix="SEARCH_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -274,10 +420,9 @@ class DatasourcePayloadConstructor(BaseModel, ABC):
         pass
 
 
-class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
+class _AzureSearchSettings(_DotEnvSettings, DatasourcePayloadConstructor):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_SEARCH_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -387,12 +532,11 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
 
 
 class _AzureCosmosDbMongoVcoreSettings(
-    BaseSettings,
+    _DotEnvSettings,
     DatasourcePayloadConstructor
 ):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_COSMOSDB_MONGO_VCORE_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -458,10 +602,9 @@ class _AzureCosmosDbMongoVcoreSettings(
         }
 
 
-class _ElasticsearchSettings(BaseSettings, DatasourcePayloadConstructor):
+class _ElasticsearchSettings(_DotEnvSettings, DatasourcePayloadConstructor):
     model_config = SettingsConfigDict(
         env_prefix="ELASTICSEARCH_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -531,10 +674,9 @@ class _ElasticsearchSettings(BaseSettings, DatasourcePayloadConstructor):
         }
 
 
-class _PineconeSettings(BaseSettings, DatasourcePayloadConstructor):
+class _PineconeSettings(_DotEnvSettings, DatasourcePayloadConstructor):
     model_config = SettingsConfigDict(
         env_prefix="PINECONE_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -601,10 +743,9 @@ class _PineconeSettings(BaseSettings, DatasourcePayloadConstructor):
         }
 
 
-class _AzureMLIndexSettings(BaseSettings, DatasourcePayloadConstructor):
+class _AzureMLIndexSettings(_DotEnvSettings, DatasourcePayloadConstructor):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_MLINDEX_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -657,10 +798,9 @@ class _AzureMLIndexSettings(BaseSettings, DatasourcePayloadConstructor):
         }
 
 
-class _AzureSqlServerSettings(BaseSettings, DatasourcePayloadConstructor):
+class _AzureSqlServerSettings(_DotEnvSettings, DatasourcePayloadConstructor):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_SQL_SERVER_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -704,10 +844,9 @@ class _AzureSqlServerSettings(BaseSettings, DatasourcePayloadConstructor):
         }
     
 
-class _MongoDbSettings(BaseSettings, DatasourcePayloadConstructor):
+class _MongoDbSettings(_DotEnvSettings, DatasourcePayloadConstructor):
     model_config = SettingsConfigDict(
         env_prefix="MONGODB_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -781,9 +920,8 @@ class _MongoDbSettings(BaseSettings, DatasourcePayloadConstructor):
         }
 
 
-class _BaseSettings(BaseSettings):
+class _BaseSettings(_DotEnvSettings):
     model_config = SettingsConfigDict(
-        env_file=DOTENV_PATH,
         extra="ignore",
         arbitrary_types_allowed=True,
         env_ignore_empty=True
@@ -792,6 +930,8 @@ class _BaseSettings(BaseSettings):
     auth_enabled: bool = True
     sanitize_answer: bool = False
     use_promptflow: bool = False
+    metrics_multiproc_dir: Optional[str] = None
+    metrics_token: Optional[str] = None
 
 
 
@@ -804,87 +944,81 @@ class _BaseSettings(BaseSettings):
 
 
 class _AppSettings(BaseModel):
-    base_settings: _BaseSettings = _BaseSettings()
-    azure_openai: _AzureOpenAISettings = _AzureOpenAISettings()
-    search: _SearchCommonSettings = _SearchCommonSettings()
-    ui: Optional[_UiSettings] = _UiSettings()
-    foundry: Optional[_FoundrySettings] = _FoundrySettings()
+    base_settings: _BaseSettings = Field(default_factory=_BaseSettings)
+    azure_openai: _AzureOpenAISettings = Field(default_factory=_AzureOpenAISettings)
+    search: _SearchCommonSettings = Field(default_factory=_SearchCommonSettings)
+    ui: Optional[_UiSettings] = Field(default_factory=_UiSettings)
+    tracing: _TracingSettings = Field(default_factory=_TracingSettings)
+    profiling: _ProfilingSettings = Field(default_factory=_ProfilingSettings)
+    event_loop: _EventLoopSettings = Field(default_factory=_EventLoopSettings)
+    usage: _UsageSettings = Field(default_factory=_UsageSettings)
+    health: _HealthSettings = Field(default_factory=_HealthSettings)
     
-    # Constructed properties
-    chat_history: Optional[_ChatHistorySettings] = None
-    datasource: Optional[DatasourcePayloadConstructor] = None
-    promptflow: Optional[_PromptflowSettings] = None
-
-    @model_validator(mode="after")
-    def set_foundry_settings(self) -> Self:
+    # Constructed properties, built on first use so a deployment only
+    # validates the integrations it actually calls
+    @cached_property
+    def foundry(self) -> Optional[_FoundrySettings]:
         try:
-            self.foundry = _FoundrySettings()
+            return _FoundrySettings()
             
         except ValidationError:
-            self.foundry = None
-            
-        return self
+            return None
     
-    @model_validator(mode="after")
-    def set_promptflow_settings(self) -> Self:
+    @cached_property
+    def promptflow(self) -> Optional[_PromptflowSettings]:
         try:
-            self.promptflow = _PromptflowSettings()
+            return _PromptflowSettings()
             
         except ValidationError:
-            self.promptflow = None
-            
-        return self
+            return None
     
-    @model_validator(mode="after")
-    def set_chat_history_settings(self) -> Self:
+    @cached_property
+    def chat_history(self) -> Optional[_ChatHistorySettings]:
         try:
-            self.chat_history = _ChatHistorySettings()
+            return _ChatHistorySettings()
         
         except ValidationError:
-            self.chat_history = None
-        
-        return self
+            return None
     
-    @model_validator(mode="after")
-    def set_datasource_settings(self) -> Self:
+    @cached_property
+    def datasource(self) -> Optional[DatasourcePayloadConstructor]:
         try:
             if self.base_settings.datasource_type == "AzureCognitiveSearch":
-                self.datasource = _AzureSearchSettings(settings=self, _env_file=DOTENV_PATH)
                 logging.debug("Using Azure Cognitive Search")
+                return _AzureSearchSettings(settings=self)
             
             elif self.base_settings.datasource_type == "AzureCosmosDB":
-                self.datasource = _AzureCosmosDbMongoVcoreSettings(settings=self, _env_file=DOTENV_PATH)
                 logging.debug("Using Azure CosmosDB Mongo vcore")
+                return _AzureCosmosDbMongoVcoreSettings(settings=self)
             
             elif self.base_settings.datasource_type == "Elasticsearch":
-                self.datasource = _ElasticsearchSettings(settings=self, _env_file=DOTENV_PATH)
                 logging.debug("Using Elasticsearch")
+                return _ElasticsearchSettings(settings=self)
             
             elif self.base_settings.datasource_type == "Pinecone":
-                self.datasource = _PineconeSettings(settings=self, _env_file=DOTENV_PATH)
                 logging.debug("Using Pinecone")
+                return _PineconeSettings(settings=self)
             
             elif self.base_settings.datasource_type == "AzureMLIndex":
-                self.datasource = _AzureMLIndexSettings(settings=self, _env_file=DOTENV_PATH)
                 logging.debug("Using Azure ML Index")
+                return _AzureMLIndexSettings(settings=self)
             
             elif self.base_settings.datasource_type == "AzureSqlServer":
-                self.datasource = _AzureSqlServerSettings(settings=self, _env_file=DOTENV_PATH)
                 logging.debug("Using SQL Server")
+                return _AzureSqlServerSettings(settings=self)
             
             elif self.base_settings.datasource_type == "MongoDB":
-                self.datasource = _MongoDbSettings(settings=self, _env_file=DOTENV_PATH)
                 logging.debug("Using Mongo DB")
+                return _MongoDbSettings(settings=self)
                 
             else:
-                self.datasource = None
                 logging.warning("No datasource configuration found in the environment -- calls will be made to Azure OpenAI without grounding data.")
-                
-            return self
+                return None
 
         except ValidationError as e:
             logging.warning("No datasource configuration found in the environment -- calls will be made to Azure OpenAI without grounding data.")
             logging.warning(e.errors())
+            return None
 
 
 app_settings = _AppSettings()
@@ -0,0 +1,288 @@
+"""Serving the frontend build: precompressed, cached and revalidated.
+
+`StaticFilesMiddleware` answers GET and HEAD for `/`, `/favicon.ico` and
+`/assets/...` before the request reaches Quart. For each file it picks the
+best precompressed variant the client accepts (`.br`, then `.gz`, written
+next to the file at image build time), sends a strong ETag and answers
+`If-None-Match` with 304. Vite's content-hashed asset names are cached by
+browsers as `immutable` for a year; everything else, including `/`, is
+revalidated on each use. Small files and `/` are kept in memory; larger
+ones are read from disk, or handed to the server with the
+`http.response.pathsend` ASGI extension when the server supports it, so it
+can use sendfile. Paths it cannot find fall through to the app.
+
+`/` is the index.html template, rendered once with the UI settings.
+
+Write the compressed variants after building the frontend with:
+
+    python -m backend.static_assets static
+"""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+## vite names build output <name>-<8 character content hash>.<ext>
+HASHED_NAME = re.compile(r"-[0-9A-Za-z_-]{8}\.[0-9A-Za-z]+$")
+COMPRESSIBLE_EXTENSIONS = {".js", ".mjs", ".css", ".html", ".svg", ".json", ".map", ".txt", ".ico", ".webmanifest"}
+## preferred first
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+MEMORY_CACHE_MAX_BYTES = 128 * 1024
+MIN_COMPRESS_BYTES = 1024
+CHUNK_BYTES = 256 * 1024
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=11)
+    ## mtime=0 keeps the output identical across builds
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+
+def precompress(directory: str, min_size: int = MIN_COMPRESS_BYTES) -> int:
+    """Write .br (with the brotli package) and .gz variants of the compressible files under `directory`."""
+    encodings = [(encoding, suffix) for encoding, suffix in ENCODINGS if encoding != "br" or brotli]
+    if brotli is None:
+        logging.warning("brotli is not installed, writing gzip variants only")
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.splitext(name)[1] not in COMPRESSIBLE_EXTENSIONS or os.path.getsize(path) < min_size:
+                continue
+            with open(path, "rb") as f:
+                body = f.read()
+            for encoding, suffix in encodings:
+                compressed = _compress(body, encoding)
+                if len(compressed) >= len(body):
+                    continue
+                with open(path + suffix, "wb") as f:
+                    f.write(compressed)
+                written += 1
+    return written
+
+
+@dataclass
+class _Variant():
+    path: Optional[str]
+    size: int
+    etag: str
+    encoding: Optional[str] = None
+    body: Optional[bytes] = None
+
+
+@dataclass
+class _Asset():
+    content_type: str
+    cache_control: str
+    ## keyed by content encoding, None for the uncompressed file
+    variants: Dict[Optional[str], _Variant] = field(default_factory=dict)
+    ## (mtime_ns, size) of the uncompressed file, to notice a rebuild
+    stat: Optional[tuple] = None
+
+
+def _content_type(name: str) -> str:
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    if content_type.startswith("text/") or content_type in ("application/javascript", "image/svg+xml"):
+        content_type += "; charset=utf-8"
+    return content_type
+
+
+def _etag(digest: str, encoding: Optional[str]) -> str:
+    return f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+
+
+def accepted_encodings(header: str) -> Dict[str, float]:
+    accepted = {}
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = quality
+    return accepted
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    ## weak comparison, as If-None-Match requires
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in header.split(","))
+
+
+class StaticAssets():
+    def __init__(self, directory: str, memory_cache_max_bytes: int = MEMORY_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.memory_cache_max_bytes = memory_cache_max_bytes
+        self._assets: Dict[str, _Asset] = {}
+
+    def add_rendered(self, url_path: str, template: str, **context) -> bool:
+        """Render a template from the directory once and serve it from memory at `url_path`."""
+        from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+        if not os.path.isfile(os.path.join(self.directory, template)):
+            return False
+        environment = Environment(loader=FileSystemLoader(self.directory), autoescape=select_autoescape())
+        body = environment.get_template(template).render(**context).encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        asset = _Asset(content_type=_content_type(template), cache_control=REVALIDATE_CACHE_CONTROL)
+        asset.variants[None] = _Variant(path=None, size=len(body), etag=_etag(digest, None), body=body)
+        for encoding, _ in ENCODINGS:
+            if encoding == "br" and brotli is None:
+                continue
+            compressed = _compress(body, encoding)
+            asset.variants[encoding] = _Variant(
+                path=None, size=len(compressed), etag=_etag(digest, encoding), encoding=encoding, body=compressed
+            )
+        self._assets[url_path] = asset
+        return True
+
+    def _load(self, path: str, stat) -> _Asset:
+        name = os.path.basename(path)
+        asset = _Asset(
+            content_type=_content_type(name),
+            cache_control=IMMUTABLE_CACHE_CONTROL if HASHED_NAME.search(name) else REVALIDATE_CACHE_CONTROL,
+            stat=(stat.st_mtime_ns, stat.st_size),
+        )
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+                digest.update(chunk)
+        digest = digest.hexdigest()[:20]
+        candidates = [(None, path, stat)]
+        for encoding, suffix in ENCODINGS:
+            try:
+                variant_stat = os.stat(path + suffix)
+            except OSError:
+                continue
+            ## a variant older than its file is left over from a previous build
+            if variant_stat.st_mtime_ns >= stat.st_mtime_ns:
+                candidates.append((encoding, path + suffix, variant_stat))
+        for encoding, variant_path, variant_stat in candidates:
+            variant = _Variant(
+                path=variant_path, size=variant_stat.st_size, etag=_etag(digest, encoding), encoding=encoding
+            )
+            if variant.size <= self.memory_cache_max_bytes:
+                with open(variant_path, "rb") as f:
+                    variant.body = f.read()
+            asset.variants[encoding] = variant
+        return asset
+
+    def lookup(self, url_path: str, file_path: Optional[str] = None, subdirectory: str = "") -> Optional[_Asset]:
+        """The asset rendered at `url_path`, or served there from `file_path`, which must not leave `subdirectory`."""
+        asset = self._assets.get(url_path)
+        if asset is not None and asset.stat is None:
+            return asset
+        if file_path is None:
+            return None
+        path = safe_join(self.directory, subdirectory, file_path)
+        try:
+            stat = os.stat(path) if path else None
+        except OSError:
+            stat = None
+        if stat is None or not os.path.isfile(path):
+            self._assets.pop(url_path, None)
+            return None
+        if asset is None or asset.stat != (stat.st_mtime_ns, stat.st_size):
+            asset = self._assets[url_path] = self._load(path, stat)
+        return asset
+
+
+class StaticFilesMiddleware():
+    def __init__(self, app, assets: StaticAssets, prefix: str = "/assets/", files: Optional[Dict[str, str]] = None):
+        self.app = app
+        self.assets = assets
+        self.prefix = prefix
+        ## exact url paths and the files that serve them
+        self.files = files or {}
+
+    def _resolve(self, path: str) -> Optional[_Asset]:
+        if path.startswith(self.prefix):
+            return self.assets.lookup(path, path[len(self.prefix):], subdirectory=self.prefix.strip("/"))
+        return self.assets.lookup(path, self.files.get(path))
+
+    async def __call__(self, scope, receive, send):
+        asset = None
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            asset = self._resolve(scope["path"])
+        if asset is None:
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = {}
+        for name, value in scope["headers"]:
+            if name in (b"accept-encoding", b"if-none-match"):
+                request_headers[name] = value.decode("latin-1")
+
+        variant = asset.variants[None]
+        accepted = accepted_encodings(request_headers.get(b"accept-encoding", ""))
+        for encoding, _ in ENCODINGS:
+            if encoding in asset.variants and accepted.get(encoding, 0) > 0:
+                variant = asset.variants[encoding]
+                break
+
+        headers = [
+            (b"etag", variant.etag.encode()),
+            (b"cache-control", asset.cache_control.encode()),
+        ]
+        if len(asset.variants) > 1:
+            headers.append((b"vary", b"Accept-Encoding"))
+
+        if etag_matches(request_headers.get(b"if-none-match", ""), variant.etag):
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        headers += [
+            (b"content-type", asset.content_type.encode()),
+            (b"content-length", str(variant.size).encode()),
+        ]
+        if variant.encoding:
+            headers.append((b"content-encoding", variant.encoding.encode()))
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+
+        if scope["method"] == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+        elif variant.body is not None:
+            await send({"type": "http.response.body", "body": variant.body})
+        elif "http.response.pathsend" in scope.get("extensions", {}):
+            await send({"type": "http.response.pathsend", "path": variant.path})
+        else:
+            await self._send_file(variant.path, send)
+
+    async def _send_file(self, path, send):
+        import aiofiles
+
+        async with aiofiles.open(path, "rb") as f:
+            while True:
+                chunk = await f.read(CHUNK_BYTES)
+                more_body = len(chunk) == CHUNK_BYTES
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+                if not more_body:
+                    break
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit("usage: python -m backend.static_assets <directory>")
+    logging.basicConfig(level=logging.INFO)
+    print(f"wrote {precompress(sys.argv[1])} compressed files")
@@ -0,0 +1,82 @@
+"""Request-scoped stage timings, reported as a Server-Timing header.
+
+A `RequestTimings` is created per request and made current with
+`bind_timings`; code anywhere below the request handler adds to it with
+`timed(stage)`, which is a no-op outside of a request. Nested use of the same
+stage, as in the recursive Graph group lookup, is only counted once.
+
+Streamed responses send their headers before the stream is produced, so a
+client that sends `X-Server-Timing-Trailer: true` also gets the full
+breakdown, with time to first token and token counts, as a final frame.
+"""
+import contextlib
+import contextvars
+import time
+from typing import Optional
+
+SERVER_TIMING_TRAILER_HEADER = "X-Server-Timing-Trailer"
+
+STAGE_DESCRIPTIONS = {
+    "auth": "Authentication",
+    "groups": "Graph group lookup",
+    "payload": "Payload build",
+    "upstream": "Model backend",
+    "functions": "Function calls",
+    "history": "Chat history",
+}
+
+_current_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+class RequestTimings():
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.durations = {}
+        self._active = set()
+
+    @contextlib.contextmanager
+    def measure(self, stage: str):
+        if stage in self._active:
+            yield
+            return
+        self._active.add(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._active.discard(stage)
+            self.durations[stage] = self.durations.get(stage, 0.0) + time.perf_counter() - start
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def as_dict(self) -> dict:
+        """Stage durations and the total so far, in milliseconds."""
+        timings = {stage: round(seconds * 1000, 2) for stage, seconds in self.durations.items()}
+        timings["total"] = round(self.elapsed() * 1000, 2)
+        return timings
+
+    def server_timing_header(self) -> str:
+        return ", ".join(
+            f'{stage};dur={duration}' + (f';desc="{STAGE_DESCRIPTIONS[stage]}"' if stage in STAGE_DESCRIPTIONS else "")
+            for stage, duration in self.as_dict().items()
+        )
+
+
+def bind_timings(timings: RequestTimings):
+    return _current_timings.set(timings)
+
+
+def current_timings() -> Optional[RequestTimings]:
+    return _current_timings.get()
+
+
+@contextlib.contextmanager
+def timed(stage: str):
+    """Add the duration of the block to the current request's `stage`; usable as a decorator on sync functions."""
+    timings = _current_timings.get()
+    if timings is None:
+        yield
+        return
+    with timings.measure(stage):
+        yield
@@ -0,0 +1,78 @@
+"""OpenTelemetry tracing for the chat pipeline.
+
+Spans are created through the module level `tracer`, which is a no-op until
+`configure_tracing` installs a tracer provider, so instrumented code pays
+almost nothing when tracing is disabled. The SDK and the propagators are
+only imported once tracing is configured or a span is recording, which keeps
+them out of the app's import time.
+"""
+import json
+import logging
+import sys
+
+from opentelemetry import trace
+
+tracer = trace.get_tracer("sample-app-aoai-chatgpt")
+
+
+def _create_exporter(settings):
+    from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+
+    if settings.exporter == "console":
+        return ConsoleSpanExporter(out=sys.stdout)
+
+    if settings.exporter == "file":
+        ## one JSON span per line, so the file can be loaded with pandas or jq
+        return ConsoleSpanExporter(
+            out=open(settings.file_path, "a", encoding="utf-8"),
+            formatter=lambda span: json.dumps(json.loads(span.to_json())) + "\n"
+        )
+
+    if settings.exporter == "otlp":
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError as e:
+            raise ValueError(
+                "TRACING_EXPORTER=otlp requires the opentelemetry-exporter-otlp-proto-http package"
+            ) from e
+        ## endpoint and headers come from the standard OTEL_EXPORTER_OTLP_* variables
+        return OTLPSpanExporter()
+
+    raise ValueError(f"Unsupported tracing exporter: {settings.exporter}")
+
+
+def configure_tracing(settings):
+    """Install a tracer provider for the current process, or return None if tracing is disabled."""
+    if not settings or not settings.enabled:
+        return None
+
+    from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+    provider = TracerProvider(
+        resource=Resource.create({SERVICE_NAME: settings.service_name}),
+        sampler=ParentBased(TraceIdRatioBased(settings.sample_ratio))
+    )
+    provider.add_span_processor(BatchSpanProcessor(_create_exporter(settings)))
+    trace.set_tracer_provider(provider)
+    logging.debug(f"Tracing enabled with the {settings.exporter} exporter")
+    return provider
+
+
+def inject_trace_headers(headers=None, span=None) -> dict:
+    """Add W3C traceparent/tracestate headers for `span` (default: the current span) to `headers`."""
+    headers = {} if headers is None else headers
+    if not (span or trace.get_current_span()).get_span_context().is_valid:
+        ## nothing to propagate, e.g. tracing is disabled
+        return headers
+
+    from opentelemetry import propagate
+    propagate.inject(headers, context=trace.set_span_in_context(span) if span else None)
+    return headers
+
+
+def current_trace_id() -> str:
+    span_context = trace.get_current_span().get_span_context()
+    return format(span_context.trace_id, "032x") if span_context.is_valid else ""
@@ -0,0 +1,184 @@
+"""Per-user token usage accounting and budgets.
+
+`UsageTracker` keeps each user's prompt and completion tokens in hourly
+buckets in process memory, so budget checks on the request path never leave
+the process. Daily and monthly budgets apply to sliding windows of the last
+24 hours and the last 30 days, to the hour. Recorded usage is also queued
+per user and UTC day and periodically added to the chat history store by
+`run`, which is what the admin endpoint reports across workers and restarts.
+
+The first time a worker sees a user, it seeds that user's window from the
+store. After that each worker only counts the usage it served itself, so
+with several workers a user can go over budget by up to what the other
+workers served since the seed.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from backend.metrics import metrics
+
+BUCKET_SECONDS = 3600
+WINDOWS = {
+    "daily": 24 * 3600,
+    "monthly": 30 * 24 * 3600,
+}
+
+USAGE_TOKENS = metrics.counter(
+    "chat_usage_tokens_total",
+    "Model tokens used by chat requests",
+    ("kind",)
+)
+BUDGET_REJECTIONS = metrics.counter(
+    "chat_budget_rejections_total",
+    "Chat requests rejected because the user exceeded a token budget",
+    ("window",)
+)
+
+
+def usage_day(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d")
+
+
+def usage_from_response(usage) -> Optional[tuple]:
+    """(prompt_tokens, completion_tokens) from an OpenAI usage object or a
+    Responses API style usage dict, or None if there is no usage."""
+    if not usage:
+        return None
+    if isinstance(usage, dict):
+        prompt_tokens = usage.get("prompt_tokens", usage.get("input_tokens"))
+        completion_tokens = usage.get("completion_tokens", usage.get("output_tokens"))
+    else:
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+    if prompt_tokens is None and completion_tokens is None:
+        return None
+    return prompt_tokens or 0, completion_tokens or 0
+
+
+def _add(counters: dict, key, prompt_tokens: int, completion_tokens: int, requests: int):
+    counter = counters.get(key)
+    if counter is None:
+        counters[key] = [prompt_tokens, completion_tokens, requests]
+    else:
+        counter[0] += prompt_tokens
+        counter[1] += completion_tokens
+        counter[2] += requests
+
+
+class UsageTracker():
+    def __init__(self, daily_budget: int = None, monthly_budget: int = None):
+        self.budgets = {"daily": daily_budget, "monthly": monthly_budget}
+        ## user id -> {hour: [prompt_tokens, completion_tokens, requests]}
+        self.windows = {}
+        ## (user id, day) -> [prompt_tokens, completion_tokens, requests] not yet in the store
+        self.pending = {}
+        ## user id -> task seeding the user's window from the store
+        self._seeds = {}
+        ## (user id, day) -> [prompt_tokens, completion_tokens, requests] this worker added to the
+        ## store before seeding the user, which are in the window already and not added again by the seed
+        self._flushed = {}
+
+    def record(self, user_id: str, prompt_tokens: int, completion_tokens: int, now: float = None):
+        now = time.time() if now is None else now
+        USAGE_TOKENS.inc(prompt_tokens, kind="prompt")
+        USAGE_TOKENS.inc(completion_tokens, kind="completion")
+        _add(self.windows.setdefault(user_id, {}), int(now // BUCKET_SECONDS), prompt_tokens, completion_tokens, 1)
+        _add(self.pending, (user_id, usage_day(now)), prompt_tokens, completion_tokens, 1)
+
+    def usage(self, user_id: str, window: str, now: float = None) -> dict:
+        now = time.time() if now is None else now
+        first_bucket = int((now - WINDOWS[window]) // BUCKET_SECONDS) + 1
+        prompt_tokens = completion_tokens = requests = 0
+        for bucket, counter in self.windows.get(user_id, {}).items():
+            if bucket >= first_bucket:
+                prompt_tokens += counter[0]
+                completion_tokens += counter[1]
+                requests += counter[2]
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "requests": requests,
+        }
+
+    def exceeded_budget(self, user_id: str, now: float = None) -> Optional[str]:
+        """The first window whose budget the user has used up, or None."""
+        for window, budget in self.budgets.items():
+            if budget is not None and self.usage(user_id, window, now)["total_tokens"] >= budget:
+                BUDGET_REJECTIONS.inc(window=window)
+                return window
+        return None
+
+    async def seed(self, user_id: str, store):
+        """Add the user's persisted usage to their window, once per process."""
+        if store is None:
+            return
+        task = self._seeds.get(user_id)
+        if task is None:
+            task = self._seeds[user_id] = asyncio.ensure_future(self._seed(user_id, store))
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            ## budgets fall back to this worker's own counts; try again next request
+            self._seeds.pop(user_id, None)
+            logging.exception(f"Failed to load token usage for user {user_id}")
+
+    async def _seed(self, user_id, store):
+        since = time.time() - WINDOWS["monthly"]
+        documents = await store.get_usage(user_id=user_id, since_day=usage_day(since))
+        window = self.windows.setdefault(user_id, {})
+        for document in documents:
+            flushed = self._flushed.pop((user_id, document["day"]), (0, 0, 0))
+            ## persisted usage is per day, so it is counted from the start of its day
+            day_start = datetime.strptime(document["day"], "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+            _add(
+                window,
+                int(day_start // BUCKET_SECONDS),
+                document["prompt_tokens"] - flushed[0],
+                document["completion_tokens"] - flushed[1],
+                document["requests"] - flushed[2]
+            )
+        for key in [key for key in self._flushed if key[0] == user_id]:
+            del self._flushed[key]
+
+    def _prune(self, now: float):
+        first_bucket = int((now - WINDOWS["monthly"]) // BUCKET_SECONDS) + 1
+        for user_id in list(self.windows):
+            window = self.windows[user_id]
+            for bucket in [bucket for bucket in window if bucket < first_bucket]:
+                del window[bucket]
+            if not window:
+                del self.windows[user_id]
+                self._seeds.pop(user_id, None)
+        first_day = usage_day(now - WINDOWS["monthly"])
+        for key in [key for key in self._flushed if key[1] < first_day]:
+            del self._flushed[key]
+
+    async def flush(self, store):
+        """Add the queued usage to the store. Without a store it is dropped."""
+        self._prune(time.time())
+        pending, self.pending = self.pending, {}
+        if store is None:
+            return
+        for (user_id, day), (prompt_tokens, completion_tokens, requests) in pending.items():
+            seed = self._seeds.get(user_id)
+            if seed is not None and not seed.done():
+                ## the seed may or may not read this usage from the store, it waits for the next flush
+                _add(self.pending, (user_id, day), prompt_tokens, completion_tokens, requests)
+                continue
+            try:
+                await store.record_usage(user_id, day, prompt_tokens, completion_tokens, requests)
+            except Exception:
+                logging.exception(f"Failed to store token usage for user {user_id}, retrying on the next flush")
+                _add(self.pending, (user_id, day), prompt_tokens, completion_tokens, requests)
+                continue
+            if seed is None:
+                _add(self._flushed, (user_id, day), prompt_tokens, completion_tokens, requests)
+
+    async def run(self, get_store, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush(get_store())
@@ -1,10 +1,13 @@
 import os
 import json
 import logging
-import requests
 import dataclasses
 
 from typing import List
+from quart import has_request_context, request
+
+from backend.timing import timed
+from backend.tracing import tracer
 
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
@@ -31,6 +34,32 @@ async def format_as_ndjson(r):
         yield json.dumps({"error": str(error)})
 
 
+async def parse_ndjson(chunks):
+    # Incrementally decode an NDJSON byte stream, holding at most one partial line.
+    # Only the new chunk is split; the pieces of a line spanning chunks are joined once its newline arrives
+    partial = []
+    async for chunk in chunks:
+        *lines, rest = chunk.split(b"\n")
+        if lines:
+            lines[0] = b"".join(partial + [lines[0]])
+            partial = []
+        if rest:
+            partial.append(rest)
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    buffer = b"".join(partial)
+    if buffer.strip():
+        yield json.loads(buffer)
+
+
+def current_route() -> str:
+    # Route template (e.g. /history/read) of the request being served, used as a metrics label
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return "none"
+
+
 def parse_multi_columns(columns: str) -> list:
     if "|" in columns:
         return columns.split("|")
@@ -38,6 +67,8 @@ def parse_multi_columns(columns: str) -> list:
         return columns.split(",")
 
 
+@tracer.start_as_current_span("fetchUserGroups")
+@timed("groups")
 def fetchUserGroups(userToken, nextLink=None):
     # Recursively fetch group membership
     if nextLink:
@@ -47,6 +78,7 @@ def fetchUserGroups(userToken, nextLink=None):
 
     headers = {"Authorization": "bearer " + userToken}
     try:
+        import requests
         r = requests.get(endpoint, headers=headers)
         if r.status_code != 200:
             logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
@@ -0,0 +1,71 @@
+"""Compare the token offset text splitter with the recursive splitter it replaced.
+
+Extracts the text of data/employee_handbook.pdf, repeats it to make larger
+documents, and times what chunk_content_helper does for a text document:
+counting the document's tokens, splitting it, and counting each chunk's
+tokens. The recursive character splitter encodes every candidate split and
+the chunks again; the token offset splitter encodes the document once.
+
+    python benchmarks/chunking_benchmark.py
+    python benchmarks/chunking_benchmark.py --copies 1,10,50 --chunk-size 1024 --overlap 128 --repeat 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+
+import fitz
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from data_utils import SENTENCE_ENDINGS, TOKEN_ESTIMATOR, WORDS_BREAKS, TokenOffsetTextSplitter
+
+
+def recursive_split(text, chunk_size, overlap):
+    TOKEN_ESTIMATOR.estimate_tokens(text)
+    splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        separators=SENTENCE_ENDINGS + WORDS_BREAKS, chunk_size=chunk_size, chunk_overlap=overlap)
+    return [(chunk, TOKEN_ESTIMATOR.estimate_tokens(chunk)) for chunk in splitter.split_text(text)]
+
+
+def token_offset_split(text, chunk_size, overlap):
+    tokens = TOKEN_ESTIMATOR.encode(text)
+    splitter = TokenOffsetTextSplitter(separators=SENTENCE_ENDINGS + WORDS_BREAKS, chunk_size=chunk_size, chunk_overlap=overlap)
+    return splitter.split_text_with_token_counts(text, tokens)
+
+
+def timed(split, text, chunk_size, overlap, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = split(text, chunk_size, overlap)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples), chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--pdf", default=os.path.join(ROOT, "data", "employee_handbook.pdf"))
+    parser.add_argument("--copies", default="1,10,50", help="Comma separated document sizes, in copies of the handbook text.")
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--overlap", type=int, default=128)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with fitz.open(args.pdf) as pdf:
+        handbook = "".join(page.get_text() for page in pdf)
+
+    print(f"{'copies':>6} {'chars':>10} {'recursive s':>12} {'offsets s':>10} {'speedup':>8} {'chunks':>13}")
+    for copies in [int(copies) for copies in args.copies.split(",")]:
+        text = handbook * copies
+        recursive_seconds, recursive_chunks = timed(recursive_split, text, args.chunk_size, args.overlap, args.repeat)
+        offset_seconds, offset_chunks = timed(token_offset_split, text, args.chunk_size, args.overlap, args.repeat)
+        print(f"{copies:>6} {len(text):>10} {recursive_seconds:>12.3f} {offset_seconds:>10.3f} "
+              f"{recursive_seconds / offset_seconds:>7.1f}x {len(recursive_chunks):>6}/{len(offset_chunks):<6}")
+
+
+if __name__ == "__main__":
+    main()
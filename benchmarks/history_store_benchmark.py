@@ -0,0 +1,124 @@
+"""Compare chat history backend latencies.
+
+Drives the same mix of ConversationStore operations that the /history/*
+routes issue against each selected backend and prints p50/p95/p99 latency
+per operation.
+
+    python -m benchmarks.history_store_benchmark --backends sqlite
+    python -m benchmarks.history_store_benchmark --backends sqlite,cosmosdb --users 20 --concurrency 16
+
+The cosmosdb backend reads AZURE_COSMOSDB_ACCOUNT, AZURE_COSMOSDB_DATABASE,
+AZURE_COSMOSDB_CONVERSATIONS_CONTAINER and AZURE_COSMOSDB_ACCOUNT_KEY from
+the environment and writes to the live container, so point it at a
+scratch container.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.sqlitedbservice import SqliteConversationClient
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    async def timed(self, operation, awaitable):
+        start = time.perf_counter()
+        result = await awaitable
+        self.samples[operation].append((time.perf_counter() - start) * 1000)
+        return result
+
+    def report(self, backend):
+        print(f"\n== {backend} ==")
+        print(f"{'operation':<26}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}  (ms)")
+        for operation, samples in self.samples.items():
+            print(
+                f"{operation:<26}{len(samples):>8}{statistics.fmean(samples):>10.2f}"
+                f"{percentile(samples, 50):>10.2f}{percentile(samples, 95):>10.2f}{percentile(samples, 99):>10.2f}"
+            )
+
+
+async def simulate_user(store, recorder, user_id, conversations, turns):
+    for _ in range(conversations):
+        conversation = await recorder.timed("create_conversation", store.create_conversation(user_id, title="benchmark"))
+        for turn in range(turns):
+            await recorder.timed(
+                "create_message",
+                store.create_message(str(uuid.uuid4()), conversation["id"], user_id, {"role": "user", "content": f"question {turn}"})
+            )
+            await recorder.timed(
+                "create_message",
+                store.create_message(str(uuid.uuid4()), conversation["id"], user_id, {"role": "assistant", "content": f"answer {turn}"})
+            )
+        await recorder.timed("get_conversations", store.get_conversations(user_id, limit=25, offset=0))
+        await recorder.timed("get_conversation", store.get_conversation(user_id, conversation["id"]))
+        await recorder.timed("get_messages", store.get_messages(user_id, conversation["id"]))
+
+    for conversation in await store.get_conversations(user_id, limit=None):
+        await recorder.timed("delete_messages", store.delete_messages(conversation["id"], user_id))
+        await recorder.timed("delete_conversation", store.delete_conversation(user_id, conversation["id"]))
+
+
+def build_store(backend, workdir):
+    if backend == "sqlite":
+        return SqliteConversationClient(os.path.join(workdir, "history_benchmark.db"))
+    if backend == "cosmosdb":
+        return CosmosConversationClient(
+            cosmosdb_endpoint=f"https://{os.environ['AZURE_COSMOSDB_ACCOUNT']}.documents.azure.com:443/",
+            credential=os.environ["AZURE_COSMOSDB_ACCOUNT_KEY"],
+            database_name=os.environ["AZURE_COSMOSDB_DATABASE"],
+            container_name=os.environ["AZURE_COSMOSDB_CONVERSATIONS_CONTAINER"],
+        )
+    raise ValueError(f"Unknown backend {backend}")
+
+
+async def run_backend(backend, args, workdir):
+    store = build_store(backend, workdir)
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def bounded(user_id):
+        async with semaphore:
+            await simulate_user(store, recorder, user_id, args.conversations, args.turns)
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[bounded(f"benchmark-user-{i}") for i in range(args.users)])
+    finally:
+        await store.close()
+    elapsed = time.perf_counter() - start
+
+    recorder.report(backend)
+    total = sum(len(samples) for samples in recorder.samples.values())
+    print(f"{total} operations in {elapsed:.2f}s ({total / elapsed:.0f} ops/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chat history backends.")
+    parser.add_argument("--backends", default="sqlite", help="Comma-separated list of sqlite,cosmosdb")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--conversations", type=int, default=5, help="Conversations per user")
+    parser.add_argument("--turns", type=int, default=5, help="Question/answer pairs per conversation")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for backend in args.backends.split(","):
+            asyncio.run(run_backend(backend.strip(), args, workdir))
+
+
+if __name__ == "__main__":
+    main()
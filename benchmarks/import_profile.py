@@ -0,0 +1,76 @@
+"""Where the time goes when a worker imports the app.
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter, so
+nothing is cached in sys.modules, and reports the wall time of the import
+and the modules with the largest cumulative import time.
+
+    python -m benchmarks.import_profile
+    python -m benchmarks.import_profile --top 40 --module backend.settings
+
+The app is configured with placeholder Azure OpenAI settings and an empty
+.env unless DOTENV_PATH or AZURE_OPENAI_* are set, since settings are read
+at import. Nothing is called over the network.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_env(dotenv_path=None):
+    env = dict(os.environ)
+    env.setdefault("DOTENV_PATH", dotenv_path or tempfile.NamedTemporaryFile(suffix=".env", delete=False).name)
+    env.setdefault("AZURE_OPENAI_MODEL", "gpt-4o")
+    env.setdefault("AZURE_OPENAI_ENDPOINT", "https://localhost.openai.azure.com/")
+    return env
+
+
+def cold_import(module="app", importtime=False, env=None):
+    """Import `module` in a new interpreter; returns (wall seconds, -X importtime output)."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    command = [sys.executable, *(["-X", "importtime"] if importtime else []), "-c", f"import {module}"]
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=root, env=env or import_env(), capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{completed.stderr}")
+    return wall, completed.stderr
+
+
+def parse_importtime(output):
+    """(module, self microseconds, cumulative microseconds, depth) per imported module."""
+    modules = []
+    for line in output.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--top", type=int, default=25, help="modules to list by cumulative import time")
+    parser.add_argument("--runs", type=int, default=3, help="cold imports to time, without -X importtime")
+    args = parser.parse_args()
+
+    env = import_env()
+    walls = sorted(cold_import(args.module, env=env)[0] for _ in range(args.runs))
+    _, output = cold_import(args.module, importtime=True, env=env)
+    modules = parse_importtime(output)
+
+    print(f"import {args.module}: {walls[len(walls) // 2] * 1000:.0f} ms wall (median of {args.runs}, interpreter startup included)")
+    print(f"{len(modules)} modules imported\n")
+    print(f"{'cumulative ms':>14}{'self ms':>10}  module")
+    for name, self_us, cumulative_us, depth in sorted(modules, key=lambda m: -m[2])[:args.top]:
+        print(f"{cumulative_us / 1000:>14.1f}{self_us / 1000:>10.1f}  {'  ' * depth}{name}")
+
+
+if __name__ == "__main__":
+    main()
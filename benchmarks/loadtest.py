@@ -0,0 +1,274 @@
+"""End-to-end load test of the backend against local mock services.
+
+Starts the mock Azure OpenAI server from benchmarks.mock_services and the
+app (with an in-memory chat history store) as subprocesses, then drives
+/history/generate, /history/update, /history/list and /conversation from
+`--concurrency` virtual users and reports TTFT, latency, stream frames per
+second and server CPU time per request.
+
+    python -m benchmarks.loadtest --concurrency 32 --duration 60
+    python -m benchmarks.loadtest --concurrency 64 --ttft-ms 800 --tokens-per-second 40 --throttle-rate 0.05 --datasource
+
+Nothing here talks to Azure: the app is configured with a dummy key, an
+endpoint pointing at the mock and, with --datasource, dummy Azure AI Search
+settings whose requests the mock answers with citations.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+
+import httpx
+
+from benchmarks.history_store_benchmark import percentile
+
+MODEL = "gpt-4o-loadtest"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def create_loadtest_app(aoai_endpoint=None, cosmos_latency_ms=None, datasource=None, dotenv=None):
+    """The app configured against the mock services, with an in-memory chat
+    history store. Arguments default to LOADTEST_* environment variables, so
+    ASGI servers can load it as the factory benchmarks.loadtest:create_loadtest_app.
+    Must run before app is imported, since settings are read at import."""
+    aoai_endpoint = aoai_endpoint or os.environ["LOADTEST_AOAI_ENDPOINT"]
+    cosmos_latency_ms = float(os.environ.get("LOADTEST_COSMOS_LATENCY_MS", 5.0) if cosmos_latency_ms is None else cosmos_latency_ms)
+    datasource = os.environ.get("LOADTEST_DATASOURCE") == "true" if datasource is None else datasource
+    dotenv = dotenv or os.environ.get("LOADTEST_DOTENV")
+
+    os.environ["DOTENV_PATH"] = dotenv or tempfile.NamedTemporaryFile(suffix=".env", delete=False).name
+    os.environ.update({
+        "AZURE_OPENAI_ENDPOINT": aoai_endpoint,
+        "AZURE_OPENAI_KEY": "loadtest",
+        "AZURE_OPENAI_MODEL": MODEL,
+        "AZURE_OPENAI_STREAM": "true",
+    })
+    if datasource:
+        os.environ.update({
+            "DATASOURCE_TYPE": "AzureCognitiveSearch",
+            "AZURE_SEARCH_SERVICE": "loadtest",
+            "AZURE_SEARCH_INDEX": "loadtest",
+            "AZURE_SEARCH_KEY": "loadtest",
+        })
+
+    import app as app_module
+    from quart import jsonify
+    from benchmarks.mock_services import InMemoryConversationStore
+
+    async def init_conversation_store():
+        return InMemoryConversationStore(latency_ms=cosmos_latency_ms)
+
+    app_module.init_conversation_store = init_conversation_store
+    app = app_module.create_app()
+
+    @app.route("/_loadtest/cpu")
+    async def cpu():
+        return jsonify({"cpu_seconds": time.process_time()})
+
+    return app
+
+
+def serve(args):
+    ## runs in the app subprocess
+    import uvicorn
+    app = create_loadtest_app(args.aoai_endpoint, args.cosmos_latency_ms, args.datasource, args.dotenv)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+class Results():
+    def __init__(self):
+        self.ttft = defaultdict(list)
+        self.latency = defaultdict(list)
+        self.frames = 0
+        self.requests = 0
+        self.errors = defaultdict(int)
+
+    def report(self, wall_seconds, cpu_seconds):
+        print(f"\n{self.requests} requests in {wall_seconds:.1f}s ({self.requests / wall_seconds:.1f} req/s)")
+        print(f"{'route':<20}{'metric':<10}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}  (ms)")
+        for name, table in (("ttft", self.ttft), ("latency", self.latency)):
+            for route, samples in sorted(table.items()):
+                print(
+                    f"{route:<20}{name:<10}{len(samples):>8}{statistics.fmean(samples):>10.1f}"
+                    f"{percentile(samples, 50):>10.1f}{percentile(samples, 95):>10.1f}{percentile(samples, 99):>10.1f}"
+                )
+        print(f"stream frames/s: {self.frames / wall_seconds:.1f}")
+        if cpu_seconds is not None and self.requests:
+            print(f"server CPU per request: {cpu_seconds / self.requests * 1000:.2f} ms ({cpu_seconds:.2f}s total)")
+        for key, count in sorted(self.errors.items()):
+            print(f"errors {key}: {count}")
+
+
+async def stream_chat(client, results, route, body, headers):
+    start = time.perf_counter()
+    answer = []
+    async with client.stream("POST", route, json=body, headers=headers) as response:
+        if response.status_code != 200:
+            await response.aread()
+            results.errors[f"{route} {response.status_code}"] += 1
+            return None, None
+        metadata = {}
+        async for line in response.aiter_lines():
+            if not line.strip():
+                continue
+            results.frames += 1
+            frame = json.loads(line)
+            if "error" in frame:
+                results.errors[f"{route} stream error"] += 1
+                return None, None
+            metadata = frame.get("history_metadata") or metadata
+            for message in (frame.get("choices") or [{}])[0].get("messages", []):
+                if message.get("role") == "assistant" and message.get("content"):
+                    if not answer:
+                        results.ttft[route].append((time.perf_counter() - start) * 1000)
+                    answer.append(message["content"])
+    results.latency[route].append((time.perf_counter() - start) * 1000)
+    results.requests += 1
+    return "".join(answer), metadata
+
+
+async def timed_request(client, results, method, route, **kwargs):
+    start = time.perf_counter()
+    response = await client.request(method, route, **kwargs)
+    if response.status_code != 200:
+        results.errors[f"{route} {response.status_code}"] += 1
+        return None
+    results.latency[route].append((time.perf_counter() - start) * 1000)
+    results.requests += 1
+    return response
+
+
+async def virtual_user(client, results, deadline, turns):
+    headers = {"X-Ms-Client-Principal-Id": str(uuid.uuid4()), "X-Ms-Client-Principal-Name": "loadtest"}
+    while time.perf_counter() < deadline:
+        messages = []
+        conversation_id = None
+        for turn in range(turns):
+            messages.append({"id": str(uuid.uuid4()), "role": "user", "content": f"What does the handbook say about topic {turn}?"})
+            body = {"messages": messages}
+            if conversation_id:
+                body["conversation_id"] = conversation_id
+            answer, metadata = await stream_chat(client, results, "/history/generate", body, headers)
+            if answer is None:
+                break
+            conversation_id = metadata.get("conversation_id", conversation_id)
+            messages.append({"id": str(uuid.uuid4()), "role": "assistant", "content": answer})
+            await timed_request(
+                client, results, "POST", "/history/update",
+                json={"conversation_id": conversation_id, "messages": messages}, headers=headers
+            )
+            await timed_request(client, results, "GET", "/history/list", params={"offset": 0}, headers=headers)
+            if time.perf_counter() >= deadline:
+                return
+        await stream_chat(client, results, "/conversation", {"messages": messages[-1:] if messages else []}, headers)
+
+
+async def server_cpu(client):
+    try:
+        response = await client.get("/_loadtest/cpu")
+        return response.json()["cpu_seconds"]
+    except (httpx.HTTPError, ValueError, KeyError):
+        return None
+
+
+async def wait_until_up(url, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.perf_counter() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+async def run_load(args, target):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=target, timeout=120.0, limits=limits) as client:
+        if args.warmup:
+            await asyncio.gather(*[virtual_user(client, Results(), time.perf_counter() + args.warmup, 1) for _ in range(min(4, args.concurrency))])
+        results = Results()
+        cpu_before = await server_cpu(client)
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*[virtual_user(client, results, deadline, args.turns) for _ in range(args.concurrency)])
+        wall = time.perf_counter() - start
+        cpu_after = await server_cpu(client)
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    results.report(wall, cpu)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mode", nargs="?", default="run", choices=["run", "serve"], help=argparse.SUPPRESS)
+    parser.add_argument("--target", help="drive an already running app at this URL instead of starting one")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds of unmeasured load before measuring")
+    parser.add_argument("--turns", type=int, default=3, help="user turns per conversation")
+    parser.add_argument("--ttft-ms", type=float, default=400.0)
+    parser.add_argument("--tokens-per-second", type=float, default=60.0)
+    parser.add_argument("--completion-tokens", type=int, default=150)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of completions answered with 429")
+    parser.add_argument("--cosmos-latency-ms", type=float, default=5.0, help="simulated chat history round trip")
+    parser.add_argument("--datasource", action="store_true", help="configure Azure AI Search so requests carry data_sources")
+    parser.add_argument("--dotenv", help="extra settings for the app; defaults to an empty file")
+    ## internal, used by the app subprocess
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--aoai-endpoint", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode == "serve":
+        serve(args)
+        return
+
+    if args.target:
+        asyncio.run(run_load(args, args.target))
+        return
+
+    mock_port, app_port = free_port(), free_port()
+    processes = [
+        subprocess.Popen([
+            sys.executable, "-m", "benchmarks.mock_services", "--port", str(mock_port),
+            "--ttft-ms", str(args.ttft_ms), "--tokens-per-second", str(args.tokens_per_second),
+            "--completion-tokens", str(args.completion_tokens), "--throttle-rate", str(args.throttle_rate),
+        ]),
+    ]
+    app_command = [
+        sys.executable, "-m", "benchmarks.loadtest", "serve", "--port", str(app_port),
+        "--aoai-endpoint", f"http://127.0.0.1:{mock_port}", "--cosmos-latency-ms", str(args.cosmos_latency_ms),
+    ]
+    if args.datasource:
+        app_command.append("--datasource")
+    if args.dotenv:
+        app_command += ["--dotenv", args.dotenv]
+    processes.append(subprocess.Popen(app_command))
+
+    target = f"http://127.0.0.1:{app_port}"
+    try:
+        asyncio.run(wait_until_up(f"http://127.0.0.1:{mock_port}/health"))
+        asyncio.run(wait_until_up(f"{target}/frontend_settings"))
+        asyncio.run(run_load(args, target))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""Local stand-ins for the Azure services the backend talks to.
+
+- `create_mock_aoai_app` serves the Azure OpenAI chat completions API with a
+  configurable time to first token, token rate and 429 rate. When a request
+  carries `data_sources` it answers like On Your Data over Azure AI Search,
+  sending a citations context in the first chunk, so it also stands in for
+  the Search index.
+- `InMemoryConversationStore` implements ConversationStore in memory with an
+  optional per-call latency, standing in for Cosmos DB.
+
+    python -m benchmarks.mock_services --port 8089 --ttft-ms 400 --tokens-per-second 60 --throttle-rate 0.02
+"""
+import argparse
+import asyncio
+import copy
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+
+from quart import Quart, jsonify, make_response, request
+
+WORDS = (
+    "the employee handbook describes benefits leave policies and the process for "
+    "requesting time off as well as guidance on expenses travel and security"
+).split()
+
+
+@dataclass
+class MockAoaiConfig:
+    ttft_ms: float = 400.0
+    ttft_jitter_ms: float = 100.0
+    tokens_per_second: float = 60.0
+    completion_tokens: int = 150
+    throttle_rate: float = 0.0
+    retry_after_ms: int = 200
+
+
+def _chunk(completion_id, model, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def _usage(tokens):
+    return {"prompt_tokens": 100, "completion_tokens": len(tokens), "total_tokens": 100 + len(tokens)}
+
+
+def _citations_context():
+    return {
+        "citations": [
+            {
+                "content": " ".join(random.choices(WORDS, k=120)),
+                "title": f"handbook-{i}.pdf",
+                "url": f"https://contoso.blob.core.windows.net/docs/handbook-{i}.pdf",
+                "filepath": f"handbook-{i}.pdf",
+                "chunk_id": str(i),
+            }
+            for i in range(5)
+        ],
+        "intent": "[\"employee handbook benefits\"]",
+    }
+
+
+def create_mock_aoai_app(config: MockAoaiConfig) -> Quart:
+    app = Quart(__name__)
+    app.stats = {"requests": 0, "throttled": 0}
+
+    @app.route("/health")
+    async def health():
+        return jsonify(app.stats)
+
+    @app.route("/openai/deployments/<deployment>/chat/completions", methods=["POST"])
+    async def chat_completions(deployment):
+        body = await request.get_json()
+        app.stats["requests"] += 1
+        headers = {"apim-request-id": str(uuid.uuid4())}
+
+        if random.random() < config.throttle_rate:
+            app.stats["throttled"] += 1
+            headers["retry-after-ms"] = str(config.retry_after_ms)
+            headers["retry-after"] = str(max(1, config.retry_after_ms // 1000))
+            error = {"error": {"code": "429", "message": "Requests to the deployment have exceeded the rate limit."}}
+            return jsonify(error), 429, headers
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        with_citations = bool(body.get("data_sources"))
+        tokens = [random.choice(WORDS) + " " for _ in range(min(config.completion_tokens, body.get("max_tokens") or config.completion_tokens))]
+        ttft = max(0.0, random.gauss(config.ttft_ms, config.ttft_jitter_ms)) / 1000
+        interval = 1 / config.tokens_per_second if config.tokens_per_second > 0 else 0
+
+        if not body.get("stream"):
+            await asyncio.sleep(ttft + interval * len(tokens))
+            message = {"role": "assistant", "content": "".join(tokens)}
+            if with_citations:
+                message["context"] = _citations_context()
+            return jsonify({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": deployment,
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": _usage(tokens),
+            }), 200, headers
+
+        async def generate():
+            await asyncio.sleep(ttft)
+            if with_citations:
+                first = {"role": "assistant", "context": _citations_context()}
+                yield f"data: {json.dumps(_chunk(completion_id, deployment, first))}\n\n".encode()
+            for token in tokens:
+                yield f"data: {json.dumps(_chunk(completion_id, deployment, {'role': 'assistant', 'content': token}))}\n\n".encode()
+                await asyncio.sleep(interval)
+            yield f"data: {json.dumps(_chunk(completion_id, deployment, {}, 'stop'))}\n\n".encode()
+            if (body.get("stream_options") or {}).get("include_usage"):
+                usage_chunk = {**_chunk(completion_id, deployment, {}), "choices": [], "usage": _usage(tokens)}
+                yield f"data: {json.dumps(usage_chunk)}\n\n".encode()
+            yield b"data: [DONE]\n\n"
+
+        response = await make_response(generate(), 200, headers)
+        response.timeout = None
+        response.mimetype = "text/event-stream"
+        return response
+
+    return app
+
+
+class InMemoryConversationStore():
+    """ConversationStore kept in process memory, with `latency_ms` of simulated round trip per call."""
+
+    def __init__(self, latency_ms: float = 0.0, enable_message_feedback: bool = False):
+        self.latency = latency_ms / 1000
+        self.enable_message_feedback = enable_message_feedback
+        self.conversations = {}
+        self.messages = {}
+        self.usage = {}
+
+    async def _round_trip(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def ensure(self):
+        return True, "In-memory chat history initialized successfully"
+
+    async def create_conversation(self, user_id, title=''):
+        await self._round_trip()
+        now = datetime.utcnow().isoformat()
+        conversation = {
+            'id': str(uuid.uuid4()),
+            'type': 'conversation',
+            'createdAt': now,
+            'updatedAt': now,
+            'userId': user_id,
+            'title': title
+        }
+        self.conversations[(user_id, conversation['id'])] = conversation
+        return copy.deepcopy(conversation)
+
+    async def upsert_conversation(self, conversation):
+        await self._round_trip()
+        self.conversations[(conversation['userId'], conversation['id'])] = copy.deepcopy(conversation)
+        return conversation
+
+    async def delete_conversation(self, user_id, conversation_id):
+        await self._round_trip()
+        self.conversations.pop((user_id, conversation_id), None)
+        return True
+
+    async def delete_messages(self, conversation_id, user_id):
+        await self._round_trip()
+        deleted = [
+            key for key, message in self.messages.items()
+            if key[0] == user_id and message['conversationId'] == conversation_id
+        ]
+        for key in deleted:
+            del self.messages[key]
+        return deleted
+
+    async def get_conversations(self, user_id, limit, sort_order='DESC', offset=0):
+        await self._round_trip()
+        conversations = sorted(
+            (c for (owner, _), c in self.conversations.items() if owner == user_id),
+            key=lambda c: c['updatedAt'],
+            reverse=sort_order.upper() == 'DESC'
+        )
+        offset = int(offset)
+        conversations = conversations[offset:offset + limit] if limit is not None else conversations[offset:]
+        return copy.deepcopy(conversations)
+
+    async def get_conversation(self, user_id, conversation_id):
+        await self._round_trip()
+        conversation = self.conversations.get((user_id, conversation_id))
+        return copy.deepcopy(conversation) if conversation else None
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        await self._round_trip()
+        conversation = self.conversations.get((user_id, conversation_id))
+        if not conversation:
+            return "Conversation not found"
+        now = datetime.utcnow().isoformat()
+        message = {
+            'id': uuid,
+            'type': 'message',
+            'userId': user_id,
+            'createdAt': now,
+            'updatedAt': now,
+            'conversationId': conversation_id,
+            'role': input_message['role'],
+            'content': input_message['content']
+        }
+        if self.enable_message_feedback:
+            message['feedback'] = ''
+        self.messages[(user_id, uuid)] = message
+        conversation['updatedAt'] = now
+        return copy.deepcopy(message)
+
+    async def update_message_feedback(self, user_id, message_id, feedback):
+        await self._round_trip()
+        message = self.messages.get((user_id, message_id))
+        if not message:
+            return False
+        message['feedback'] = feedback
+        return copy.deepcopy(message)
+
+    async def get_messages(self, user_id, conversation_id):
+        await self._round_trip()
+        return sorted(
+            (copy.deepcopy(m) for (owner, _), m in self.messages.items() if owner == user_id and m['conversationId'] == conversation_id),
+            key=lambda m: m['createdAt']
+        )
+
+    async def export_documents(self, user_id, continuation=None, page_size=100):
+        documents = [c for (owner, _), c in self.conversations.items() if owner == user_id]
+        documents += [m for (owner, _), m in self.messages.items() if owner == user_id]
+        start = int(continuation or 0)
+        while start < len(documents):
+            await self._round_trip()
+            end = start + page_size
+            yield copy.deepcopy(documents[start:end]), str(end) if end < len(documents) else None
+            start = end
+
+    async def import_documents(self, user_id, documents, max_concurrency=8):
+        await self._round_trip()
+        for document in documents:
+            target = self.conversations if document.get('type') == 'conversation' else self.messages
+            target[(user_id, document['id'])] = copy.deepcopy(document)
+        return len(documents)
+
+    async def record_usage(self, user_id, day, prompt_tokens, completion_tokens, requests):
+        await self._round_trip()
+        usage = self.usage.setdefault((user_id, day), {
+            'id': f"usage-{day}",
+            'type': 'usage',
+            'userId': user_id,
+            'day': day,
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+            'requests': 0
+        })
+        usage['prompt_tokens'] += prompt_tokens
+        usage['completion_tokens'] += completion_tokens
+        usage['requests'] += requests
+
+    async def get_usage(self, user_id=None, since_day=None):
+        await self._round_trip()
+        return sorted(
+            (copy.deepcopy(u) for (owner, day), u in self.usage.items()
+             if (user_id is None or owner == user_id) and (since_day is None or day >= since_day)),
+            key=lambda u: u['day']
+        )
+
+    async def close(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a mock Azure OpenAI chat completions endpoint.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--ttft-ms", type=float, default=400.0)
+    parser.add_argument("--ttft-jitter-ms", type=float, default=100.0)
+    parser.add_argument("--tokens-per-second", type=float, default=60.0)
+    parser.add_argument("--completion-tokens", type=int, default=150)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after-ms", type=int, default=200)
+    args = parser.parse_args()
+
+    import uvicorn
+    config = MockAoaiConfig(
+        ttft_ms=args.ttft_ms,
+        ttft_jitter_ms=args.ttft_jitter_ms,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        throttle_rate=args.throttle_rate,
+        retry_after_ms=args.retry_after_ms,
+    )
+    uvicorn.run(create_mock_aoai_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
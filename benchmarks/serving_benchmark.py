@@ -0,0 +1,237 @@
+"""Throughput and stream concurrency per core for each way of serving the app.
+
+Every mode serves the load test app (benchmarks.loadtest.create_loadtest_app:
+mock Azure OpenAI, in-memory chat history) and is measured in three phases:
+
+- rps: GET /frontend_settings in a loop over `--connections` keep-alive connections
+- streams: `--streams` virtual users each streaming /conversation back to back
+- drain: SIGTERM to the server while `--drain-streams` streams are open,
+  counting how many still arrive complete
+
+Per core figures divide by the CPU time the server process tree used
+(utime + stime from /proc), so they are not capped by the load generator
+and the mock sharing the machine. "streams/core" is how many concurrent
+streams of this shape one fully busy core would sustain.
+
+    python -m benchmarks.serving_benchmark
+    python -m benchmarks.serving_benchmark --modes gunicorn-uvloop,gunicorn-h11 --workers 2 --streams 200
+
+Linux only, because of /proc.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+import aiohttp
+
+from benchmarks.history_store_benchmark import percentile
+from benchmarks.loadtest import free_port, wait_until_up
+
+FACTORY = "benchmarks.loadtest:create_loadtest_app"
+
+
+def _gunicorn(port, workers, *extra):
+    return [
+        sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "-w", str(workers),
+        "-b", f"127.0.0.1:{port}", "--log-level", "warning", *extra, f"{FACTORY}()",
+    ]
+
+
+def _hypercorn(port, workers, *extra):
+    return [
+        sys.executable, "-m", "hypercorn", "-w", str(workers), "-b", f"127.0.0.1:{port}",
+        "--graceful-timeout", "60", *extra, f"{FACTORY}()",
+    ]
+
+
+MODES = {
+    ## what start.cmd and a bare `uvicorn app:app` run: one process, asyncio, h11
+    "uvicorn-h11": lambda port, workers: [
+        sys.executable, "-m", "uvicorn", "--factory", FACTORY, "--port", str(port),
+        "--loop", "asyncio", "--http", "h11", "--log-level", "warning",
+    ],
+    "gunicorn-h11": lambda port, workers: _gunicorn(port, workers, "-k", "uvicorn.workers.UvicornH11Worker"),
+    ## the production configuration in gunicorn.conf.py
+    "gunicorn-uvloop": lambda port, workers: _gunicorn(port, workers),
+    "hypercorn": lambda port, workers: _hypercorn(port, workers),
+    "hypercorn-uvloop": lambda port, workers: _hypercorn(port, workers, "-k", "uvloop"),
+}
+
+
+def tree_cpu_seconds(pid):
+    children = defaultdict(list)
+    ticks = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children[int(fields[1])].append(int(entry))
+        ticks[int(entry)] = int(fields[11]) + int(fields[12])
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        total += ticks.get(current, 0)
+        stack.extend(children[current])
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+async def stream_conversation(session, url, stats):
+    body = {"messages": [{"id": "1", "role": "user", "content": "What does the handbook say about leave?"}]}
+    start = time.perf_counter()
+    tokens = 0
+    try:
+        async with session.post(f"{url}/conversation", json=body) as response:
+            if response.status != 200:
+                stats["errors"] += 1
+                return 0
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                frame = json.loads(line)
+                messages = (frame.get("choices") or [{}])[0].get("messages", [])
+                if any(m.get("role") == "assistant" and m.get("content") for m in messages):
+                    if not tokens:
+                        stats["ttft"].append((time.perf_counter() - start) * 1000)
+                    tokens += 1
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        stats["errors"] += 1
+    stats["frames"] += tokens
+    return tokens
+
+
+async def measure(pid, duration, worker):
+    cpu_before = tree_cpu_seconds(pid)
+    start = time.perf_counter()
+    await worker(start + duration)
+    wall = time.perf_counter() - start
+    return wall, tree_cpu_seconds(pid) - cpu_before
+
+
+async def bench_rps(url, pid, connections, duration):
+    count = 0
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=connections)) as session:
+        async def client(deadline):
+            nonlocal count
+            while time.perf_counter() < deadline:
+                async with session.get(f"{url}/frontend_settings") as response:
+                    await response.read()
+                count += 1
+
+        async def worker(deadline):
+            await asyncio.gather(*[client(deadline) for _ in range(connections)])
+
+        wall, cpu = await measure(pid, duration, worker)
+    return {"rps": count / wall, "rps/core": count / cpu if cpu else float("nan")}
+
+
+async def bench_streams(url, pid, streams, duration):
+    stats = {"ttft": [], "frames": 0, "errors": 0}
+    completed = 0
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=streams)) as session:
+        async def user(deadline):
+            nonlocal completed
+            while time.perf_counter() < deadline:
+                if await stream_conversation(session, url, stats):
+                    completed += 1
+
+        async def worker(deadline):
+            await asyncio.gather(*[user(deadline) for _ in range(streams)])
+
+        wall, cpu = await measure(pid, duration, worker)
+    return {
+        "streams/s": completed / wall,
+        "frames/s": stats["frames"] / wall,
+        "ttft p50": percentile(stats["ttft"], 50) if stats["ttft"] else float("nan"),
+        "ttft p95": percentile(stats["ttft"], 95) if stats["ttft"] else float("nan"),
+        "streams/core": streams * wall / cpu if cpu else float("nan"),
+        "errors": stats["errors"],
+    }
+
+
+async def bench_drain(url, process, streams, expected_tokens, delay):
+    stats = {"ttft": [], "frames": 0, "errors": 0}
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=streams)) as session:
+        tasks = [asyncio.create_task(stream_conversation(session, url, stats)) for _ in range(streams)]
+        await asyncio.sleep(delay)
+        process.send_signal(signal.SIGTERM)
+        tokens = await asyncio.gather(*tasks)
+    return {"drained": f"{sum(1 for t in tokens if t == expected_tokens)}/{streams}"}
+
+
+async def run_mode(args, mode, aoai_endpoint):
+    port = free_port()
+    env = {**os.environ, "LOADTEST_AOAI_ENDPOINT": aoai_endpoint, "LOADTEST_COSMOS_LATENCY_MS": "0"}
+    process = subprocess.Popen(MODES[mode](port, args.workers), env=env)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        await wait_until_up(f"{url}/frontend_settings", timeout=60)
+        ## let every worker start and warm up
+        await bench_rps(url, process.pid, args.connections, 1.0)
+        await bench_streams(url, process.pid, min(args.streams, 8), 1.0)
+        result = {"mode": mode}
+        result.update(await bench_rps(url, process.pid, args.connections, args.duration))
+        result.update(await bench_streams(url, process.pid, args.streams, args.duration))
+        result.update(await bench_drain(url, process, args.drain_streams, args.completion_tokens, args.drain_after))
+        return result
+    finally:
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
+
+
+def report(results):
+    columns = ["mode", "rps", "rps/core", "streams/s", "frames/s", "ttft p50", "ttft p95", "streams/core", "errors", "drained"]
+    print("".join(f"{c:>16}" for c in columns))
+    for result in results:
+        print("".join(
+            f"{result[c]:>16.1f}" if isinstance(result[c], float) else f"{result[c]:>16}"
+            for c in columns
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default=",".join(MODES), help=f"comma-separated, from: {', '.join(MODES)}")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes for the multi-worker modes")
+    parser.add_argument("--connections", type=int, default=32)
+    parser.add_argument("--streams", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per measured phase")
+    parser.add_argument("--drain-streams", type=int, default=20)
+    parser.add_argument("--drain-after", type=float, default=0.5, help="seconds into the streams to send SIGTERM")
+    parser.add_argument("--ttft-ms", type=float, default=200.0)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--completion-tokens", type=int, default=50)
+    args = parser.parse_args()
+
+    mock_port = free_port()
+    mock = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.mock_services", "--port", str(mock_port),
+        "--ttft-ms", str(args.ttft_ms), "--ttft-jitter-ms", "0",
+        "--tokens-per-second", str(args.tokens_per_second), "--completion-tokens", str(args.completion_tokens),
+    ])
+    results = []
+    try:
+        asyncio.run(wait_until_up(f"http://127.0.0.1:{mock_port}/health"))
+        for mode in args.modes.split(","):
+            print(f"benchmarking {mode}...", file=sys.stderr)
+            results.append(asyncio.run(run_mode(args, mode, f"http://127.0.0.1:{mock_port}")))
+    finally:
+        mock.terminate()
+        mock.wait()
+    report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+## Production server settings, loaded by `gunicorn app:app` from this directory.
+## See backend/serving.py; every setting can be overridden on the command line.
+import os
+import tempfile
+
+from backend.serving import available_cpus
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = "backend.serving.UvicornWorker"
+## one event loop per core; WEB_CONCURRENCY overrides
+workers = int(os.environ.get("WEB_CONCURRENCY") or available_cpus())
+## keep idle client connections open longer than the load balancer in front does,
+## so it never reuses a connection the app has just closed
+keepalive = int(os.environ.get("SERVER_KEEP_ALIVE", "75"))
+## seconds in-flight requests and streams get to finish on SIGTERM; keep it
+## within the platform's stop timeout (WEBSITES_CONTAINER_STOP_TIME_LIMIT on App Service)
+graceful_timeout = int(os.environ.get("SERVER_GRACEFUL_TIMEOUT", "60"))
+## a worker that misses its heartbeat for this long is restarted
+timeout = int(os.environ.get("SERVER_WORKER_TIMEOUT", "120"))
+## heartbeat files on disk can stall workers in containers
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+## each worker imports the app and creates its clients itself
+preload_app = False
+
+
+def on_starting(server):
+    ## with several workers /metrics needs a shared snapshot directory to report totals
+    if server.cfg.workers > 1 and not os.environ.get("METRICS_MULTIPROC_DIR"):
+        os.environ["METRICS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="metrics-")
@@ -2,17 +2,18 @@
 import argparse
 import json
 import os
-import uuid
 
 import requests
 from data_utils import Document
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import AzureCliCredential
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
 from pymongo.mongo_client import MongoClient
 from typing import List
 
-from data_utils import chunk_directory
+from data_utils import assign_chunk_ids, chunk_directory, send_batches
 
 SUPPORTED_LANGUAGE_CODES = {
     "ar": "Arabic",
@@ -122,27 +123,47 @@ def upsert_documents_to_index(
         mongo_client: MongoClient,
         database_name: str,
         collection_name: str,
-        docs: List[Document]
+        docs: List[Document],
+        batch_size: int = 1000,
+        max_in_flight: int = 4
         ):
+    """Upserts the docs by id with unordered bulk writes of batch_size docs, several batches at a time.
+    Returns the ids of the docs that could not be upserted."""
+    mongo_collection = mongo_client[database_name][collection_name]
+    ids = []
+    operations = []
     for document in docs:
         finalDocChunk:dict = {}
-        finalDocChunk["_id"] = f"doc:{uuid.uuid4()}"
+        finalDocChunk["_id"] = f"doc:{document.id}"
         finalDocChunk['title'] = document.title
         finalDocChunk["filepath"] = document.filepath
         finalDocChunk["url"] = document.url
         finalDocChunk["content"] = document.content
         finalDocChunk["contentvector"] = document.contentVector
         finalDocChunk["metadata"] = document.metadata
-
-        mongo_collection = mongo_client[database_name][collection_name]
-
-        try:
-            mongo_collection.insert_one(finalDocChunk)
-            print(f"Upsert doc chunk {document.id} successfully")
-        
-        except Exception as e:
-            print(f"Failed to upsert doc chunk {document.id}")
-            continue
+        ids.append(finalDocChunk["_id"])
+        operations.append(ReplaceOne({"_id": finalDocChunk["_id"]}, finalDocChunk, upsert=True))
+
+    starts = range(0, len(operations), batch_size)
+    batches = [operations[start: start + batch_size] for start in starts]
+    errors = send_batches(lambda batch: mongo_collection.bulk_write(batch, ordered=False), batches, max_in_flight)
+
+    failed_ids = []
+    messages = set()
+    for position, e in errors:
+        start = starts[position]
+        if isinstance(e, BulkWriteError):
+            # the rest of an unordered batch was written
+            for write_error in e.details.get("writeErrors", []):
+                failed_ids.append(ids[start + write_error["index"]])
+                messages.add(write_error.get("errmsg"))
+        else:
+            failed_ids.extend(ids[start: start + batch_size])
+            messages.add(str(e))
+    print(f"Upserted {len(operations) - len(failed_ids)} doc chunks in {len(batches)} batches")
+    if failed_ids:
+        print(f"Failed to upsert {len(failed_ids)} doc chunks. Errors: {sorted(messages)}")
+    return failed_ids
 
 def validate_index(
         mongo_client: MongoClient,
@@ -207,9 +228,14 @@ def create_index(config, credential, form_recognizer_client=None, embedding_mode
     print(f"Files with errors: {result.num_files_with_errors} files")
     print(f"Found {len(result.chunks)} chunks")
 
+    # ids derived from the file and the content, so a rerun overwrites the chunks instead of adding copies
+    assign_chunk_ids(result.chunks, namespace=config["data_path"])
+
     # upsert documents to index
     print("Upserting documents to index...")
-    upsert_documents_to_index(mongo_client, database_name, collection_name, result.chunks)
+    failed_ids = upsert_documents_to_index(mongo_client, database_name, collection_name, result.chunks)
+    if failed_ids:
+        raise Exception(f"INDEXING FAILED for {len(failed_ids)} documents. Please recreate the index.")
 
     # check if index is ready/validate index
     print("Validating index...")
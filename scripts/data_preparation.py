@@ -4,6 +4,7 @@ import dataclasses
 import json
 import os
 import subprocess
+import tempfile
 import time
 
 import requests
@@ -12,9 +13,12 @@ from azure.core.credentials import AzureKeyCredential
 from azure.identity import AzureCliCredential
 from azure.search.documents import SearchClient
 from dotenv import load_dotenv
-from tqdm import tqdm
 
-from data_utils import chunk_directory, chunk_blob_container
+from data_utils import assign_chunk_ids, downloadBlobUrlToLocalFolder, file_chunker, get_files_recursively
+from embedding_service import EmbeddingService
+from ingestion_manifest import IngestionManifest
+from ingestion_pipeline import run_ingestion
+from search_uploader import SearchUploader, UploadStats, index_documents
 
 # Configure environment variables  
 load_dotenv() # take environment variables from .env.
@@ -277,23 +281,27 @@ def create_or_update_search_index(
     return True
 
 
-def upload_documents_to_index(service_name, subscription_id, resource_group, index_name, docs, credential=None, upload_batch_size = 50, admin_key=None):
-    if credential is None and admin_key is None:
-        raise ValueError("credential and admin_key cannot be None")
-    
-    to_upload_dicts = []
+def _raise_on_failures(stats):
+    if stats.failures:
+        raise Exception(f"INDEXING FAILED for {len(stats.failures)} documents. Please recreate the index."
+                        f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {sorted(set(stats.failures.values()))}")
+
 
-    id = 0
-    for d in docs:
+def to_search_documents(docs):
+    """Dicts of the docs for the index. Docs without an id get their position as id."""
+    to_upload_dicts = []
+    for position, d in enumerate(docs):
         if type(d) is not dict:
             d = dataclasses.asdict(d)
-        # add id to documents
-        d.update({"@search.action": "upload", "id": str(id)})
+        if not d.get("id"):
+            d["id"] = str(position)
         if "contentVector" in d and d["contentVector"] is None:
             del d["contentVector"]
         to_upload_dicts.append(d)
-        id += 1
-    
+    return to_upload_dicts
+
+
+def get_search_client(service_name, subscription_id, resource_group, index_name, admin_key=None):
     endpoint = "https://{}.search.windows.net/".format(service_name)
     if not admin_key:
         admin_key = json.loads(
@@ -304,25 +312,29 @@ def upload_documents_to_index(service_name, subscription_id, resource_group, ind
             ).stdout
         )["primaryKey"]
 
-    search_client = SearchClient(
+    return SearchClient(
         endpoint=endpoint,
         index_name=index_name,
         credential=AzureKeyCredential(admin_key),
     )
-    # Upload the documents in batches of upload_batch_size
-    for i in tqdm(range(0, len(to_upload_dicts), upload_batch_size), desc="Indexing Chunks..."):
-        batch = to_upload_dicts[i: i + upload_batch_size]
-        results = search_client.upload_documents(documents=batch)
-        num_failures = 0
-        errors = set()
-        for result in results:
-            if not result.succeeded:
-                print(f"Indexing Failed for {result.key} with ERROR: {result.error_message}")
-                num_failures += 1
-                errors.add(result.error_message)
-        if num_failures > 0:
-            raise Exception(f"INDEXING FAILED for {num_failures} documents. Please recreate the index."
-                            f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {list(errors)}")
+
+
+def delete_documents_from_index(search_client, ids, batch_size=None):
+    _raise_on_failures(index_documents(search_client, [{"id": id} for id in ids], action="delete", max_request_documents=batch_size))
+
+
+def upload_documents_to_index(service_name, subscription_id, resource_group, index_name, docs, credential=None, upload_batch_size = None, admin_key=None, delete_ids=None):
+    """Merges or uploads docs by id in concurrent requests, then deletes the documents with delete_ids.
+    Docs without an id get their position as id. Raises once all docs were tried if any could not be indexed."""
+    if credential is None and admin_key is None:
+        raise ValueError("credential and admin_key cannot be None")
+    
+    to_upload_dicts = to_search_documents(docs)
+    search_client = get_search_client(service_name, subscription_id, resource_group, index_name, admin_key)
+    # Upload the documents in requests sized by their serialized bytes, several at a time
+    _raise_on_failures(index_documents(search_client, to_upload_dicts, max_request_documents=upload_batch_size))
+    if delete_ids:
+        delete_documents_from_index(search_client, list(delete_ids), upload_batch_size)
 
 def validate_index(service_name, subscription_id, resource_group, index_name):
     api_version = "2024-03-01-Preview"
@@ -364,7 +376,10 @@ def validate_index(service_name, subscription_id, resource_group, index_name):
                 print(f"Request failed. Please investigate. Status code: {response.status_code}")
             break
 
-def create_index(config, credential, form_recognizer_client=None, embedding_model_endpoint=None, use_layout=False, njobs=4, captioning_model_endpoint=None, captioning_model_key=None):
+def create_index(config, credential, form_recognizer_client=None, embedding_model_endpoint=None, use_layout=False, njobs=4, captioning_model_endpoint=None, captioning_model_key=None, manifest_path=None):
+    """Creates or updates the index and ingests the data paths of the config.
+    With manifest_path, only files added or changed since the run that wrote the manifest are processed,
+    and chunks of changed or removed files that are no longer produced are deleted from the index."""
     service_name = config["search_service_name"]
     subscription_id = config["subscription_id"]
     resource_group = config["resource_group"]
@@ -404,36 +419,81 @@ def create_index(config, credential, form_recognizer_client=None, embedding_mode
     if "data_paths" in config:
         data_configs.extend(config["data_paths"])
 
+    manifest = IngestionManifest(manifest_path) if manifest_path else None
+    add_embeddings = bool(config.get("vector_config_name") and embedding_model_endpoint)
+    search_client = get_search_client(service_name, subscription_id, resource_group, index_name, admin_key)
+    ## document key -> error of the chunks that could not be indexed, across all data paths
+    upload_failures = {}
     for data_config in data_configs:
-        # chunk directory
-        print(f"Chunking path {data_config['path']}...")
-        add_embeddings = False
-        if config.get("vector_config_name") and embedding_model_endpoint:
-            add_embeddings = True
-
-        if "blob.core" in data_config["path"]:
-            result = chunk_blob_container(data_config["path"], credential=credential, num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
-                                azure_credential=credential, form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
-                                add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, url_prefix=data_config["url_prefix"])
-        elif os.path.exists(data_config["path"]):
-            result = chunk_directory(data_config["path"], num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
-                                    azure_credential=credential, form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
-                                    add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, url_prefix=data_config["url_prefix"],
-                                    captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key)
-        else:
-            raise Exception(f"Path {data_config['path']} does not exist and is not a blob URL. Please check the path and try again.")
-
-        if len(result.chunks) == 0:
+        source = data_config["path"]
+        with tempfile.TemporaryDirectory() as download_folder:
+            if "blob.core" in source:
+                print(f"Downloading {source} to local folder")
+                downloadBlobUrlToLocalFolder(source, download_folder, credential)
+                directory = download_folder
+            elif os.path.exists(source):
+                directory = source
+            else:
+                raise Exception(f"Path {source} does not exist and is not a blob URL. Please check the path and try again.")
+
+            files = [file_path for file_path in get_files_recursively(directory) if os.path.isfile(file_path)]
+            plan = None
+            if manifest is not None:
+                plan = manifest.plan(source, directory, files)
+                print(f"Incremental run: {len(plan.changed)} added or changed, {plan.unchanged} unchanged, {len(plan.removed)} removed files")
+                files = plan.changed
+
+            totals = {"files": 0, "unsupported": 0, "errors": 0, "chunks": 0}
+            stale_ids = []
+
+            def on_file_done(file_path, outcome):
+                result, is_error = outcome
+                totals["files"] += 1
+                if is_error or result.num_files_with_errors:
+                    totals["errors"] += 1
+                    return
+                totals["unsupported"] += result.num_unsupported_format_files
+                totals["chunks"] += len(result.chunks)
+                if manifest is not None:
+                    rel_path = os.path.relpath(file_path, directory)
+                    stale_ids.extend(manifest.record_file(source, rel_path, plan.states[rel_path], [chunk.id for chunk in result.chunks]))
+
+            uploader = SearchUploader(search_client)
+
+            async def send(docs):
+                return await uploader.index(to_search_documents(docs))
+
+            # parsing, embedding and uploading overlap, with bounded queues between them
+            print(f"Chunking, embedding and uploading {len(files)} files from {source}...")
+            process, executor = file_chunker(directory, njobs=njobs, form_recognizer_client=form_recognizer_client,
+                                             num_tokens=config["chunk_size"], token_overlap=max(0, config.get("token_overlap", 0)),
+                                             url_prefix=data_config.get("url_prefix"), use_layout=use_layout,
+                                             captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key)
+            embedding_service = EmbeddingService(embedding_model_endpoint, azure_credential=credential) if add_embeddings else None
+            with executor:
+                run_ingestion(files, process, executor, send, embedding_service=embedding_service, max_pending_files=2 * njobs,
+                              prepare=lambda result: assign_chunk_ids(result.chunks, namespace=source), on_file_done=on_file_done,
+                              upload_batch_size=uploader.max_request_documents, max_uploads_in_flight=uploader.concurrency.maximum)
+            print(uploader.stats.report(uploader.concurrency.limit))
+            upload_failures.update(uploader.stats.failures)
+
+        if totals["chunks"] == 0 and manifest is None:
             raise Exception("No chunks found. Please check the data path and chunk size.")
 
-        print(f"Processed {result.total_files} files")
-        print(f"Unsupported formats: {result.num_unsupported_format_files} files")
-        print(f"Files with errors: {result.num_files_with_errors} files")
-        print(f"Found {len(result.chunks)} chunks")
+        print(f"Processed {totals['files']} files")
+        print(f"Unsupported formats: {totals['unsupported']} files")
+        print(f"Files with errors: {totals['errors']} files")
+        print(f"Uploaded {totals['chunks']} chunks")
+
+        if manifest is not None:
+            stale_ids.extend(manifest.remove_files(source, plan.removed))
+            if stale_ids:
+                print(f"Deleting {len(stale_ids)} stale chunks...")
+                delete_documents_from_index(search_client, stale_ids)
+            manifest.save()
 
-        # upload documents to index
-        print("Uploading documents to index...")
-        upload_documents_to_index(service_name, subscription_id, resource_group, index_name, result.chunks, credential)
+    ## the manifest only records the files whose chunks were all indexed, so a rerun retries the others
+    _raise_on_failures(UploadStats(failures=upload_failures))
 
     # check if index is ready/validate index
     print("Validating index...")
@@ -459,6 +519,8 @@ if __name__ == "__main__":
     parser.add_argument("--search-admin-key", type=str, help="Admin key for the search service. If not provided, will use Azure CLI to get the key.")
     parser.add_argument("--azure-openai-endpoint", type=str, help="Endpoint for the (Azure) OpenAI API. Format: 'https://<AOAI resource name>.openai.azure.com/openai/deployments/<vision model name>/chat/completions?api-version=2024-04-01-preview'")
     parser.add_argument("--azure-openai-key", type=str, help="Key for the (Azure) OpenAI API.")
+    parser.add_argument("--incremental", action="store_true", help="Only process files added or changed since the last incremental run, and delete the chunks of removed files.")
+    parser.add_argument("--manifest-dir", type=str, default=".ingestion_manifests", help="Directory of the manifests of incremental runs, one per index. Default=.ingestion_manifests")
     args = parser.parse_args()
 
     with open(args.config) as f:
@@ -483,7 +545,8 @@ if __name__ == "__main__":
         if index_config.get("vector_config_name") and not args.embedding_model_endpoint:
             raise Exception("ERROR: Vector search is enabled in the config, but no embedding model endpoint and key were provided. Please provide these values or disable vector search.")
     
-        create_index(index_config, credential, form_recognizer_client, embedding_model_endpoint=args.embedding_model_endpoint, use_layout=args.form_rec_use_layout, njobs=args.njobs, captioning_model_endpoint=args.azure_openai_endpoint, captioning_model_key=args.azure_openai_key)
+        manifest_path = os.path.join(args.manifest_dir, f"{index_config['index_name']}.json") if args.incremental else None
+        create_index(index_config, credential, form_recognizer_client, embedding_model_endpoint=args.embedding_model_endpoint, use_layout=args.form_rec_use_layout, njobs=args.njobs, captioning_model_endpoint=args.azure_openai_endpoint, captioning_model_key=args.azure_openai_key, manifest_path=manifest_path)
         print("Data preparation for index", index_config["index_name"], "completed")
 
     print(f"Data preparation script completed. {len(config)} indexes updated.")
\ No newline at end of file
@@ -1,5 +1,6 @@
 """Data utilities for index preparation."""
 import ast
+import hashlib
 import html
 import json
 import os
@@ -8,11 +9,14 @@ import ssl
 import subprocess
 import tempfile
 import time
+import urllib.error
 import urllib.request
 from abc import ABC, abstractmethod
-from concurrent.futures import ProcessPoolExecutor
-from dataclasses import dataclass
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from functools import partial
+from itertools import accumulate
 from typing import Any, Callable, Dict, Generator, List, Optional, Tuple, Union
 from azure.ai.documentintelligence.models import AnalyzeDocumentRequest
 import fitz
@@ -28,7 +32,8 @@ from azure.identity import DefaultAzureCredential
 from azure.storage.blob import ContainerClient
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-from langchain.text_splitter import TextSplitter, MarkdownTextSplitter, RecursiveCharacterTextSplitter, PythonCodeTextSplitter
+from embedding_cache import cache_key, get_embedding_cache
+from langchain.text_splitter import TextSplitter, MarkdownTextSplitter, PythonCodeTextSplitter
 from openai import AzureOpenAI
 from tqdm import tqdm
 
@@ -58,14 +63,25 @@ SENTENCE_ENDINGS = [".", "!", "?"]
 WORDS_BREAKS = list(reversed([",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]))
 
 HTML_TABLE_TAGS = {"table_open": "<table>", "table_close": "</table>", "row_open":"<tr>"}
+TABLE_CELL_PATTERN = re.compile("<t[dh][ >]")
+
+# urls and image tags are masked before splitting so that they are never cut; image tags win over the urls inside them
+URL_PATTERN = r"(?i:\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^()\s<>]+|\(([^()\s<>]+|(\([^()\s<>]+\)))*\))+(?:\(([^()\s<>]+|(\([^()\s<>]+\)))*\)|[^()\s`!()\[\]{};:'\".,<>?«»“”‘’])))"
+IMG_PATTERN = r'<img\s+src="[^"]+"[^>]*>.*?</img>'
+MASK_PATTERN = re.compile(f"(?P<img>{IMG_PATTERN})|(?P<url>{URL_PATTERN})", re.DOTALL)
+MASK_PLACEHOLDER_PATTERN = re.compile(r"##(?:URL|IMG)\d+##")
 
 PDF_HEADERS = {
     "title": "h1",
     "sectionHeading": "h2"
 }
 
+UTF8_CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+
 class TokenEstimator(object):
     GPT2_TOKENIZER = tiktoken.get_encoding("gpt2")
+    _char_starts: Optional[List[int]] = None
+    _inside_char: Optional[List[bool]] = None
 
     def estimate_tokens(self, text: Union[str, List]) -> int:
 
@@ -77,8 +93,148 @@ class TokenEstimator(object):
         )
         return newTokens
 
+    def encode(self, text: str) -> List[int]:
+        return self.GPT2_TOKENIZER.encode(text, allowed_special="all")
+
+    def _build_char_tables(self):
+        ## number of characters that start in each token: every character has exactly one byte that is not a continuation byte
+        char_starts = []
+        inside_char = []
+        for token in range(self.GPT2_TOKENIZER.n_vocab):
+            try:
+                token_bytes = self.GPT2_TOKENIZER.decode_single_token_bytes(token)
+            except KeyError:
+                char_starts.append(0)
+                inside_char.append(False)
+                continue
+            char_starts.append(len(token_bytes.translate(None, UTF8_CONTINUATION_BYTES)))
+            inside_char.append(token_bytes[:1] in UTF8_CONTINUATION_BYTES if token_bytes else False)
+        self._char_starts, self._inside_char = char_starts, inside_char
+
+    def char_offsets(self, text: str, tokens: List[int]) -> List[int]:
+        """The position in text where each of its tokens starts, followed by len(text).
+        A token that starts inside a character starts at the next character."""
+        if self._char_starts is None:
+            self._build_char_tables()
+        return [0] + list(accumulate(map(self._char_starts.__getitem__, tokens)))
+
+    def starts_inside_char(self, tokens: List[int]) -> List[bool]:
+        """Whether each token starts inside a multibyte character, so that text cannot be split before it."""
+        if self._char_starts is None:
+            self._build_char_tables()
+        return list(map(self._inside_char.__getitem__, tokens))
+
 TOKEN_ESTIMATOR = TokenEstimator()
 
+
+class TokenOffsetTextSplitter(TextSplitter):
+    """Splits text into chunks of at most chunk_size tokens, encoding it only once.
+
+    Split points are chosen on the token array: each chunk ends at the last token boundary of
+    its second half that follows the highest priority separator, and the next chunk starts
+    chunk_overlap tokens earlier. Chunks are slices of the text, and their token counts are
+    known without encoding them again.
+    """
+
+    def __init__(self, separators: Optional[List[str]] = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        separators = separators or SENTENCE_ENDINGS + WORDS_BREAKS
+        ## lower is better
+        self._ranks = {separator: rank for rank, separator in reversed(list(enumerate(separators))) if len(separator) == 1}
+        self._sentence_endings = set(SENTENCE_ENDINGS)
+
+    def _boundary_rank(self, text: str, position: int) -> Optional[int]:
+        """Rank of the separator that a split at position would follow, or None."""
+        if position == 0:
+            return None
+        previous = text[position - 1]
+        if previous in self._ranks and (previous not in self._sentence_endings or position == len(text) or text[position].isspace()):
+            return self._ranks[previous]
+        ## tokens carry their leading whitespace, so a split before it ends the previous word
+        if position < len(text) and text[position].isspace() and text[position] in self._ranks:
+            return self._ranks[text[position]]
+        return None
+
+    def split_text_with_token_counts(self, text: str, tokens: Optional[List[int]] = None) -> List[Tuple[str, int]]:
+        """Splits text, whose tokens can be passed in if already known. Returns each chunk with its number of tokens."""
+        if tokens is None:
+            tokens = TOKEN_ESTIMATOR.encode(text)
+        offsets = TOKEN_ESTIMATOR.char_offsets(text, tokens)
+        ## chunks only start and end at tokens that start a character, so their text holds exactly their tokens
+        inside_char = TOKEN_ESTIMATOR.starts_inside_char(tokens) + [False]
+        num_tokens = len(tokens)
+        chunk_size = max(1, self._chunk_size)
+
+        def char_start(position: int, lowest: int) -> int:
+            """The last token at or before position, and after lowest, that starts a character, else the next one."""
+            candidate = position
+            while candidate > lowest and inside_char[candidate]:
+                candidate -= 1
+            if candidate > lowest:
+                return candidate
+            while inside_char[position]:
+                position += 1
+            return position
+
+        chunks = []
+        start = 0
+        while start < num_tokens:
+            end = char_start(min(start + chunk_size, num_tokens), start)
+            if end < num_tokens:
+                best_rank, best_end = None, end
+                for candidate in range(end, start + max(1, chunk_size // 2) - 1, -1):
+                    if inside_char[candidate]:
+                        continue
+                    rank = self._boundary_rank(text, offsets[candidate])
+                    if rank is not None and (best_rank is None or rank < best_rank):
+                        best_rank, best_end = rank, candidate
+                        if rank == 0:
+                            break
+                end = best_end
+            chunk_start, chunk_end = offsets[start], offsets[end]
+            first, last = start, end
+            if self._strip_whitespace:
+                chunk = text[chunk_start:chunk_end]
+                chunk_start += len(chunk) - len(chunk.lstrip())
+                chunk_end = max(chunk_start, chunk_end - (len(chunk) - len(chunk.rstrip())))
+                ## the tokens left are those that overlap what remains; the ones that start inside its last
+                ## character are placed after it by char_offsets
+                first = bisect_right(offsets, chunk_start, start, end) - 1
+                last = bisect_left(offsets, chunk_end, start, end)
+                while last < end and inside_char[last]:
+                    last += 1
+            if chunk_end > chunk_start:
+                chunks.append((text[chunk_start:chunk_end], last - first))
+            if end == num_tokens:
+                break
+            next_start = char_start(max(start + 1, end - self._chunk_overlap), start)
+            ## start the overlap at a word
+            for candidate in range(next_start, end):
+                if not inside_char[candidate] and text[offsets[candidate]].isspace():
+                    next_start = candidate
+                    break
+            start = next_start
+        return chunks
+
+    def split_text(self, text: str) -> List[str]:
+        return [chunk for chunk, _ in self.split_text_with_token_counts(text)]
+
+
+def find_table_headers(table: str) -> str:
+    """What re.search("<th.*>.*</th>", table) matches, or "", without the regex's quadratic backtracking on long lines."""
+    start = table.find("<th")
+    while start != -1:
+        line_end = table.find("\n", start)
+        if line_end == -1:
+            line_end = len(table)
+        end = table.rfind("</th>", start + 3, line_end)
+        if end != -1 and table.find(">", start + 3, end) != -1:
+            return table[start:end + len("</th>")]
+        # a later <th on the same line has no </th> after it either
+        start = table.find("<th", line_end)
+    return ""
+
+
 class PdfTextSplitter(TextSplitter):
     def __init__(self, length_function: Callable[[str], int] =TOKEN_ESTIMATOR.estimate_tokens, separator: str = "\n\n", **kwargs: Any):
         """Create a new TextSplitter for htmls from extracted pdfs."""
@@ -87,6 +243,10 @@ class PdfTextSplitter(TextSplitter):
         self._separators = separator or ["\n\n", "\n", " ", ""]
         self._length_function = length_function
         self._noise = 50 # tokens to accommodate differences in token calculation, we don't want the chunking-on-the-fly to inadvertently chunk anything due to token calc mismatch
+        # text between tables is encoded once and split on token offsets; whitespace is kept since merge_chunks_serially joins the pieces back
+        rest_chunk_size = max(1, self._chunk_size - self._noise)
+        self._rest_splitter = TokenOffsetTextSplitter(separators=self._separators, chunk_size=rest_chunk_size,
+                                                      chunk_overlap=min(self._chunk_overlap, rest_chunk_size), strip_whitespace=False)
 
     def extract_caption(self, text):
         separator = self._separators[-1]
@@ -113,48 +273,45 @@ class PdfTextSplitter(TextSplitter):
         if len(text.split(f"<{PDF_HEADERS['sectionHeading']}>"))>1:
             caption +=  text.split(f"<{PDF_HEADERS['sectionHeading']}>")[-1].split(f"</{PDF_HEADERS['sectionHeading']}>")[0]
         
-        caption += "\n"+ lines[-1].strip()
+        if lines: # the text pieces keep their whitespace, the last one before a table can be nothing else
+            caption += "\n"+ lines[-1].strip()
 
         return caption
     
     def mask_urls_and_imgs(self, text) -> Tuple[Dict[str, str], str]:
-
-        def find_urls(string):
-            regex = r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^()\s<>]+|\(([^()\s<>]+|(\([^()\s<>]+\)))*\))+(?:\(([^()\s<>]+|(\([^()\s<>]+\)))*\)|[^()\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
-            urls = re.findall(regex, string)
-            return [x[0] for x in urls]
-        
-        def find_imgs(string):
-            regex = r'(<img\s+src="[^"]+"[^>]*>.*?</img>)'
-            imgs = re.findall(regex, string, re.DOTALL)
-            return imgs
-        
+        """Replaces each url and image tag with a placeholder, in one pass over the text.
+        Returns the placeholders with what they replace, and the masked text."""
         content_dict = {}
-        masked_text = text
-        urls = set(find_urls(text))
-
-        for i, url in enumerate(urls):
-            masked_text = masked_text.replace(url, f"##URL{i}##")
-            content_dict[f"##URL{i}##"] = url
+        placeholders = {}
+        counts = {"URL": 0, "IMG": 0}
 
-        imgs = set(find_imgs(text))
-        for i, img in enumerate(imgs):
-            masked_text = masked_text.replace(img, f"##IMG{i}##")
-            content_dict[f"##IMG{i}##"] = img
+        def mask(match):
+            value = match.group()
+            kind = "IMG" if match.group("img") is not None else "URL"
+            if (kind, value) not in placeholders:
+                placeholder = f"##{kind}{counts[kind]}##"
+                counts[kind] += 1
+                placeholders[(kind, value)] = placeholder
+                content_dict[placeholder] = value
+            return placeholders[(kind, value)]
 
-        return content_dict, masked_text
+        return content_dict, MASK_PATTERN.sub(mask, text)
 
     def split_text(self, text: str) -> List[str]:
+        return [chunk for chunk, _ in self.split_text_with_token_counts(text)]
+
+    def split_text_with_token_counts(self, text: str) -> List[Tuple[str, int]]:
         content_dict, masked_text = self.mask_urls_and_imgs(text)
         start_tag = self._table_tags["table_open"]
         end_tag = self._table_tags["table_close"]
         splits = masked_text.split(start_tag)
         
-        final_chunks = self.chunk_rest(splits[0]) # the first split is before the first table tag so it is regular text
+        # text pieces keep the token counts of the splitter, tables are counted when they are merged
+        final_chunks = self.chunk_rest_with_token_counts(splits[0]) # the first split is before the first table tag so it is regular text
         
         table_caption_prefix = ""
         if len(final_chunks)>0:
-            table_caption_prefix += self.extract_caption(final_chunks[-1]) # extracted from the last chunk before the table
+            table_caption_prefix += self.extract_caption(final_chunks[-1][0]) # extracted from the last chunk before the table
         for part in splits[1:]:
             table, rest = part.split(end_tag)
             table = start_tag + table + end_tag 
@@ -162,88 +319,67 @@ class PdfTextSplitter(TextSplitter):
             final_chunks.extend(minitables)
 
             if rest.strip()!="":
-                text_minichunks = self.chunk_rest(rest)
+                text_minichunks = self.chunk_rest_with_token_counts(rest)
                 final_chunks.extend(text_minichunks)
-                table_caption_prefix = self.extract_caption(text_minichunks[-1])
+                table_caption_prefix = self.extract_caption(text_minichunks[-1][0])
             else:
                 table_caption_prefix = ""
             
 
-        final_final_chunks = [chunk for chunk, chunk_size in merge_chunks_serially(final_chunks, self._chunk_size, content_dict)]
-
-        return final_final_chunks
+        return list(merge_chunks_serially(final_chunks, self._chunk_size, content_dict))
 
 
 
     def chunk_rest(self, item):
-        separator = self._separators[-1]
-        for _s in self._separators:
-            if _s == "":
-                separator = _s
-                break
-            if _s in item:
-                separator = _s
-                break
-        chunks = []
-        if separator:
-            splits = item.split(separator)
-        else:
-            splits = list(item)
-        _good_splits = []
-        for s in splits:
-            if self._length_function(s) < self._chunk_size - self._noise:
-                _good_splits.append(s)
-            else:
-                if _good_splits:
-                    merged_text = self._merge_splits(_good_splits, separator)
-                    chunks.extend(merged_text)
-                    _good_splits = []
-                other_info = self.chunk_rest(s)
-                chunks.extend(other_info)
-        if _good_splits:
-            merged_text = self._merge_splits(_good_splits, separator)
-            chunks.extend(merged_text)
-        return chunks
+        return self._rest_splitter.split_text(item)
+
+    def chunk_rest_with_token_counts(self, item) -> List[Tuple[str, int]]:
+        return self._rest_splitter.split_text_with_token_counts(item)
         
     def chunk_table(self, table, caption):
         if self._length_function("\n".join([caption, table])) < self._chunk_size - self._noise:
             return ["\n".join([caption, table])]
         else:
-            headers = ""
-            if re.search("<th.*>.*</th>", table):
-                headers += re.search("<th.*>.*</th>", table).group() # extract the header out. Opening tag may contain rowspan/colspan
-            splits = table.split(self._table_tags["row_open"]) #split by row tag
+            row_open = self._table_tags["row_open"]
+            table_close = self._table_tags["table_close"]
+            headers = find_table_headers(table) # extract the header out. Opening tag may contain rowspan/colspan
+            splits = table.split(row_open) #split by row tag, the first split is the table opening tag
+
+            # every row is measured once, a mini-table's size is the sum of its parts
+            first_prefix = caption + "\n" + splits[0]
+            next_prefix = "\n".join([caption, self._table_tags["table_open"], headers])
+            next_prefix_size = self._length_function(next_prefix)
             tables = []
-            current_table = caption + "\n"
-            for part in splits:
-                if len(part)>0:
-                    if self._length_function(current_table + self._table_tags["row_open"] + part) < self._chunk_size: # if current table length is within permissible limit, keep adding rows
-                        if part not in [self._table_tags["table_open"], self._table_tags["table_close"]]: # need add the separator (row tag) when the part is not a table tag
-                            current_table += self._table_tags["row_open"]
-                        current_table += part
-                        
-                    else:
-                        
-                        # if current table size is beyond the permissible limit, complete this as a mini-table and add to final mini-tables list
-                        current_table += self._table_tags["table_close"]
-                        tables.append(current_table)
-
-                        # start a new table
-                        current_table = "\n".join([caption, self._table_tags["table_open"], headers])
-                        if part not in [self._table_tags["table_open"], self._table_tags["table_close"]]:
-                            current_table += self._table_tags["row_open"]
-                        current_table += part
-
-            
-            # TO DO: fix the case where the last mini table only contain tags
-            
-            if not current_table.endswith(self._table_tags["table_close"]):
-                
-                tables.append(current_table + self._table_tags["table_close"])
-            else:
-                tables.append(current_table)
+            current_table = [first_prefix]
+            current_size = self._length_function(first_prefix)
+            has_rows = False
+            for part in splits[1:]:
+                if len(part) == 0:
+                    continue
+                row = part if part.strip() == table_close else row_open + part
+                if not TABLE_CELL_PATTERN.search(part):
+                    # closing tags without cells stay with the rows before them rather than making a mini-table of their own
+                    current_table.append(row)
+                    continue
+                row_size = self._length_function(row)
+                if has_rows and current_size + row_size >= self._chunk_size:
+                    # if current table size is beyond the permissible limit, complete this as a mini-table and start a new one
+                    tables.append(self._close_table(current_table))
+                    current_table = [next_prefix]
+                    current_size = next_prefix_size
+                current_table.append(row)
+                current_size += row_size
+                has_rows = True
+
+            tables.append(self._close_table(current_table))
             return tables
 
+    def _close_table(self, parts: List[str]) -> str:
+        table = "".join(parts)
+        if not table.endswith(self._table_tags["table_close"]):
+            table += self._table_tags["table_close"]
+        return table
+
     
 @dataclass
 class Document(object):
@@ -498,6 +634,8 @@ class ChunkingResult:
         num_unsupported_format_files (int): Number of files with unsupported format.
         num_files_with_errors (int): Number of files with errors.
         skipped_chunks (int): Number of chunks skipped.
+        token_counts (List[int]): Number of tokens in each chunk, in the order of chunks.
+        failed_files (List[str]): Paths, relative to the chunked directory, of the files that could not be chunked.
     """
     chunks: List[Document]
     total_files: int
@@ -505,6 +643,26 @@ class ChunkingResult:
     num_files_with_errors: int = 0
     # some chunks might be skipped to small number of tokens
     skipped_chunks: int = 0
+    token_counts: List[int] = field(default_factory=list)
+    failed_files: List[str] = field(default_factory=list)
+
+def chunk_id(namespace: str, filepath: str, content: str, occurrence: int = 0) -> str:
+    """A stable id for a chunk, made from where it comes from and what it contains.
+    occurrence tells apart identical chunks of the same file."""
+    digest = hashlib.sha256(f"{namespace}\0{filepath}\0{occurrence}\0{content}".encode("utf-8")).hexdigest()
+    return digest[:40]
+
+
+def assign_chunk_ids(chunks: List[Document], namespace: str = "") -> List[Document]:
+    """Sets the id of each chunk from its namespace (e.g. the data path), filepath and content."""
+    occurrences: Dict[Tuple[Optional[str], str], int] = {}
+    for chunk in chunks:
+        key = (chunk.filepath, chunk.content)
+        occurrence = occurrences.get(key, 0)
+        occurrences[key] = occurrence + 1
+        chunk.id = chunk_id(namespace, chunk.filepath or "", chunk.content, occurrence)
+    return chunks
+
 
 def extractStorageDetailsFromUrl(url):
     matches = re.fullmatch(r'https:\/\/([^\/.]*)\.blob\.core\.windows\.net\/([^\/]*)\/(.*)', url)
@@ -712,18 +870,21 @@ def extract_pdf_content(file_path, form_recognizer_client, use_layout=False):
 
     return full_text, image_mapping
 
-def merge_chunks_serially(chunked_content_list: List[str], num_tokens: int, content_dict: Dict[str, str]={}) -> Generator[Tuple[str, int], None, None]:
-    def unmask_urls_and_imgs(text, content_dict={}):
-        if "##URL" in text or "##IMG" in text:
-            for key, value in content_dict.items():
-                text = text.replace(key, value)
-        return text
+def merge_chunks_serially(chunked_content_list: List[Union[str, Tuple[str, int]]], num_tokens: int, content_dict: Dict[str, str]={}) -> Generator[Tuple[str, int], None, None]:
+    """Joins consecutive pieces into chunks of up to num_tokens tokens. A piece can be given with its number of tokens,
+    which is used unless placeholders in it are unmasked; other pieces are counted here."""
+    def unmask_urls_and_imgs(text, content_dict={}) -> Tuple[str, int]:
+        if content_dict:
+            return MASK_PLACEHOLDER_PATTERN.subn(lambda match: content_dict.get(match.group(), match.group()), text)
+        return text, 0
     # TODO: solve for token overlap
     current_chunk = ""
     total_size = 0
     for chunked_content in chunked_content_list:
-        chunked_content = unmask_urls_and_imgs(chunked_content, content_dict)
-        chunk_size = TOKEN_ESTIMATOR.estimate_tokens(chunked_content)
+        chunked_content, chunk_size = chunked_content if isinstance(chunked_content, tuple) else (chunked_content, None)
+        chunked_content, unmasked = unmask_urls_and_imgs(chunked_content, content_dict)
+        if chunk_size is None or unmasked:
+            chunk_size = TOKEN_ESTIMATOR.estimate_tokens(chunked_content)
         if total_size > 0:
             new_size = total_size + chunk_size
             if new_size > num_tokens:
@@ -742,60 +903,205 @@ def get_payload_and_headers_cohere(
         "Authorization": f"Bearer {aad_token}",
     }
 
-    cohere_body = { "texts": [text], "input_type": "search_document" }
+    texts = text if isinstance(text, list) else [text]
+    cohere_body = { "texts": texts, "input_type": "search_document" }
     return cohere_body, oai_headers
-    
-def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None):
+
+
+# Per request limits of the embedding APIs; EMBEDDING_BATCH_SIZE and EMBEDDING_BATCH_MAX_TOKENS lower them
+EMBEDDING_BATCH_LIMITS = {
+    "AOAI": {"max_inputs": 2048, "max_tokens": 250000},
+    "COHERE": {"max_inputs": 96, "max_tokens": 250000},
+}
+
+
+def embedding_batch_limits() -> Tuple[int, int]:
+    limits = EMBEDDING_BATCH_LIMITS[os.getenv("FLAG_EMBEDDING_MODEL", "AOAI")]
+    max_inputs = min(int(os.getenv("EMBEDDING_BATCH_SIZE", limits["max_inputs"])), limits["max_inputs"])
+    max_tokens = min(int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", limits["max_tokens"])), limits["max_tokens"])
+    return max_inputs, max_tokens
+
+
+def batch_by_size(sizes: List[int], max_items: int, max_size: int) -> Generator[range, None, None]:
+    """Splits the items, in order, into ranges of at most max_items items whose sizes add up to at most max_size.
+    An item larger than max_size gets a range of its own."""
+    start = 0
+    batch_size = 0
+    for i, size in enumerate(sizes):
+        if i > start and (i - start >= max_items or batch_size + size > max_size):
+            yield range(start, i)
+            start = i
+            batch_size = 0
+        batch_size += size
+    if start < len(sizes):
+        yield range(start, len(sizes))
+
+
+def batch_by_tokens(token_counts: List[int], max_inputs: int, max_tokens: int) -> Generator[range, None, None]:
+    """Splits the inputs, in order, into ranges of at most max_inputs inputs and max_tokens tokens.
+    An input larger than max_tokens is sent on its own."""
+    return batch_by_size(token_counts, max_inputs, max_tokens)
+
+
+def send_batches(send: Callable[[List[Any]], Any], batches: List[List[Any]], max_in_flight: int = 4) -> List[Tuple[int, Exception]]:
+    """Calls send with each batch, max_in_flight batches at a time. Returns the position and error of the batches that failed."""
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        futures = {executor.submit(send, batch): i for i, batch in enumerate(batches)}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                errors.append((futures[future], future.exception()))
+    return sorted(errors, key=lambda error: error[0])
+
+
+def parse_aoai_endpoint(endpoint: str) -> Tuple[str, str, str]:
+    """Splits an embeddings endpoint URL into the base url, deployment and api version."""
+    endpoint_parts = endpoint.split("/openai/deployments/")
+    base_url = endpoint_parts[0]
+    deployment_id = endpoint_parts[1].split("/embeddings")[0]
+    api_version = endpoint_parts[1].split("api-version=")[1].split("&")[0]
+    return base_url, deployment_id, api_version
+
+
+def aoai_embedding_options() -> Dict[str, Any]:
+    if os.getenv("FLAG_AOAI", "V3") == "V3":
+        return {"dimensions": int(os.getenv("VECTOR_DIMENSION", 1536))}
+    return {}
+
+
+def cohere_api_key(embedding_model_key: Optional[str] = None) -> Optional[str]:
+    if embedding_model_key:
+        return embedding_model_key
+    if os.getenv("FLAG_COHERE", "ENGLISH") == "MULTILINGUAL":
+        return os.getenv("COHERE_MULTILINGUAL_API_KEY")
+    return os.getenv("COHERE_ENGLISH_API_KEY")
+
+
+def embedding_cache_keys(texts: List[str], endpoint: str) -> List[bytes]:
+    """Embedding cache keys of the texts for the model behind the endpoint."""
+    if os.getenv("FLAG_EMBEDDING_MODEL", "AOAI") == "AOAI":
+        base_url, deployment_id, _ = parse_aoai_endpoint(endpoint)
+        deployment = f"{base_url}/{deployment_id}"
+        dimensions = aoai_embedding_options().get("dimensions")
+    else:
+        deployment = endpoint
+        dimensions = None
+    return [cache_key(deployment, dimensions, text) for text in texts]
+
+
+_EMBEDDING_CLIENTS = {}
+
+
+def get_embedding_client(base_url: str, api_version: str, api_key: Optional[str] = None, azure_credential = None) -> AzureOpenAI:
+    """One AzureOpenAI client per process and endpoint. With a credential the client
+    asks for an Entra token only when the cached one is about to expire."""
+    cache_key = (base_url, api_version, api_key, id(azure_credential) if azure_credential else None)
+    client = _EMBEDDING_CLIENTS.get(cache_key)
+    if client is None:
+        if azure_credential is not None:
+            from azure.identity import get_bearer_token_provider
+            token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
+            client = AzureOpenAI(api_version=api_version, azure_endpoint=base_url, azure_ad_token_provider=token_provider,
+                                 max_retries=RETRY_COUNT)
+        else:
+            client = AzureOpenAI(api_version=api_version, azure_endpoint=base_url, api_key=api_key, max_retries=RETRY_COUNT)
+        _EMBEDDING_CLIENTS[cache_key] = client
+    return client
+
+
+def _post_cohere(endpoint: str, texts: List[str], key: str) -> List[List[float]]:
+    data, headers = get_payload_and_headers_cohere(texts, key)
+    body = str.encode(json.dumps(data))
+    for i in range(RETRY_COUNT):
+        try:
+            req = urllib.request.Request(endpoint, body, headers)
+            with urllib.request.urlopen(req) as response:
+                result_content = json.loads(response.read().decode('utf-8'))
+            return result_content["embeddings"]
+        except urllib.error.HTTPError as e:
+            if e.code not in (408, 429) and e.code < 500 or i == RETRY_COUNT - 1:
+                raise
+            retry_after = e.headers.get("retry-after")
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else 2 ** i
+            print(f"Embedding request throttled with status={e.code}, retrying in {delay}s, {RETRY_COUNT - (i + 1)} retries left")
+            time.sleep(delay)
+
+
+def get_embeddings(texts: List[str], embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None,
+                   token_counts: Optional[List[int]] = None) -> List[List[float]]:
+    """Embeds the texts with as few requests as the batch limits allow.
+    Texts found in the embedding cache are not sent.
+    Returns the embeddings in the order of the texts.
+    Args:
+        token_counts (List[int]): Token counts of the texts, if already known.
+    """
     endpoint = embedding_model_endpoint if embedding_model_endpoint else os.environ.get("EMBEDDING_MODEL_ENDPOINT")
-    
-    FLAG_EMBEDDING_MODEL = os.getenv("FLAG_EMBEDDING_MODEL", "AOAI")
-    FLAG_COHERE = os.getenv("FLAG_COHERE", "ENGLISH")
-    FLAG_AOAI = os.getenv("FLAG_AOAI", "V3")
 
-    if azure_credential is None and (endpoint is None or key is None):
+    if azure_credential is None and endpoint is None:
         raise Exception("EMBEDDING_MODEL_ENDPOINT and EMBEDDING_MODEL_KEY are required for embedding")
 
+    if not texts:
+        return []
+    cache = get_embedding_cache()
+    if cache is None:
+        return _request_embeddings(texts, endpoint, embedding_model_key, azure_credential, token_counts)
+
+    keys = embedding_cache_keys(texts, endpoint)
+    embeddings = cache.get_many(keys)
+    ## repeated texts are requested once
+    missing = {}
+    for i, embedding in enumerate(embeddings):
+        if embedding is None:
+            missing.setdefault(keys[i], i)
+    if missing:
+        first = list(missing.values())
+        new_embeddings = _request_embeddings(
+            [texts[i] for i in first], endpoint, embedding_model_key, azure_credential,
+            [token_counts[i] for i in first] if token_counts is not None else None)
+        cache.put_many(list(missing), new_embeddings)
+        by_key = dict(zip(missing, new_embeddings))
+        embeddings = [by_key[key] if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+    return embeddings
+
+
+def _request_embeddings(texts: List[str], endpoint: str, embedding_model_key=None, azure_credential=None,
+                        token_counts: Optional[List[int]] = None) -> List[List[float]]:
+    FLAG_EMBEDDING_MODEL = os.getenv("FLAG_EMBEDDING_MODEL", "AOAI")
+    if token_counts is None:
+        token_counts = [TOKEN_ESTIMATOR.estimate_tokens(text) for text in texts]
+    max_inputs, max_tokens = embedding_batch_limits()
+
     try:
+        embeddings = []
         if FLAG_EMBEDDING_MODEL == "AOAI":
-            endpoint_parts = endpoint.split("/openai/deployments/")
-            base_url = endpoint_parts[0]
-            deployment_id = endpoint_parts[1].split("/embeddings")[0]
-            api_version = endpoint_parts[1].split("api-version=")[1].split("&")[0]
-            if azure_credential is not None:
-                api_key = azure_credential.get_token("https://cognitiveservices.azure.com/.default").token
-            else:
+            base_url, deployment_id, api_version = parse_aoai_endpoint(endpoint)
+            api_key = None
+            if azure_credential is None:
                 api_key = embedding_model_key if embedding_model_key else os.getenv("AZURE_OPENAI_API_KEY")
-            
-            client = AzureOpenAI(api_version=api_version, azure_endpoint=base_url, api_key=api_key)
-            if FLAG_AOAI == "V2":
-                embeddings = client.embeddings.create(model=deployment_id, input=text)
-            elif FLAG_AOAI == "V3":   
-                embeddings = client.embeddings.create(model=deployment_id, 
-                                                      input=text, 
-                                                      dimensions=int(os.getenv("VECTOR_DIMENSION", 1536)))
-            
-            return embeddings.model_dump()['data'][0]['embedding']
-        
-        if FLAG_EMBEDDING_MODEL == "COHERE":
-            if FLAG_COHERE == "MULTILINGUAL":
-                key = embedding_model_key if embedding_model_key else os.getenv("COHERE_MULTILINGUAL_API_KEY")
-            elif FLAG_COHERE == "ENGLISH":
-                key = embedding_model_key if embedding_model_key else os.getenv("COHERE_ENGLISH_API_KEY")
-            data, headers = get_payload_and_headers_cohere(text, key)
-
-            body = str.encode(json.dumps(data))
-            req = urllib.request.Request(endpoint, body, headers)
-            response = urllib.request.urlopen(req)
-            result = response.read()
-            result_content = json.loads(result.decode('utf-8'))
-                        
-            return result_content["embeddings"][0]   
-        
+
+            client = get_embedding_client(base_url, api_version, api_key=api_key, azure_credential=azure_credential)
+            options = aoai_embedding_options()
+            for batch in batch_by_tokens(token_counts, max_inputs, max_tokens):
+                response = client.embeddings.create(model=deployment_id, input=texts[batch.start:batch.stop], **options)
+                embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+
+        elif FLAG_EMBEDDING_MODEL == "COHERE":
+            key = cohere_api_key(embedding_model_key)
+            for batch in batch_by_tokens(token_counts, max_inputs, max_tokens):
+                embeddings.extend(_post_cohere(endpoint, texts[batch.start:batch.stop], key))
+
+        if len(embeddings) != len(texts):
+            raise Exception(f"expected {len(texts)} embeddings, got {len(embeddings)}")
+        return embeddings
 
     except Exception as e:
         raise Exception(f"Error getting embeddings with endpoint={endpoint} with error={e}")
 
 
+def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None):
+    return get_embeddings([text], embedding_model_endpoint, embedding_model_key, azure_credential)[0]
+
+
 def chunk_content_helper(
         content: str, file_format: str, file_name: Optional[str],
         token_overlap: int,
@@ -807,7 +1113,8 @@ def chunk_content_helper(
     parser = parser_factory(file_format.split("_pdf")[0]) # to handle cracked pdf converted to html
     doc = parser.parse(content, file_name=file_name)
     # if the original doc after parsing is < num_tokens return as it is
-    doc_content_size = TOKEN_ESTIMATOR.estimate_tokens(doc.content)
+    doc_tokens = TOKEN_ESTIMATOR.encode(doc.content)
+    doc_content_size = len(doc_tokens)
     if doc_content_size < num_tokens or file_format in ["png", "jpg", "jpeg", "gif", "webp"]:
         yield doc.content, doc_content_size, doc
     else:
@@ -820,21 +1127,23 @@ def chunk_content_helper(
                 chunk_doc = parser.parse(chunked_content, file_name=file_name)
                 chunk_doc.title = doc.title
                 yield chunk_doc.content, chunk_size, chunk_doc
-        else:
-            if file_format == "python":
-                splitter = PythonCodeTextSplitter.from_tiktoken_encoder(
-                    chunk_size=num_tokens, chunk_overlap=token_overlap)
-            else:
-                if file_format == "html_pdf": # cracked pdf converted to html
-                    splitter = PdfTextSplitter(separator=SENTENCE_ENDINGS + WORDS_BREAKS, chunk_size=num_tokens, chunk_overlap=token_overlap)
-                else:
-                    splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-                            separators=SENTENCE_ENDINGS + WORDS_BREAKS,
-                            chunk_size=num_tokens, chunk_overlap=token_overlap)
+        elif file_format == "python":
+            splitter = PythonCodeTextSplitter.from_tiktoken_encoder(
+                chunk_size=num_tokens, chunk_overlap=token_overlap)
             chunked_content_list = splitter.split_text(doc.content)
             for chunked_content in chunked_content_list:
                 chunk_size = TOKEN_ESTIMATOR.estimate_tokens(chunked_content)
                 yield chunked_content, chunk_size, doc
+        else:
+            # the splitters report the token count of each chunk, so chunks are not encoded again
+            if file_format == "html_pdf": # cracked pdf converted to html
+                splitter = PdfTextSplitter(separator=SENTENCE_ENDINGS + WORDS_BREAKS, chunk_size=num_tokens, chunk_overlap=token_overlap)
+                chunks_with_sizes = splitter.split_text_with_token_counts(doc.content)
+            else:
+                splitter = TokenOffsetTextSplitter(separators=SENTENCE_ENDINGS + WORDS_BREAKS, chunk_size=num_tokens, chunk_overlap=token_overlap)
+                chunks_with_sizes = splitter.split_text_with_token_counts(doc.content, doc_tokens)
+            for chunked_content, chunk_size in chunks_with_sizes:
+                yield chunked_content, chunk_size, doc
 
 def chunk_content(
     content: str,
@@ -885,37 +1194,33 @@ def chunk_content(
             token_overlap=token_overlap
         )
         chunks = []
+        chunk_sizes = []
         skipped_chunks = 0
         for chunk, chunk_size, doc in chunked_context:
             if chunk_size >= min_chunk_size:
-                if add_embeddings:
-                    for i in range(RETRY_COUNT):
-                        try:
-                            doc.contentVector = get_embedding(chunk, azure_credential=azure_credential, embedding_model_endpoint=embedding_endpoint)
-                            break
-                        except Exception as e:
-                            print(f"Error getting embedding for chunk with error={e}, retrying, current at {i + 1} retry, {RETRY_COUNT - (i + 1)} retries left")
-                            time.sleep(30)
-                    if doc.contentVector is None:
-                        raise Exception(f"Error getting embedding for chunk={chunk}")
-                    
-                doc.image_mapping = {}
+                chunk_image_mapping = {}
                 for key, value in image_mapping.items():
                     if key in chunk:
-                        doc.image_mapping[key] = value
+                        chunk_image_mapping[key] = value
                 chunks.append(
                     Document(
                         content=chunk,
                         title=doc.title,
                         url=url,
-                        contentVector=doc.contentVector,
                         metadata=doc.metadata,
-                        image_mapping=doc.image_mapping
+                        image_mapping=chunk_image_mapping
                     )
                 )
+                chunk_sizes.append(chunk_size)
             else:
                 skipped_chunks += 1
 
+        if add_embeddings and chunks:
+            embeddings = get_embeddings([chunk.content for chunk in chunks], azure_credential=azure_credential,
+                                        embedding_model_endpoint=embedding_endpoint, token_counts=chunk_sizes)
+            for chunk, embedding in zip(chunks, embeddings):
+                chunk.contentVector = embedding
+
     except UnsupportedFormatError as e:
         if ignore_errors:
             return ChunkingResult(
@@ -932,6 +1237,7 @@ def chunk_content(
         chunks=chunks,
         total_files=1,
         skipped_chunks=skipped_chunks,
+        token_counts=chunk_sizes,
     )
 
 def image_content_to_tag(image_content: str) -> str:
@@ -1128,6 +1434,24 @@ def process_file(
         result =None
     return result, is_error
 
+def file_chunker(directory_path: str, njobs: int = 4, form_recognizer_client = None, **process_file_options):
+    """Returns process_file for the files of directory_path, without embeddings, and the executor to run it in:
+    one thread when njobs is 1, else a pool of njobs processes.
+    Args:
+        process_file_options: The other arguments of process_file.
+    """
+    process_file_partial = partial(process_file, directory_path=directory_path,
+                                   form_recognizer_client=form_recognizer_client if njobs == 1 else None,
+                                   add_embeddings=False, **process_file_options)
+    if njobs==1:
+        print("Single process to chunk and parse the files. --njobs > 1 can help performance.")
+        executor = ThreadPoolExecutor(max_workers=1)
+    else:
+        print(f"Multiprocessing with njobs={njobs}")
+        executor = ProcessPoolExecutor(max_workers=njobs)
+    return process_file_partial, executor
+
+
 def chunk_blob_container(
         blob_url: str,
         credential,
@@ -1142,7 +1466,8 @@ def chunk_blob_container(
         njobs=4,
         add_embeddings = False,
         azure_credential = None,
-        embedding_endpoint = None
+        embedding_endpoint = None,
+        select_files = None
 ):
     with tempfile.TemporaryDirectory() as local_data_folder:
         print(f'Downloading {blob_url} to local folder')
@@ -1162,7 +1487,8 @@ def chunk_blob_container(
             njobs=njobs,
             add_embeddings=add_embeddings,
             azure_credential=azure_credential,
-            embedding_endpoint=embedding_endpoint
+            embedding_endpoint=embedding_endpoint,
+            select_files=select_files
         )
 
     return result
@@ -1183,7 +1509,8 @@ def chunk_directory(
         azure_credential = None,
         embedding_endpoint = None,
         captioning_model_endpoint = None,
-        captioning_model_key = None
+        captioning_model_key = None,
+        select_files = None
 ):
     """
     Chunks the given directory recursively
@@ -1200,6 +1527,7 @@ def chunk_directory(
         form_recognizer_client: Optional form recognizer client to use for pdf files.
         use_layout (bool): If true, uses Layout model for pdf files. Otherwise, uses Read.
         add_embeddings (bool): If true, adds a vector embedding to each chunk using the embedding model endpoint and key.
+        select_files (Callable): Optional, called with the directory and the files found in it, returns the files to chunk.
 
     Returns:
         List[Document]: List of chunked documents.
@@ -1209,52 +1537,45 @@ def chunk_directory(
     num_unsupported_format_files = 0
     num_files_with_errors = 0
     skipped_chunks = 0
+    failed_files = []
 
     all_files_directory = get_files_recursively(directory_path)
     files_to_process = [file_path for file_path in all_files_directory if os.path.isfile(file_path)]
+    if select_files is not None:
+        files_to_process = select_files(directory_path, files_to_process)
     print(f"Total files to process={len(files_to_process)} out of total directory size={len(all_files_directory)}")
 
 
-    if njobs==1:
-        print("Single process to chunk and parse the files. --njobs > 1 can help performance.")
-        for file_path in tqdm(files_to_process):
+    def collect(outcomes):
+        nonlocal total_files, num_unsupported_format_files, num_files_with_errors, skipped_chunks
+        for file_path, (result, is_error) in zip(files_to_process, outcomes):
             total_files += 1
-            result, is_error = process_file(file_path=file_path,directory_path=directory_path, ignore_errors=ignore_errors,
-                                       num_tokens=num_tokens,
-                                       min_chunk_size=min_chunk_size, url_prefix=url_prefix,
-                                       token_overlap=token_overlap,
-                                       extensions_to_process=extensions_to_process,
-                                       form_recognizer_client=form_recognizer_client, use_layout=use_layout, add_embeddings=add_embeddings,
-                                       azure_credential=azure_credential, embedding_endpoint=embedding_endpoint,
-                                       captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key)
             if is_error:
                 num_files_with_errors += 1
+                failed_files.append(os.path.relpath(file_path, directory_path))
                 continue
             chunks.extend(result.chunks)
             num_unsupported_format_files += result.num_unsupported_format_files
             num_files_with_errors += result.num_files_with_errors
             skipped_chunks += result.skipped_chunks
-    elif njobs > 1:
-        print(f"Multiprocessing with njobs={njobs}")
-        process_file_partial = partial(process_file, directory_path=directory_path, ignore_errors=ignore_errors,
-                                       num_tokens=num_tokens,
-                                       min_chunk_size=min_chunk_size, url_prefix=url_prefix,
-                                       token_overlap=token_overlap,
-                                       extensions_to_process=extensions_to_process,
-                                       form_recognizer_client=None, use_layout=use_layout, add_embeddings=add_embeddings,
-                                       azure_credential=azure_credential, embedding_endpoint=embedding_endpoint,
-                                       captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key)
-        with ProcessPoolExecutor(max_workers=njobs) as executor:
-            futures = list(tqdm(executor.map(process_file_partial, files_to_process), total=len(files_to_process)))
-            for result, is_error in futures:
-                total_files += 1
-                if is_error:
-                    num_files_with_errors += 1
-                    continue
-                chunks.extend(result.chunks)
-                num_unsupported_format_files += result.num_unsupported_format_files
-                num_files_with_errors += result.num_files_with_errors
-                skipped_chunks += result.skipped_chunks
+            if result.num_files_with_errors:
+                failed_files.append(os.path.relpath(file_path, directory_path))
+
+    # the workers only chunk; with add_embeddings one rate limited stage in this process embeds for all of them
+    process_file_partial, executor = file_chunker(directory_path, njobs=njobs, form_recognizer_client=form_recognizer_client,
+                                                  ignore_errors=ignore_errors, num_tokens=num_tokens,
+                                                  min_chunk_size=min_chunk_size, url_prefix=url_prefix,
+                                                  token_overlap=token_overlap,
+                                                  extensions_to_process=extensions_to_process, use_layout=use_layout,
+                                                  captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key)
+    with executor:
+        if add_embeddings:
+            from ingestion_pipeline import chunk_and_embed
+            collect(chunk_and_embed(files_to_process, process_file_partial, executor,
+                                    embedding_model_endpoint=embedding_endpoint, azure_credential=azure_credential,
+                                    max_pending_files=2 * njobs))
+        else:
+            collect(tqdm(executor.map(process_file_partial, files_to_process), total=len(files_to_process)))
 
     return ChunkingResult(
             chunks=chunks,
@@ -1262,6 +1583,7 @@ def chunk_directory(
             num_unsupported_format_files=num_unsupported_format_files,
             num_files_with_errors=num_files_with_errors,
             skipped_chunks=skipped_chunks,
+            failed_files=failed_files,
         )
 
 
@@ -1,13 +1,10 @@
 import argparse
-from asyncio import sleep
 import json
 
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 
-from data_utils import get_embedding
-
-RETRY_COUNT = 5
+from data_utils import embedding_batch_limits, get_embeddings
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -48,20 +45,23 @@ if __name__ == "__main__":
 
         # Embed documents
         print("Generating embeddings...")
+        max_inputs, _ = embedding_batch_limits()
         with open(args.input_data_path) as input_file, open(args.output_file_path, "w") as output_file:
+            def embed_batch(documents):
+                embeddings = get_embeddings([document["content"] for document in documents], embedding_endpoint, embedding_key)
+                for document, embedding in zip(documents, embeddings):
+                    document["contentVector"] = embedding
+                    output_file.write(json.dumps(document) + "\n")
+
+            # get_embeddings packs each batch into as few requests as the token limit allows
+            documents = []
             for line in input_file:
-                document = json.loads(line)
-                # Sleep/Retry in case embedding model is rate limited.
-                for _ in range(RETRY_COUNT):
-                    try:
-                        embedding = get_embedding(document["content"], embedding_endpoint,  embedding_key)
-                        document["contentVector"] = embedding
-                        break
-                    except:
-                        print("Error generating embedding. Retrying...")
-                        sleep(30)
-                
-                output_file.write(json.dumps(document) + "\n")
+                documents.append(json.loads(line))
+                if len(documents) == max_inputs:
+                    embed_batch(documents)
+                    documents = []
+            if documents:
+                embed_batch(documents)
 
         print("Embeddings generated and saved to {}.".format(args.output_file_path))
 
@@ -0,0 +1,143 @@
+"""On-disk cache of chunk embeddings, so reruns only embed new or changed chunks.
+
+Entries are keyed by a hash of the model deployment, the vector dimensions and
+the chunk text, and stored in SQLite as float32 arrays. Reads go through
+SQLite's memory map. The cache lives at EMBEDDING_CACHE_PATH; set it to an
+empty string to turn the cache off.
+
+    python embedding_cache.py stats
+    python embedding_cache.py compact --older-than-days 30
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional, Sequence
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "sample-app-aoai-chatgpt", "embeddings.sqlite3")
+MMAP_SIZE = 1 << 30
+## below SQLite's limit on bound parameters
+LOOKUP_BATCH = 500
+SECONDS_PER_DAY = 86400
+
+
+def cache_key(deployment: str, dimensions: Optional[int], text: str) -> bytes:
+    return hashlib.sha256(f"{deployment}\0{dimensions or ''}\0{text}".encode("utf-8")).digest()
+
+
+class EmbeddingCache():
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_used INTEGER NOT NULL) WITHOUT ROWID"
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys: Sequence[bytes]) -> List[Optional[List[float]]]:
+        """The cached embedding for each key, or None."""
+        found: Dict[bytes, bytes] = {}
+        today = int(time.time()) // SECONDS_PER_DAY
+        with self._lock:
+            for start in range(0, len(keys), LOOKUP_BATCH):
+                batch = list(keys[start:start + LOOKUP_BATCH])
+                placeholders = ",".join("?" * len(batch))
+                found.update(self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ))
+            if found:
+                ## last_used has day resolution, so a rerun on the same day writes nothing
+                with self._connection:
+                    self._connection.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ? AND last_used < ?",
+                        [(today, key, today) for key in found],
+                    )
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return [_decode(found[key]) if key in found else None for key in keys]
+
+    def put_many(self, keys: Sequence[bytes], vectors: Sequence[List[float]]):
+        today = int(time.time()) // SECONDS_PER_DAY
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), today) for key, vector in zip(keys, vectors)],
+            )
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            page_count = self._connection.execute("PRAGMA page_count").fetchone()[0]
+            page_size = self._connection.execute("PRAGMA page_size").fetchone()[0]
+            free_pages = self._connection.execute("PRAGMA freelist_count").fetchone()[0]
+        return {
+            "entries": entries,
+            "size_bytes": page_count * page_size,
+            "free_bytes": free_pages * page_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def compact(self, older_than_days: Optional[int] = None) -> int:
+        """Deletes entries not used for `older_than_days` days, if given, and rewrites the file. Returns the entries deleted."""
+        deleted = 0
+        with self._lock:
+            if older_than_days is not None:
+                cutoff = int(time.time()) // SECONDS_PER_DAY - older_than_days
+                with self._connection:
+                    deleted = self._connection.execute("DELETE FROM embeddings WHERE last_used < ?", (cutoff,)).rowcount
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._connection.execute("VACUUM")
+        return deleted
+
+    def close(self):
+        self._connection.close()
+
+
+def _decode(blob: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+_CACHES: Dict[str, EmbeddingCache] = {}
+
+
+def get_embedding_cache(path: Optional[str] = None) -> Optional[EmbeddingCache]:
+    """The process wide cache at `path`, EMBEDDING_CACHE_PATH by default, or None when the cache is turned off."""
+    if path is None:
+        path = os.getenv("EMBEDDING_CACHE_PATH", DEFAULT_CACHE_PATH)
+    if not path:
+        return None
+    ## a connection must not be used from a forked worker
+    key = f"{os.getpid()}:{path}"
+    if key not in _CACHES:
+        _CACHES[key] = EmbeddingCache(path)
+    return _CACHES[key]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or compact the embedding cache.")
+    parser.add_argument("command", choices=["stats", "compact"])
+    parser.add_argument("--path", type=str, default=None, help="Cache file, EMBEDDING_CACHE_PATH by default.")
+    parser.add_argument("--older-than-days", type=int, default=None, help="With compact, delete entries unused for this many days.")
+    args = parser.parse_args()
+
+    cache = get_embedding_cache(args.path)
+    if cache is None:
+        raise SystemExit("The embedding cache is turned off, EMBEDDING_CACHE_PATH is empty.")
+    if args.command == "compact":
+        before = cache.stats()["size_bytes"]
+        deleted = cache.compact(args.older_than_days)
+        print(f"Deleted {deleted} entries, {before} -> {cache.stats()['size_bytes']} bytes")
+    stats = cache.stats()
+    print(f"{cache.path}: {stats['entries']} entries, {stats['size_bytes']} bytes ({stats['free_bytes']} free)")
@@ -0,0 +1,383 @@
+"""Embedding stage shared by all chunking workers.
+
+The chunking workers only parse and split files. Their chunks are sent
+through a queue to one asyncio loop in the main process, which packs them
+into batches and embeds them. A token bucket sized to the deployment's
+tokens and requests per minute paces all requests. Throttled requests are
+retried after the server's `retry-after`, or with exponential backoff and
+jitter if there is none. A throttle response also pauses every other request
+until that time. The number of requests in flight is halved on each throttle
+and grows again by one after each run of successful requests. Chunks found
+in the embedding cache are not sent at all.
+"""
+import asyncio
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from openai import APIConnectionError, APIStatusError, AsyncAzureOpenAI
+
+from data_utils import (
+    RETRY_COUNT,
+    TOKEN_ESTIMATOR,
+    aoai_embedding_options,
+    batch_by_tokens,
+    cohere_api_key,
+    embedding_batch_limits,
+    embedding_cache_keys,
+    get_payload_and_headers_cohere,
+    parse_aoai_endpoint,
+)
+from embedding_cache import get_embedding_cache
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+MAX_BACKOFF_SECONDS = 60
+
+
+class TokenBucket():
+    """Allows `per_minute` units a minute, with bursts of up to `burst_seconds` worth."""
+
+    def __init__(self, per_minute: float, burst_seconds: float = 10):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1) -> float:
+        """Waits until `amount` units are available and takes them. Returns the seconds waited."""
+        ## a request larger than the burst would never fit, it waits for a full bucket instead
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= amount:
+                    self.available -= amount
+                    return waited
+                delay = (amount - self.available) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+
+class AdaptiveConcurrency():
+    """A semaphore whose limit is halved on each throttle and grows by one after `limit` successes."""
+
+    def __init__(self, maximum: int, minimum: int = 1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = maximum
+        self.in_flight = 0
+        self._successes = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        self._successes += 1
+        if self._successes >= self.limit and self.limit < self.maximum:
+            self.limit += 1
+            self._successes = 0
+
+    def on_throttle(self):
+        self.limit = max(self.minimum, self.limit // 2)
+        self._successes = 0
+
+
+@dataclass
+class EmbeddingStats():
+    requests: int = 0
+    inputs: int = 0
+    tokens: int = 0
+    throttled: int = 0
+    retries: int = 0
+    ## time spent waiting on the rate limiter and on throttle responses
+    limiter_seconds: float = 0.0
+    throttle_seconds: float = 0.0
+    cache_hits: int = 0
+    started: float = 0.0
+    finished: float = 0.0
+
+    def report(self, concurrency_limit: Optional[int] = None) -> str:
+        elapsed = max(self.finished - self.started, 1e-9)
+        lines = [
+            f"Embedded {self.inputs} chunks ({self.tokens} tokens) in {self.requests} requests over {elapsed:.1f}s",
+            f"Throughput: {self.inputs / elapsed:.1f} chunks/s, {self.tokens * 60 / elapsed:.0f} tokens/min",
+            f"Throttled {self.throttled} times, {self.retries} retries, {self.throttle_seconds:.1f}s waiting on throttles, "
+            f"{self.limiter_seconds:.1f}s waiting on the rate limiter",
+            f"Embedding cache: {self.cache_hits} chunks found, {self.inputs} added",
+        ]
+        if concurrency_limit is not None:
+            lines.append(f"Final concurrency limit: {concurrency_limit}")
+        return "\n".join(lines)
+
+
+def _retry_after_seconds(headers) -> Optional[float]:
+    if headers is None:
+        return None
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) * scale
+            except ValueError:
+                continue
+    return None
+
+
+class _RetryableError(Exception):
+    def __init__(self, message: str, throttled: bool, retry_after: Optional[float]):
+        super().__init__(message)
+        self.throttled = throttled
+        self.retry_after = retry_after
+
+
+class EmbeddingService():
+    """Embeds batches of texts for the whole run, within the deployment's rate limits.
+    Args:
+        tokens_per_minute (int): Token quota of the deployment, EMBEDDING_TPM by default. None for no limit.
+        requests_per_minute (int): Request quota of the deployment, EMBEDDING_RPM by default. None for no limit.
+        max_concurrency (int): Most requests in flight, EMBEDDING_MAX_CONCURRENCY by default.
+    """
+
+    def __init__(
+        self,
+        embedding_model_endpoint: Optional[str] = None,
+        embedding_model_key: Optional[str] = None,
+        azure_credential = None,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        max_concurrency: Optional[int] = None,
+    ):
+        self.endpoint = embedding_model_endpoint if embedding_model_endpoint else os.environ.get("EMBEDDING_MODEL_ENDPOINT")
+        if self.endpoint is None:
+            raise Exception("EMBEDDING_MODEL_ENDPOINT is required for embedding")
+        self.model = os.getenv("FLAG_EMBEDDING_MODEL", "AOAI")
+        self.embedding_model_key = embedding_model_key
+        self.azure_credential = azure_credential
+
+        tokens_per_minute = tokens_per_minute or _env_int("EMBEDDING_TPM")
+        requests_per_minute = requests_per_minute or _env_int("EMBEDDING_RPM")
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.concurrency = AdaptiveConcurrency(max_concurrency or _env_int("EMBEDDING_MAX_CONCURRENCY") or 8)
+        self.max_inputs, self.max_tokens = embedding_batch_limits()
+        self.stats = EmbeddingStats()
+        self.cache = get_embedding_cache()
+        ## monotonic time before which no request is sent, set by throttle responses
+        self._resume_at = 0.0
+        self._client = None
+
+    async def __aenter__(self):
+        self.stats.started = time.monotonic()
+        if self.model == "AOAI":
+            base_url, self._deployment_id, api_version = parse_aoai_endpoint(self.endpoint)
+            options = {"api_version": api_version, "azure_endpoint": base_url, "max_retries": 0}
+            if self.azure_credential is not None:
+                from azure.identity import get_bearer_token_provider
+                options["azure_ad_token_provider"] = get_bearer_token_provider(
+                    self.azure_credential, "https://cognitiveservices.azure.com/.default")
+            else:
+                options["api_key"] = self.embedding_model_key if self.embedding_model_key else os.getenv("AZURE_OPENAI_API_KEY")
+            self._client = AsyncAzureOpenAI(**options)
+            self._options = aoai_embedding_options()
+        else:
+            self._client = httpx.AsyncClient(timeout=60)
+            self._cohere_key = cohere_api_key(self.embedding_model_key)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.stats.finished = time.monotonic()
+        if self.model == "AOAI":
+            await self._client.close()
+        else:
+            await self._client.aclose()
+
+    async def _send(self, texts: List[str]) -> List[List[float]]:
+        if self.model == "AOAI":
+            try:
+                response = await self._client.embeddings.create(model=self._deployment_id, input=texts, **self._options)
+            except APIStatusError as e:
+                if e.status_code not in RETRYABLE_STATUS_CODES:
+                    raise
+                raise _RetryableError(str(e), e.status_code == 429, _retry_after_seconds(e.response.headers))
+            except APIConnectionError as e:
+                raise _RetryableError(str(e), False, None)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+        data, headers = get_payload_and_headers_cohere(texts, self._cohere_key)
+        try:
+            response = await self._client.post(self.endpoint, json=data, headers=headers)
+        except httpx.TransportError as e:
+            raise _RetryableError(str(e), False, None)
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            raise _RetryableError(f"status_code={response.status_code}", response.status_code == 429,
+                                  _retry_after_seconds(response.headers))
+        response.raise_for_status()
+        return response.json()["embeddings"]
+
+    def lookup(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """The cached embedding of each text, or None."""
+        if self.cache is None:
+            return [None] * len(texts)
+        embeddings = self.cache.get_many(embedding_cache_keys(texts, self.endpoint))
+        self.stats.cache_hits += sum(embedding is not None for embedding in embeddings)
+        return embeddings
+
+    async def embed_batch(self, texts: List[str], token_count: int) -> List[List[float]]:
+        """Embeds texts that fit in one request, retrying throttles and transient errors, and caches the embeddings."""
+        for attempt in range(RETRY_COUNT + 1):
+            if self.token_bucket:
+                self.stats.limiter_seconds += await self.token_bucket.acquire(token_count)
+            if self.request_bucket:
+                self.stats.limiter_seconds += await self.request_bucket.acquire(1)
+            async with self.concurrency:
+                pause = self._resume_at - time.monotonic()
+                if pause > 0:
+                    self.stats.throttle_seconds += pause
+                    await asyncio.sleep(pause)
+                self.stats.requests += 1
+                try:
+                    embeddings = await self._send(texts)
+                except _RetryableError as e:
+                    if attempt == RETRY_COUNT:
+                        raise Exception(f"Error getting embeddings with endpoint={self.endpoint} with error={e}")
+                    ## full jitter, unless the server said when to come back
+                    delay = e.retry_after if e.retry_after is not None else random.uniform(0, min(MAX_BACKOFF_SECONDS, 2 ** attempt))
+                    if e.throttled:
+                        self.stats.throttled += 1
+                        self.concurrency.on_throttle()
+                        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+                    self.stats.retries += 1
+                    self.stats.throttle_seconds += delay
+                    await asyncio.sleep(delay)
+                    continue
+            self.concurrency.on_success()
+            if len(embeddings) != len(texts):
+                raise Exception(f"expected {len(texts)} embeddings, got {len(embeddings)}")
+            self.stats.inputs += len(texts)
+            self.stats.tokens += token_count
+            if self.cache is not None:
+                await asyncio.to_thread(self.cache.put_many, embedding_cache_keys(texts, self.endpoint), embeddings)
+            return embeddings
+
+    async def embed(self, texts: List[str], token_counts: Optional[List[int]] = None) -> List[List[float]]:
+        """Embeds any number of texts concurrently, in batches. Returns the embeddings in the order of the texts."""
+        embeddings = await asyncio.to_thread(self.lookup, texts)
+        ## repeated texts are requested once
+        first: Dict[str, int] = {}
+        for i, (text, embedding) in enumerate(zip(texts, embeddings)):
+            if embedding is None:
+                first.setdefault(text, i)
+        missing = list(first.values())
+        missing_counts = [token_counts[i] if token_counts else TOKEN_ESTIMATOR.estimate_tokens(texts[i]) for i in missing]
+        batches = list(batch_by_tokens(missing_counts, self.max_inputs, self.max_tokens))
+        results = await asyncio.gather(*[
+            self.embed_batch([texts[i] for i in missing[batch.start:batch.stop]], sum(missing_counts[batch.start:batch.stop]))
+            for batch in batches
+        ])
+        new_embeddings = [embedding for batch_embeddings in results for embedding in batch_embeddings]
+        by_text = {texts[i]: embedding for i, embedding in zip(missing, new_embeddings)}
+        return [by_text[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)]
+
+
+def _env_int(name: str) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+async def embed_stage(service: EmbeddingService, in_queue: asyncio.Queue, out_queue: asyncio.Queue, stats=None):
+    """Embeds the chunks of the chunked files read from `in_queue` and passes each file on to `out_queue` once all its
+    chunks have a vector. Items are (index, file_path, outcome) with outcome a (ChunkingResult, is_error) pair, or the
+    exception that chunking the file raised; None ends the stream. Files may leave in a different order."""
+    embed_tasks = set()
+    ## index -> [item, chunks still waiting for a vector]
+    waiting: Dict[int, list] = {}
+    batch: List[Tuple[int, Any, int]] = []
+    batch_tokens = 0
+
+    async def forward(item):
+        started = time.monotonic()
+        await out_queue.put(item)
+        if stats is not None:
+            stats.blocked_seconds += time.monotonic() - started
+
+    async def embed(batch):
+        embeddings = await service.embed_batch([document.content for _, document, _ in batch], sum(count for _, _, count in batch))
+        for (index, document, _), embedding in zip(batch, embeddings):
+            document.contentVector = embedding
+            waiting[index][1] -= 1
+        for index in dict.fromkeys(index for index, _, _ in batch):
+            if waiting[index][1] == 0:
+                await forward(waiting.pop(index)[0])
+
+    def flush():
+        nonlocal batch, batch_tokens
+        embed_tasks.add(asyncio.create_task(embed(batch)))
+        batch, batch_tokens = [], 0
+
+    def reap():
+        ## raises the error of a failed batch, whose files would otherwise never be forwarded
+        for task in [task for task in embed_tasks if task.done()]:
+            embed_tasks.discard(task)
+            task.result()
+
+    ## chunks of several files share a request; a partial batch is only sent while the
+    ## chunkers have nothing ready and there is room for another request
+    while True:
+        reap()
+        if batch and in_queue.empty() and len(embed_tasks) < service.concurrency.limit:
+            flush()
+        item = await in_queue.get()
+        if item is None:
+            break
+        if stats is not None and stats.started is None:
+            stats.started = time.monotonic()
+        index, _, outcome = item
+        if isinstance(outcome, Exception) or outcome[1]:
+            await forward(item)
+            continue
+        result = outcome[0]
+        token_counts = result.token_counts or [TOKEN_ESTIMATOR.estimate_tokens(c.content) for c in result.chunks]
+        ## the cache is read off the event loop, which keeps the other batches moving
+        cached = await asyncio.to_thread(service.lookup, [document.content for document in result.chunks])
+        missing = 0
+        for document, count, embedding in zip(result.chunks, token_counts, cached):
+            if embedding is not None:
+                document.contentVector = embedding
+                continue
+            if batch and (len(batch) >= service.max_inputs or batch_tokens + count > service.max_tokens):
+                flush()
+            batch.append((index, document, count))
+            batch_tokens += count
+            missing += 1
+        if stats is not None:
+            stats.items += len(result.chunks)
+        if missing == 0:
+            await forward(item)
+        else:
+            waiting[index] = [item, missing]
+        ## a backlog of full batches waits for the concurrency limit rather than growing without bound
+        while len(embed_tasks) > service.concurrency.limit * 2:
+            await asyncio.wait(embed_tasks, return_when=asyncio.FIRST_COMPLETED)
+            reap()
+    if batch:
+        flush()
+    if embed_tasks:
+        await asyncio.gather(*embed_tasks)
+    if stats is not None:
+        stats.finished = time.monotonic()
+    await out_queue.put(None)
@@ -0,0 +1,131 @@
+"""Manifest of the files already in an index, for incremental ingestion.
+
+For each data path the manifest records every file's size, modification time,
+content hash and the ids of the chunks it produced. A run compares the files
+on disk against it: files whose size and mtime are unchanged are skipped
+without being read, and files whose content hash is unchanged are skipped too.
+Only added and changed files are chunked. The chunks of changed and removed
+files that are no longer produced are deleted from the index.
+"""
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List
+
+MANIFEST_VERSION = 1
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclass
+class FileState():
+    size: int
+    mtime_ns: int
+    sha256: str
+    chunk_ids: List[str] = field(default_factory=list)
+
+
+@dataclass
+class IngestionPlan():
+    """What a run has to do for one data path.
+
+    Attributes:
+        changed (List[str]): Absolute paths of the added and changed files, to chunk.
+        unchanged (int): Number of files skipped.
+        removed (List[str]): Relative paths of the files gone since the last run.
+        states (Dict[str, FileState]): New state of the added and changed files, by relative path.
+    """
+    changed: List[str] = field(default_factory=list)
+    unchanged: int = 0
+    removed: List[str] = field(default_factory=list)
+    states: Dict[str, FileState] = field(default_factory=dict)
+
+
+class IngestionManifest():
+    def __init__(self, path: str):
+        self.path = path
+        ## data path -> relative file path -> state
+        self.sources: Dict[str, Dict[str, FileState]] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                for source, files in manifest["sources"].items():
+                    self.sources[source] = {rel_path: FileState(**state) for rel_path, state in files.items()}
+            else:
+                print(f"Ignoring manifest {path} with unsupported version {manifest.get('version')}, all files will be processed")
+
+    def plan(self, source: str, directory: str, file_paths: List[str]) -> IngestionPlan:
+        """Compares the files found in `directory` against what was recorded for `source`."""
+        known = self.sources.get(source, {})
+        plan = IngestionPlan()
+        seen = set()
+        for file_path in file_paths:
+            rel_path = os.path.relpath(file_path, directory)
+            seen.add(rel_path)
+            stat = os.stat(file_path)
+            previous = known.get(rel_path)
+            if previous is not None and (previous.size, previous.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                plan.unchanged += 1
+                continue
+            sha256 = file_sha256(file_path)
+            state = FileState(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=sha256)
+            if previous is not None and previous.sha256 == sha256:
+                ## touched or downloaded again, the content and so the chunks are the same
+                state.chunk_ids = previous.chunk_ids
+                self.record(source, rel_path, state)
+                plan.unchanged += 1
+            else:
+                plan.changed.append(file_path)
+                plan.states[rel_path] = state
+        plan.removed = [rel_path for rel_path in known if rel_path not in seen]
+        return plan
+
+    def record_file(self, source: str, rel_path: str, state: FileState, chunk_ids: List[str]) -> List[str]:
+        """Records the chunks now in the index for a planned file and returns the ids of its chunks to delete."""
+        current = set(chunk_ids)
+        stale = [chunk_id for chunk_id in self.chunk_ids(source, rel_path) if chunk_id not in current]
+        state.chunk_ids = list(chunk_ids)
+        self.record(source, rel_path, state)
+        return stale
+
+    def remove_files(self, source: str, rel_paths: List[str]) -> List[str]:
+        """Forgets the removed files and returns the ids of their chunks."""
+        stale = []
+        for rel_path in rel_paths:
+            stale.extend(self.chunk_ids(source, rel_path))
+            self.forget(source, rel_path)
+        return stale
+
+    def chunk_ids(self, source: str, rel_path: str) -> List[str]:
+        state = self.sources.get(source, {}).get(rel_path)
+        return state.chunk_ids if state else []
+
+    def record(self, source: str, rel_path: str, state: FileState):
+        self.sources.setdefault(source, {})[rel_path] = state
+
+    def forget(self, source: str, rel_path: str):
+        self.sources.get(source, {}).pop(rel_path, None)
+
+    def save(self):
+        """Writes the manifest atomically, so an interrupted run leaves the previous one in place."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "sources": {
+                source: {rel_path: asdict(state) for rel_path, state in files.items()}
+                for source, files in self.sources.items()
+            },
+        }
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, self.path)
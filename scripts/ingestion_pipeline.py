@@ -0,0 +1,246 @@
+"""Streaming ingestion: chunking, embedding and uploading overlap.
+
+Files are chunked by a pool of workers, their chunks are embedded by one
+rate limited `EmbeddingService` and uploaded in batches, with bounded queues
+between the stages. A stage that falls behind makes the stages before it
+wait, so memory depends on the queue sizes and not on the size of the corpus.
+Each stage reports its throughput and the time it spent waiting on the next.
+"""
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from embedding_service import EmbeddingService, embed_stage
+
+
+@dataclass
+class StageStats():
+    name: str
+    unit: str
+    items: int = 0
+    ## time spent waiting for the next stage to accept output
+    blocked_seconds: float = 0.0
+    started: Optional[float] = None
+    finished: float = 0.0
+
+    def report(self) -> str:
+        if self.started is None:
+            return f"{self.name}: no {self.unit}"
+        elapsed = max(self.finished - self.started, 1e-9)
+        return (f"{self.name}: {self.items} {self.unit} in {elapsed:.1f}s ({self.items / elapsed:.1f} {self.unit}/s), "
+                f"{self.blocked_seconds:.1f}s waiting on the next stage")
+
+
+async def _put(queue: asyncio.Queue, item, stats: StageStats):
+    started = time.monotonic()
+    await queue.put(item)
+    stats.blocked_seconds += time.monotonic() - started
+
+
+async def chunk_stage(
+    files: List[str],
+    process_file: Callable[[str], Tuple[Any, bool]],
+    executor,
+    out_queue: asyncio.Queue,
+    stats: StageStats,
+    max_pending_files: int,
+):
+    """Runs `process_file` on each file in `executor`, at most `max_pending_files` at a time, and puts
+    (index, file_path, outcome) on `out_queue` as they finish. The outcome is the (result, is_error) pair,
+    or the exception raised when errors are not ignored. Ends the stream with None."""
+    loop = asyncio.get_running_loop()
+    pending_files = asyncio.Semaphore(max_pending_files)
+    stats.started = time.monotonic()
+
+    async def chunk(index: int, file_path: str):
+        ## a file holds its slot until the next stage has taken its result, so results waiting on a full queue count
+        try:
+            try:
+                outcome = await loop.run_in_executor(executor, process_file, file_path)
+            except Exception as e:
+                outcome = e
+            stats.items += 1
+            await _put(out_queue, (index, file_path, outcome), stats)
+        finally:
+            pending_files.release()
+
+    tasks = []
+    try:
+        for index, file_path in enumerate(files):
+            await pending_files.acquire()
+            tasks.append(asyncio.create_task(chunk(index, file_path)))
+        await asyncio.gather(*tasks)
+    except BaseException:
+        ## cancelled, or a file failed: the files still waiting on the queue are dropped with the stage
+        for task in tasks:
+            task.cancel()
+        raise
+    stats.finished = time.monotonic()
+    await out_queue.put(None)
+
+
+async def upload_stage(
+    in_queue: asyncio.Queue,
+    send: Callable[[List[Any]], Awaitable[Optional[List[Optional[str]]]]],
+    stats: StageStats,
+    batch_size: int,
+    prepare: Optional[Callable[[Any], None]] = None,
+    on_file_done: Optional[Callable[[str, Any], None]] = None,
+    max_in_flight: int = 1,
+):
+    """Sends the chunks of the files read from `in_queue` in batches of up to `batch_size` with the coroutine `send`,
+    up to `max_in_flight` batches at a time. `send` returns the error of each chunk, None for the chunks it sent.
+    `prepare` is called with each file's result before its chunks are batched, `on_file_done` with the file path and
+    outcome once all its chunks are sent; a file with chunks that could not be sent is passed on as an error."""
+    send_tasks = set()
+    batch: List[Tuple[int, Any]] = []
+    ## index -> [file_path, outcome, chunks not sent yet, whether a chunk failed]
+    waiting = {}
+
+    async def send_batch(sent: List[Tuple[int, Any]]):
+        errors = await send([document for _, document in sent]) or [None] * len(sent)
+        stats.items += len(sent)
+        for (index, _), error in zip(sent, errors):
+            waiting[index][2] -= 1
+            waiting[index][3] = waiting[index][3] or error is not None
+        for index in dict.fromkeys(index for index, _ in sent):
+            if waiting[index][2] == 0:
+                file_path, (result, is_error), _, failed = waiting.pop(index)
+                if on_file_done:
+                    on_file_done(file_path, (result, is_error or failed))
+
+    def flush():
+        nonlocal batch
+        send_tasks.add(asyncio.create_task(send_batch(batch)))
+        batch = []
+
+    def reap():
+        ## raises the error of a failed batch
+        for task in [task for task in send_tasks if task.done()]:
+            send_tasks.discard(task)
+            task.result()
+
+    ## a partial batch is only sent while the earlier stages have nothing ready and a batch can go out
+    while True:
+        reap()
+        if batch and in_queue.empty() and len(send_tasks) < max_in_flight:
+            flush()
+        item = await in_queue.get()
+        if item is None:
+            break
+        if stats.started is None:
+            stats.started = time.monotonic()
+        index, file_path, outcome = item
+        if isinstance(outcome, Exception):
+            raise outcome
+        result, is_error = outcome
+        if is_error or not result.chunks:
+            if on_file_done:
+                on_file_done(file_path, outcome)
+            continue
+        if prepare:
+            prepare(result)
+        waiting[index] = [file_path, outcome, len(result.chunks), False]
+        for document in result.chunks:
+            batch.append((index, document))
+            if len(batch) >= batch_size:
+                flush()
+        while len(send_tasks) >= max_in_flight:
+            await asyncio.wait(send_tasks, return_when=asyncio.FIRST_COMPLETED)
+            reap()
+    if batch:
+        flush()
+    if send_tasks:
+        await asyncio.gather(*send_tasks)
+    stats.finished = time.monotonic()
+
+
+async def _run_stages(*coroutines):
+    """Runs the stages together; the first one to fail cancels the others."""
+    tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+def run_ingestion(
+    files: List[str],
+    process_file: Callable[[str], Tuple[Any, bool]],
+    executor,
+    send: Callable[[List[Any]], Awaitable[Optional[List[Optional[str]]]]],
+    embedding_service: Optional[EmbeddingService] = None,
+    upload_batch_size: int = 50,
+    max_pending_files: int = 16,
+    prepare: Optional[Callable[[Any], None]] = None,
+    on_file_done: Optional[Callable[[str, Any], None]] = None,
+    max_uploads_in_flight: int = 1,
+) -> List[StageStats]:
+    """Chunks the files, embeds their chunks if an embedding service is given, and sends them in batches with the
+    coroutine `send`. Prints and returns the stats of each stage."""
+    chunk_stats = StageStats("Chunking", "files")
+    embed_stats = StageStats("Embedding", "chunks")
+    upload_stats = StageStats("Uploading", "chunks")
+
+    async def run():
+        chunked: asyncio.Queue = asyncio.Queue(maxsize=max_pending_files)
+        stages = [chunk_stage(files, process_file, executor, chunked, chunk_stats, max_pending_files)]
+        if embedding_service is None:
+            to_upload = chunked
+        else:
+            to_upload = asyncio.Queue(maxsize=max_pending_files)
+            stages.append(embed_stage(embedding_service, chunked, to_upload, embed_stats))
+        stages.append(upload_stage(to_upload, send, upload_stats, upload_batch_size, prepare, on_file_done,
+                                   max_uploads_in_flight))
+        if embedding_service is None:
+            await _run_stages(*stages)
+        else:
+            async with embedding_service:
+                await _run_stages(*stages)
+            print(embedding_service.stats.report(embedding_service.concurrency.limit))
+
+    asyncio.run(run())
+    stats = [chunk_stats] + ([embed_stats] if embedding_service is not None else []) + [upload_stats]
+    for stage in stats:
+        print(stage.report())
+    return stats
+
+
+def chunk_and_embed(
+    files: List[str],
+    process_file: Callable[[str], Tuple[Any, bool]],
+    executor,
+    embedding_model_endpoint: Optional[str] = None,
+    azure_credential = None,
+    max_pending_files: int = 16,
+) -> List[Tuple[Any, bool]]:
+    """Runs `process_file` on each file in `executor` and embeds the chunks of every result in this process.
+    Returns the (result, is_error) pairs in the order of the files, and prints the embedding metrics."""
+    results: List[Optional[Tuple[Any, bool]]] = [None] * len(files)
+
+    async def collect(in_queue: asyncio.Queue):
+        while True:
+            item = await in_queue.get()
+            if item is None:
+                return
+            index, _, outcome = item
+            if isinstance(outcome, Exception):
+                raise outcome
+            results[index] = outcome
+
+    async def run():
+        chunked: asyncio.Queue = asyncio.Queue(maxsize=max_pending_files)
+        embedded: asyncio.Queue = asyncio.Queue()
+        async with EmbeddingService(embedding_model_endpoint, azure_credential=azure_credential) as service:
+            await _run_stages(
+                chunk_stage(files, process_file, executor, chunked, StageStats("Chunking", "files"), max_pending_files),
+                embed_stage(service, chunked, embedded),
+                collect(embedded),
+            )
+        print(service.stats.report(service.concurrency.limit))
+
+    asyncio.run(run())
+    return results
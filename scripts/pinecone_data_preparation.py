@@ -3,7 +3,6 @@ import argparse
 import json
 import os
 import time
-import uuid
 import pinecone
 
 import requests
@@ -14,7 +13,11 @@ from azure.identity import AzureCliCredential
 
 from typing import List
 
-from data_utils import chunk_directory
+from data_utils import assign_chunk_ids, batch_by_size, chunk_directory, send_batches
+
+## Pinecone accepts upserts of up to 2 MB and 1000 vectors
+PINECONE_MAX_REQUEST_BYTES = 2 * 1000 * 1000
+PINECONE_MAX_REQUEST_VECTORS = 1000
 
 SUPPORTED_LANGUAGE_CODES = {
     "ar": "Arabic",
@@ -101,27 +104,28 @@ def create_or_update_vector_search_index(
      
 def upsert_documents_to_index(
         index_name: str,
-        docs: List[Document]
+        docs: List[Document],
+        max_request_bytes: int = PINECONE_MAX_REQUEST_BYTES,
+        max_request_vectors: int = PINECONE_MAX_REQUEST_VECTORS,
+        max_in_flight: int = 4
         ):
-    
+    """Upserts the docs by id in batches sized by their payload, several batches at a time.
+    Returns the ids of the docs that could not be upserted."""
     index = pinecone.Index(index_name)
+    vectors = []
     for document in docs:
-        finalDocChunk:dict = {}
-        finalDocChunk["id"] = f"{uuid.uuid4()}"
-        finalDocChunk['title'] = document.title
-        finalDocChunk["filepath"] = document.filepath
-        finalDocChunk["url"] = ""
-        finalDocChunk["content"] = document.content
-        finalDocChunk["contentvector"] = document.contentVector
-
-        try:
-            index.upsert([(finalDocChunk["id"],finalDocChunk["contentvector"], {"title":finalDocChunk['title'], "filepath":finalDocChunk['filepath'],"url":finalDocChunk['url'],"content":finalDocChunk['content']})])
-
-            print(f"Upsert doc chunk {document.id} successfully")
-        
-        except Exception as e:
-            print(f"Failed to upsert doc chunk {document.id}")
-            continue
+        metadata = {"title": document.title, "filepath": document.filepath, "url": "", "content": document.content}
+        vectors.append((document.id, document.contentVector, metadata))
+
+    sizes = [len(json.dumps({"id": id, "values": values, "metadata": metadata})) + 1 for id, values, metadata in vectors]
+    batches = [vectors[batch.start:batch.stop] for batch in batch_by_size(sizes, max_request_vectors, max_request_bytes)]
+    errors = send_batches(lambda batch: index.upsert(vectors=batch), batches, max_in_flight)
+
+    failed_ids = [id for position, _ in errors for id, _, _ in batches[position]]
+    print(f"Upserted {len(vectors) - len(failed_ids)} doc chunks in {len(batches)} batches")
+    if errors:
+        print(f"Failed to upsert {len(failed_ids)} doc chunks in {len(errors)} batches. Errors: {sorted(set(str(e) for _, e in errors))}")
+    return failed_ids
 
 def validate_index(
         index_name):
@@ -175,9 +179,14 @@ def create_index(config, credential, form_recognizer_client=None, embedding_mode
     print(f"Files with errors: {result.num_files_with_errors} files")
     print(f"Found {len(result.chunks)} chunks")
 
+    # ids derived from the file and the content, so a rerun overwrites the chunks instead of adding copies
+    assign_chunk_ids(result.chunks, namespace=config["data_path"])
+
     # upsert documents to index
     print("Upserting documents to index...")
-    upsert_documents_to_index(index_name, result.chunks)
+    failed_ids = upsert_documents_to_index(index_name, result.chunks)
+    if failed_ids:
+        raise Exception(f"INDEXING FAILED for {len(failed_ids)} documents. Please recreate the index.")
 
     # check if index is ready/validate index
     print("Validating index...")
@@ -2,7 +2,6 @@ import argparse
 import dataclasses
 import time
 
-from tqdm import tqdm
 from azure.identity import AzureDeveloperCliCredential
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.indexes import SearchIndexClient
@@ -24,6 +23,7 @@ from azure.ai.formrecognizer import DocumentAnalysisClient
 
 
 from data_utils import chunk_directory
+from search_uploader import index_documents
 
 
 def create_search_index(index_name, index_client):
@@ -75,7 +75,7 @@ def create_search_index(index_name, index_client):
         print(f"Search index {index_name} already exists")
 
 
-def upload_documents_to_index(docs, search_client, upload_batch_size=50):
+def upload_documents_to_index(docs, search_client, upload_batch_size=None):
     to_upload_dicts = []
 
     id = 0
@@ -88,26 +88,13 @@ def upload_documents_to_index(docs, search_client, upload_batch_size=50):
         to_upload_dicts.append(d)
         id += 1
 
-    # Upload the documents in batches of upload_batch_size
-    for i in tqdm(
-        range(0, len(to_upload_dicts), upload_batch_size), desc="Indexing Chunks..."
-    ):
-        batch = to_upload_dicts[i : i + upload_batch_size]
-        results = search_client.upload_documents(documents=batch)
-        num_failures = 0
-        errors = set()
-        for result in results:
-            if not result.succeeded:
-                print(
-                    f"Indexing Failed for {result.key} with ERROR: {result.error_message}"
-                )
-                num_failures += 1
-                errors.add(result.error_message)
-        if num_failures > 0:
-            raise Exception(
-                f"INDEXING FAILED for {num_failures} documents. Please recreate the index."
-                f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {list(errors)}"
-            )
+    # Upload the documents in requests sized by their serialized bytes, several at a time
+    stats = index_documents(search_client, to_upload_dicts, action="upload", max_request_documents=upload_batch_size)
+    if stats.failures:
+        raise Exception(
+            f"INDEXING FAILED for {len(stats.failures)} documents. Please recreate the index."
+            f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {sorted(set(stats.failures.values()))}"
+        )
 
 
 def validate_index(index_name, index_client):
@@ -0,0 +1,195 @@
+"""Concurrent, throttle aware uploads to an Azure Cognitive Search index.
+
+Documents are packed into requests by their serialized size, below the
+service's limit of 16 MB and 1000 documents per request, and several
+requests are in flight at once. When the service answers with a partial
+success, only the documents that failed with a transient status are sent
+again. Throttling halves the number of requests in flight, which grows back
+while requests succeed, and the retries back off after the server's
+`retry-after` or with exponential backoff and jitter. Documents that still
+fail are reported with their errors instead of stopping the upload.
+"""
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+
+from data_utils import RETRY_COUNT, batch_by_size
+from embedding_service import MAX_BACKOFF_SECONDS, AdaptiveConcurrency, _env_int, _retry_after_seconds, _RetryableError
+
+MAX_REQUEST_DOCUMENTS = 1000
+## the service accepts 16 MB, the rest is left for the request envelope
+MAX_REQUEST_BYTES = 15 * 1024 * 1024
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+## per document statuses of a 207 response worth sending again: version conflict, index busy, throttled
+RETRYABLE_RESULT_STATUS_CODES = {409, 422, 429, 503}
+THROTTLE_STATUS_CODES = {429, 503}
+
+
+def document_size(document: Dict[str, Any]) -> int:
+    """Bytes the document takes in the body of an indexing request."""
+    return len(json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8")) + 1
+
+
+@dataclass
+class UploadStats():
+    documents: int = 0
+    bytes: int = 0
+    requests: int = 0
+    throttled: int = 0
+    retries: int = 0
+    throttle_seconds: float = 0.0
+    ## document key -> error message of the documents that could not be indexed
+    failures: Dict[str, str] = field(default_factory=dict)
+    started: Optional[float] = None
+    finished: float = 0.0
+
+    def report(self, concurrency_limit: Optional[int] = None) -> str:
+        if self.started is None:
+            return "Indexed 0 documents"
+        elapsed = max(self.finished - self.started, 1e-9)
+        lines = [
+            f"Indexed {self.documents} documents ({self.bytes / 1024 / 1024:.1f} MB) in {self.requests} requests over {elapsed:.1f}s",
+            f"Throughput: {self.documents / elapsed:.1f} documents/s",
+            f"Throttled {self.throttled} times, {self.retries} retries, {self.throttle_seconds:.1f}s waiting on throttles",
+        ]
+        if self.failures:
+            lines.append(f"Failed to index {len(self.failures)} documents. Errors: {sorted(set(self.failures.values()))}")
+        if concurrency_limit is not None:
+            lines.append(f"Final concurrency limit: {concurrency_limit}")
+        return "\n".join(lines)
+
+
+class SearchUploader():
+    """Indexes documents with several requests in flight, retrying the documents that failed transiently.
+    Args:
+        search_client (SearchClient): Client of the index.
+        key_field (str): Name of the key field of the index.
+        max_in_flight (int): Most requests in flight, SEARCH_UPLOAD_MAX_IN_FLIGHT by default, else 4.
+        max_request_bytes (int): Most serialized bytes per request, SEARCH_UPLOAD_MAX_BYTES by default.
+        max_request_documents (int): Most documents per request, SEARCH_UPLOAD_BATCH_SIZE by default, else 1000.
+    """
+
+    def __init__(
+        self,
+        search_client,
+        key_field: str = "id",
+        max_in_flight: Optional[int] = None,
+        max_request_bytes: Optional[int] = None,
+        max_request_documents: Optional[int] = None,
+    ):
+        self.search_client = search_client
+        self.key_field = key_field
+        self.concurrency = AdaptiveConcurrency(max_in_flight or _env_int("SEARCH_UPLOAD_MAX_IN_FLIGHT") or 4)
+        self.max_request_bytes = max_request_bytes or _env_int("SEARCH_UPLOAD_MAX_BYTES") or MAX_REQUEST_BYTES
+        self.max_request_documents = min(MAX_REQUEST_DOCUMENTS,
+                                         max_request_documents or _env_int("SEARCH_UPLOAD_BATCH_SIZE") or MAX_REQUEST_DOCUMENTS)
+        self.stats = UploadStats()
+        ## monotonic time before which no request is sent, set by throttle responses
+        self._resume_at = 0.0
+
+    def _send(self, documents: List[Dict[str, Any]], action: str):
+        try:
+            if action == "delete":
+                return self.search_client.delete_documents(documents=documents)
+            if action == "upload":
+                return self.search_client.upload_documents(documents=documents)
+            return self.search_client.merge_or_upload_documents(documents=documents)
+        except HttpResponseError as e:
+            if e.status_code not in RETRYABLE_STATUS_CODES:
+                raise
+            headers = e.response.headers if e.response is not None else None
+            raise _RetryableError(str(e), e.status_code in THROTTLE_STATUS_CODES, _retry_after_seconds(headers))
+        except (ServiceRequestError, ServiceResponseError) as e:
+            raise _RetryableError(str(e), False, None)
+
+    def _record(self, documents: List[Dict[str, Any]], results) -> Tuple[List[Dict[str, Any]], bool]:
+        """Records the results of a request. Returns the documents to send again and whether any was throttled."""
+        by_key = {str(document[self.key_field]): document for document in documents}
+        retry = []
+        throttled = False
+        for result in results:
+            if result.succeeded:
+                self.stats.documents += 1
+                self.stats.failures.pop(result.key, None)
+                continue
+            self.stats.failures[result.key] = result.error_message
+            if result.status_code in RETRYABLE_RESULT_STATUS_CODES and result.key in by_key:
+                retry.append(by_key[result.key])
+                throttled = throttled or result.status_code in THROTTLE_STATUS_CODES
+        return retry, throttled
+
+    async def _index_batch(self, documents: List[Dict[str, Any]], action: str):
+        """Sends documents that fit in one request, then sends again those that failed transiently."""
+        pending = documents
+        for attempt in range(RETRY_COUNT + 1):
+            error = None
+            too_large = None
+            async with self.concurrency:
+                pause = self._resume_at - time.monotonic()
+                if pause > 0:
+                    self.stats.throttle_seconds += pause
+                    await asyncio.sleep(pause)
+                self.stats.requests += 1
+                try:
+                    results = await asyncio.to_thread(self._send, pending, action)
+                except _RetryableError as e:
+                    error = e
+                except HttpResponseError as e:
+                    if e.status_code != 413:
+                        raise
+                    too_large = e
+            if too_large is not None:
+                if len(pending) == 1:
+                    self.stats.failures[str(pending[0][self.key_field])] = too_large.message
+                    return
+                ## larger than the size estimate allowed for, each half goes on its own
+                half = len(pending) // 2
+                await asyncio.gather(self._index_batch(pending[:half], action), self._index_batch(pending[half:], action))
+                return
+            if error is None:
+                pending, throttled = self._record(pending, results)
+                if not pending:
+                    self.concurrency.on_success()
+                    return
+                error = _RetryableError(f"{len(pending)} documents failed transiently", throttled, None)
+            if attempt == RETRY_COUNT:
+                for document in pending:
+                    key = str(document[self.key_field])
+                    self.stats.failures[key] = self.stats.failures.get(key) or str(error)
+                return
+            ## full jitter, unless the server said when to come back
+            delay = error.retry_after if error.retry_after is not None else random.uniform(0, min(MAX_BACKOFF_SECONDS, 2 ** attempt))
+            if error.throttled:
+                self.stats.throttled += 1
+                self.concurrency.on_throttle()
+                self._resume_at = max(self._resume_at, time.monotonic() + delay)
+            self.stats.retries += 1
+            self.stats.throttle_seconds += delay
+            await asyncio.sleep(delay)
+
+    async def index(self, documents: List[Dict[str, Any]], action: str = "merge_or_upload") -> List[Optional[str]]:
+        """Indexes the documents with `action`, one of merge_or_upload, upload or delete, in concurrent requests.
+        Returns the error of each document, None for the documents that were indexed."""
+        if self.stats.started is None:
+            self.stats.started = time.monotonic()
+        sizes = [document_size(document) for document in documents]
+        await asyncio.gather(*[
+            self._index_batch(documents[batch.start:batch.stop], action)
+            for batch in batch_by_size(sizes, self.max_request_documents, self.max_request_bytes)
+        ])
+        self.stats.bytes += sum(sizes)
+        self.stats.finished = time.monotonic()
+        return [self.stats.failures.get(str(document[self.key_field])) for document in documents]
+
+
+def index_documents(search_client, documents: List[Dict[str, Any]], action: str = "merge_or_upload", **options) -> UploadStats:
+    """Indexes the documents with a `SearchUploader` made with `options` and prints its report."""
+    uploader = SearchUploader(search_client, **options)
+    asyncio.run(uploader.index(documents, action))
+    print(uploader.stats.report(uploader.concurrency.limit))
+    return uploader.stats
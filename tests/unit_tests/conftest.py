@@ -0,0 +1,36 @@
+"""Makes the data preparation scripts importable by the unit tests.
+
+The scripts are flat modules in scripts/ that import each other by name. Their
+token estimator loads the gpt2 encoding when data_utils is imported, which is
+downloaded on first use, so the tests give it a small byte level encoding
+instead: every byte is a token and a few common words are merged into one.
+"""
+import os
+import sys
+from unittest import mock
+
+import tiktoken
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "scripts")
+WORDS = "the and of to a in is you that it for on with as are be this by employee employees company policy work".split()
+
+
+def byte_level_encoding() -> tiktoken.Encoding:
+    ranks = {bytes([i]): i for i in range(256)}
+    for word in WORDS:
+        for text in (word, " " + word):
+            encoded = text.encode()
+            for end in range(2, len(encoded) + 1):
+                ranks.setdefault(encoded[:end], len(ranks))
+    return tiktoken.Encoding(
+        "test_byte_level",
+        pat_str=r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""",
+        mergeable_ranks=ranks,
+        special_tokens={"<|endoftext|>": len(ranks)},
+    )
+
+
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
+with mock.patch("tiktoken.get_encoding", return_value=byte_level_encoding()):
+    import data_utils  # noqa: F401
@@ -0,0 +1,103 @@
+import pytest
+from unittest.mock import patch
+
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.metrics import metrics
+
+
+class FakeContainerClient:
+    def __init__(self, request_charge):
+        self.request_charge = request_charge
+        self.items = {}
+
+    def _respond(self, response_hook, result):
+        response_hook(
+            {"x-ms-request-charge": str(self.request_charge), "x-ms-throttle-retry-count": 1},
+            result
+        )
+        return result
+
+    async def upsert_item(self, body, response_hook=None):
+        self.items[body["id"]] = body
+        return self._respond(response_hook, body)
+
+    def query_items(self, query, parameters, response_hook=None):
+        values = {p["name"]: p["value"] for p in parameters}
+        if "c.type = 'usage'" in query:
+            documents = [item for item in self.items.values() if item["type"] == "usage"]
+        else:
+            documents = [
+                item for item in self.items.values()
+                if item["id"] == values.get("@conversationId") and item["type"] == "conversation"
+            ]
+        stats = self
+
+        class Pager:
+            def __aiter__(self):
+                stats._respond(response_hook, {"Documents": documents})
+                return iter_documents()
+
+        async def iter_documents():
+            for document in documents:
+                yield document
+
+        return Pager()
+
+
+@pytest.fixture
+def cosmos_client():
+    with patch("backend.history.cosmosdbservice.CosmosClient"):
+        client = CosmosConversationClient("https://account", "key", "db", "conversations")
+    client.container_client = FakeContainerClient(request_charge=5.5)
+    return client
+
+
+def _histogram_state(name, operation):
+    return metrics.metrics[name].values[(operation, "none")]
+
+
+@pytest.mark.asyncio
+async def test_nested_calls_roll_up_into_outer_operation(cosmos_client):
+    conversation = await cosmos_client.create_conversation("user-1", title="hello")
+    count_before = metrics.metrics["cosmos_request_charge"].values.get(("create_message", "none"), [0])[-1]
+
+    await cosmos_client.create_message("m1", conversation["id"], "user-1", {"role": "user", "content": "hi"})
+
+    ## upsert message + get_conversation query + upsert conversation, recorded once
+    state = _histogram_state("cosmos_request_charge", "create_message")
+    assert state[-1] == count_before + 1
+    assert ("get_conversation", "none") not in metrics.metrics["cosmos_request_charge"].values
+    assert metrics.metrics["cosmos_throttle_retries_total"].values[("create_message", "none")] >= 3
+
+    rendered = metrics.render()
+    assert '# TYPE cosmos_request_charge histogram' in rendered
+    assert 'cosmos_operations_total{operation="create_message",route="none",status="ok"}' in rendered
+
+
+@pytest.mark.asyncio
+async def test_request_charge_logged_above_threshold(cosmos_client, caplog):
+    cosmos_client.request_charge_log_threshold = 5
+    with caplog.at_level("INFO"):
+        await cosmos_client.create_conversation("user-1")
+    assert "CosmosDB create_conversation on none: 5.50 RU" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_import_cannot_replace_usage_documents(cosmos_client):
+    usage = {
+        "id": "usage-2026-10-19", "type": "usage", "userId": "user-1", "day": "2026-10-19",
+        "prompt_tokens": 900, "completion_tokens": 100, "requests": 3
+    }
+    cosmos_client.container_client.items[usage["id"]] = dict(usage)
+    before = await cosmos_client.get_usage(user_id="user-1")
+
+    imported = await cosmos_client.import_documents("user-1", [
+        {"type": "conversation", "id": "usage-2026-10-19", "userId": "user-1",
+         "createdAt": "2026-10-19T00:00:00", "updatedAt": "2026-10-19T00:00:00"},
+        {"type": "conversation", "id": "conversation-1", "userId": "user-1",
+         "createdAt": "2026-10-19T00:00:00", "updatedAt": "2026-10-19T00:00:00"},
+    ])
+
+    assert imported == 1
+    assert await cosmos_client.get_usage(user_id="user-1") == before == [usage]
+    assert "conversation-1" in cosmos_client.container_client.items
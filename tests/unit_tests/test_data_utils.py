@@ -0,0 +1,251 @@
+import io
+import json
+import random
+import re
+import urllib.error
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+import data_utils
+from data_utils import (
+    TOKEN_ESTIMATOR,
+    Document,
+    PdfTextSplitter,
+    TokenOffsetTextSplitter,
+    assign_chunk_ids,
+    batch_by_size,
+    find_table_headers,
+    merge_chunks_serially,
+)
+
+
+def pdf_splitter(chunk_size=200):
+    return PdfTextSplitter(separator=data_utils.SENTENCE_ENDINGS + data_utils.WORDS_BREAKS, chunk_size=chunk_size, chunk_overlap=0)
+
+
+def test_batch_by_size_respects_both_limits_in_order():
+    sizes = [3, 3, 3, 9, 1, 1, 1, 1, 20, 2]
+    batches = list(batch_by_size(sizes, max_items=3, max_size=8))
+
+    assert [index for batch in batches for index in batch] == list(range(len(sizes)))
+    assert batches == [range(0, 2), range(2, 3), range(3, 4), range(4, 7), range(7, 8), range(8, 9), range(9, 10)]
+    for batch in batches:
+        assert len(batch) <= 3
+        ## only an item larger than the limit goes over it, on its own
+        assert sum(sizes[i] for i in batch) <= 8 or len(batch) == 1
+
+
+def test_batch_by_size_of_nothing():
+    assert list(batch_by_size([], max_items=3, max_size=8)) == []
+
+
+def test_assign_chunk_ids_is_stable_and_tells_identical_chunks_apart():
+    def chunks():
+        return [Document(content="a", filepath="x.md"), Document(content="a", filepath="x.md"),
+                Document(content="a", filepath="y.md"), Document(content="b", filepath="x.md")]
+
+    ids = [chunk.id for chunk in assign_chunk_ids(chunks(), namespace="data")]
+    assert len(set(ids)) == 4
+    assert ids == [chunk.id for chunk in assign_chunk_ids(chunks(), namespace="data")]
+    assert set(ids).isdisjoint(chunk.id for chunk in assign_chunk_ids(chunks(), namespace="other"))
+
+
+@pytest.mark.parametrize("table", [
+    "<table><tr><th>a</th><th>b</th></tr><tr><td>1</td></tr></table>",
+    '<table><th colspan="2">a</th>\n<tr><th>b</th></table>',
+    "<table><th>a\n</th><th>b</th></table>",
+    "<table><thead><tr><td>no headers</td></tr></table>",
+    "<th></th>",
+    "",
+])
+def test_find_table_headers_matches_the_regex(table):
+    match = re.search("<th.*>.*</th>", table)
+    assert find_table_headers(table) == (match.group() if match else "")
+
+
+def test_find_table_headers_matches_the_regex_on_random_tables():
+    random.seed(7)
+    pieces = ["<th>", "<th", "</th>", ">", "a", "\n", "<td>", "</td>", "<tr>"]
+    for _ in range(500):
+        table = "".join(random.choice(pieces) for _ in range(random.randint(0, 30)))
+        match = re.search("<th.*>.*</th>", table)
+        assert find_table_headers(table) == (match.group() if match else ""), table
+
+
+def test_chunk_table_keeps_a_small_table_whole():
+    table = "<table><tr><th>name</th></tr><tr><td>policy</td></tr></table>"
+    assert pdf_splitter().chunk_table(table, "Caption") == ["Caption\n" + table]
+
+
+def test_chunk_table_repeats_headers_and_never_splits_a_row():
+    rows = [f"<tr><td>employee {i} of the company</td><td>policy {i}</td></tr>" for i in range(60)]
+    table = "<table><tr><th>name</th><th>policy</th></tr>" + "".join(rows) + "</table>"
+    minitables = pdf_splitter(chunk_size=120).chunk_table(table, "Caption")
+
+    assert len(minitables) > 1
+    for minitable in minitables:
+        assert minitable.startswith("Caption\n")
+        assert "<th>name</th><th>policy</th>" in minitable
+        assert minitable.endswith("</table>")
+        assert "<td>" in minitable
+    ## every row is in exactly one mini-table
+    assert sum(minitable.count("<td>employee") for minitable in minitables) == len(rows)
+    assert all(minitable.count("<tr>") == minitable.count("</tr>") for minitable in minitables)
+
+
+def test_mask_urls_and_imgs_round_trips():
+    text = ('See https://contoso.com/a(b) and www.example.org, then <img src="IMG_1.jpg">a figure at '
+            'https://contoso.com/figure</img> and https://contoso.com/a(b) again.')
+    content_dict, masked = pdf_splitter().mask_urls_and_imgs(text)
+
+    assert masked == "See ##URL0## and ##URL1##, then ##IMG0## and ##URL0## again."
+    assert content_dict == {
+        "##URL0##": "https://contoso.com/a(b)",
+        "##URL1##": "www.example.org",
+        "##IMG0##": '<img src="IMG_1.jpg">a figure at https://contoso.com/figure</img>',
+    }
+    assert data_utils.MASK_PLACEHOLDER_PATTERN.sub(lambda match: content_dict[match.group()], masked) == text
+
+
+def test_pdf_splitter_keeps_urls_whole():
+    url = "https://contoso.com/" + "policy/" * 30
+    text = ("The employee policy is on the work of the company. " * 10 + url + " ") * 3
+    chunks = pdf_splitter(chunk_size=120).split_text(text)
+
+    assert "".join(chunks) == text
+    assert sum(chunk.count(url) for chunk in chunks) == 3
+
+
+@pytest.mark.parametrize("text", ["😀", "日本語の", "the 😀 and 日本語の policy."])
+def test_token_offset_splitter_counts_every_byte_of_multibyte_characters(text):
+    splitter = TokenOffsetTextSplitter(chunk_size=1000, chunk_overlap=0)
+    assert splitter.split_text_with_token_counts(text) == [(text, TOKEN_ESTIMATOR.estimate_tokens(text))]
+
+
+@pytest.mark.parametrize("chunk_size,chunk_overlap", [(5, 0), (7, 3), (16, 4)])
+def test_token_offset_splitter_never_splits_a_character(chunk_size, chunk_overlap):
+    text = "the employee 日本語の policy 😀 is on the work 😀😀 of the company. " * 5
+    tokens = TOKEN_ESTIMATOR.encode(text)
+    splitter = TokenOffsetTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, strip_whitespace=False)
+    chunks = splitter.split_text_with_token_counts(text, tokens)
+
+    position = 0
+    for chunk, count in chunks:
+        assert 0 < count <= chunk_size
+        assert count == TOKEN_ESTIMATOR.estimate_tokens(chunk)
+        ## chunks are slices of the text, and the next one starts in the previous one when they overlap
+        start = text.index(chunk, max(0, position - len(chunk)))
+        assert start <= position
+        position = start + len(chunk)
+    assert position == len(text)
+    if chunk_overlap == 0:
+        assert "".join(chunk for chunk, _ in chunks) == text
+
+
+def test_token_offset_splitter_counts_stripped_chunks():
+    text = "  日本語の policy.  \n\n the 😀 work.  "
+    splitter = TokenOffsetTextSplitter(chunk_size=24, chunk_overlap=0)
+    for chunk, count in splitter.split_text_with_token_counts(text):
+        assert chunk == chunk.strip()
+        assert count == TOKEN_ESTIMATOR.estimate_tokens(chunk)
+
+
+def test_merge_chunks_serially_uses_known_counts_and_recounts_unmasked_pieces():
+    pieces = [("the work", 2), ("##URL0## policy", 3), "of the company"]
+    content_dict = {"##URL0##": "https://contoso.com/policy"}
+    with mock.patch.object(data_utils.TOKEN_ESTIMATOR, "estimate_tokens", wraps=TOKEN_ESTIMATOR.estimate_tokens) as estimate:
+        merged = list(merge_chunks_serially(pieces, 1000, content_dict))
+
+    assert [call.args[0] for call in estimate.call_args_list] == ["https://contoso.com/policy policy", "of the company"]
+    assert merged == [("the workhttps://contoso.com/policy policyof the company",
+                       2 + TOKEN_ESTIMATOR.estimate_tokens("https://contoso.com/policy policy") + TOKEN_ESTIMATOR.estimate_tokens("of the company"))]
+
+
+def test_pdf_splitter_counts_text_pieces_once():
+    text = "The employee policy is on the work of the company. " * 40
+    splitter = PdfTextSplitter(separator=data_utils.SENTENCE_ENDINGS + data_utils.WORDS_BREAKS, chunk_size=120, chunk_overlap=0)
+    with mock.patch.object(data_utils.TOKEN_ESTIMATOR, "estimate_tokens", wraps=TOKEN_ESTIMATOR.estimate_tokens) as estimate:
+        chunks = splitter.split_text_with_token_counts(text)
+
+    assert estimate.call_count == 0
+    assert "".join(chunk for chunk, _ in chunks) == text
+    assert all(count <= 120 for _, count in chunks)
+
+
+AOAI_ENDPOINT = "https://aoai.openai.azure.com/openai/deployments/embedding/embeddings?api-version=2024-02-01"
+
+
+class FakeEmbeddingsClient():
+    """Answers with the length of each input as its vector, with the items in reverse order."""
+
+    def __init__(self):
+        self.inputs = []
+        self.embeddings = self
+
+    def create(self, model, input, **options):
+        self.inputs.append(list(input))
+        data = [SimpleNamespace(index=i, embedding=[float(len(text))]) for i, text in enumerate(input)]
+        return SimpleNamespace(data=list(reversed(data)))
+
+
+@pytest.fixture
+def no_embedding_cache(monkeypatch):
+    monkeypatch.setenv("EMBEDDING_CACHE_PATH", "")
+
+
+def test_get_embeddings_packs_batches_by_inputs_and_tokens(monkeypatch, no_embedding_cache):
+    client = FakeEmbeddingsClient()
+    monkeypatch.setattr(data_utils, "get_embedding_client", lambda *args, **kwargs: client)
+    monkeypatch.setenv("FLAG_EMBEDDING_MODEL", "AOAI")
+    monkeypatch.setenv("EMBEDDING_BATCH_SIZE", "3")
+    monkeypatch.setenv("EMBEDDING_BATCH_MAX_TOKENS", "10")
+    texts = ["a", "bb", "ccc", "dddd", "eeeee", "f", "g"]
+
+    embeddings = data_utils.get_embeddings(texts, AOAI_ENDPOINT, "key", token_counts=[len(text) for text in texts])
+
+    ## order restored from item.index
+    assert embeddings == [[float(len(text))] for text in texts]
+    assert client.inputs == [["a", "bb", "ccc"], ["dddd", "eeeee", "f"], ["g"]]
+
+
+def test_get_embeddings_with_cohere_retries_after_throttles(monkeypatch, no_embedding_cache):
+    monkeypatch.setenv("FLAG_EMBEDDING_MODEL", "COHERE")
+    monkeypatch.setenv("EMBEDDING_BATCH_SIZE", "2")
+    requests = []
+    statuses = [429, 503]
+    sleeps = []
+
+    def urlopen(request):
+        texts = json.loads(request.data)["texts"]
+        requests.append(texts)
+        if statuses:
+            status = statuses.pop(0)
+            headers = {"retry-after": "7"} if status == 429 else {}
+            raise urllib.error.HTTPError(request.full_url, status, "throttled", headers, None)
+        return io.BytesIO(json.dumps({"embeddings": [[float(len(text))] for text in texts]}).encode())
+
+    monkeypatch.setattr(data_utils.urllib.request, "urlopen", urlopen)
+    monkeypatch.setattr(data_utils.time, "sleep", sleeps.append)
+
+    embeddings = data_utils.get_embeddings(["a", "bb", "ccc"], "https://cohere.example.com/embed", "cohere-key")
+
+    assert embeddings == [[1.0], [2.0], [3.0]]
+    assert requests == [["a", "bb"], ["a", "bb"], ["a", "bb"], ["ccc"]]
+    ## the server's retry-after, then exponential backoff
+    assert sleeps == [7.0, 2]
+
+
+def test_get_embeddings_with_cohere_does_not_retry_client_errors(monkeypatch, no_embedding_cache):
+    monkeypatch.setenv("FLAG_EMBEDDING_MODEL", "COHERE")
+    calls = []
+
+    def urlopen(request):
+        calls.append(request)
+        raise urllib.error.HTTPError(request.full_url, 400, "bad request", {}, None)
+
+    monkeypatch.setattr(data_utils.urllib.request, "urlopen", urlopen)
+    with pytest.raises(Exception, match="400"):
+        data_utils.get_embeddings(["a"], "https://cohere.example.com/embed", "cohere-key")
+    assert len(calls) == 1
@@ -0,0 +1,66 @@
+import time
+from array import array
+from types import SimpleNamespace
+
+import pytest
+
+import data_utils
+from embedding_cache import SECONDS_PER_DAY, EmbeddingCache, cache_key
+
+AOAI_ENDPOINT = "https://aoai.openai.azure.com/openai/deployments/embedding/embeddings?api-version=2024-02-01"
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite3"))
+    yield cache
+    cache.close()
+
+
+def test_put_many_then_get_many_round_trips_as_float32(cache):
+    keys = [cache_key("embedding", None, text) for text in ("a", "b", "c")]
+    cache.put_many(keys[:2], [[0.1, 1.5], [-2.0, 0.3]])
+
+    assert cache.get_many(keys) == [array("f", [0.1, 1.5]).tolist(), array("f", [-2.0, 0.3]).tolist(), None]
+    ## four bytes per dimension
+    assert [len(vector) for vector, in cache._connection.execute("SELECT vector FROM embeddings")] == [8, 8]
+    assert cache.stats()["entries"] == 2
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_keys_depend_on_deployment_and_dimensions():
+    assert len({cache_key("a", None, "text"), cache_key("b", None, "text"), cache_key("a", 256, "text")}) == 3
+
+
+def test_compact_deletes_only_stale_entries(cache):
+    stale, fresh = cache_key("embedding", None, "stale"), cache_key("embedding", None, "fresh")
+    cache.put_many([stale, fresh], [[1.0], [2.0]])
+    today = int(time.time()) // SECONDS_PER_DAY
+    with cache._connection:
+        cache._connection.execute("UPDATE embeddings SET last_used = ? WHERE key = ?", (today - 31, stale))
+
+    assert cache.compact(older_than_days=30) == 1
+    assert cache.get_many([stale, fresh]) == [None, [2.0]]
+    assert cache.compact(older_than_days=30) == 0
+
+
+class FakeEmbeddingsClient():
+    def __init__(self):
+        self.inputs = []
+        self.embeddings = self
+
+    def create(self, model, input, **options):
+        self.inputs.append(list(input))
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=[float(len(text))]) for i, text in enumerate(input)])
+
+
+def test_get_embeddings_only_requests_texts_not_in_the_cache(monkeypatch, tmp_path):
+    client = FakeEmbeddingsClient()
+    monkeypatch.setattr(data_utils, "get_embedding_client", lambda *args, **kwargs: client)
+    monkeypatch.setenv("FLAG_EMBEDDING_MODEL", "AOAI")
+    monkeypatch.setenv("EMBEDDING_CACHE_PATH", str(tmp_path / "embeddings.sqlite3"))
+
+    ## a repeated text is requested once
+    assert data_utils.get_embeddings(["a", "bb", "a"], AOAI_ENDPOINT, "key") == [[1.0], [2.0], [1.0]]
+    assert data_utils.get_embeddings(["bb", "ccc", "ccc"], AOAI_ENDPOINT, "key") == [[2.0], [3.0], [3.0]]
+    assert client.inputs == [["a", "bb"], ["ccc"]]
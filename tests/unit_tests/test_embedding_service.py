@@ -0,0 +1,121 @@
+import asyncio
+import time
+
+import pytest
+
+from data_utils import ChunkingResult, Document
+from embedding_service import AdaptiveConcurrency, TokenBucket, embed_stage
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_allows_a_burst_then_paces():
+    bucket = TokenBucket(per_minute=600, burst_seconds=0.1)
+    assert bucket.capacity == 1.0
+    assert await bucket.acquire() == 0
+
+    started = time.monotonic()
+    waited = await bucket.acquire()
+    assert waited == pytest.approx(0.1, abs=0.02)
+    assert time.monotonic() - started >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_caps_requests_larger_than_the_burst():
+    bucket = TokenBucket(per_minute=60000, burst_seconds=0.01)
+    ## waits for a full bucket rather than forever
+    assert await asyncio.wait_for(bucket.acquire(10 * bucket.capacity), timeout=1) < 0.1
+
+
+@pytest.mark.asyncio
+async def test_adaptive_concurrency_limits_in_flight_and_adapts():
+    concurrency = AdaptiveConcurrency(4)
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        async with concurrency:
+            peak = max(peak, concurrency.in_flight)
+            await asyncio.sleep(0.001)
+
+    await asyncio.gather(*[request() for _ in range(20)])
+    assert peak == 4 and concurrency.in_flight == 0
+
+    concurrency.on_throttle()
+    assert concurrency.limit == 2
+    concurrency.on_throttle()
+    concurrency.on_throttle()
+    assert concurrency.limit == 1
+    ## grows by one after limit successes, up to the maximum
+    concurrency.on_success()
+    assert concurrency.limit == 2
+    for _ in range(20):
+        concurrency.on_success()
+    assert concurrency.limit == 4
+
+
+class StubEmbeddingService():
+    def __init__(self, fail_on=None, max_inputs=2, max_tokens=1000, concurrency=2):
+        self.fail_on = fail_on
+        self.max_inputs = max_inputs
+        self.max_tokens = max_tokens
+        self.concurrency = AdaptiveConcurrency(concurrency)
+        self.batches = []
+
+    def lookup(self, texts):
+        return [None] * len(texts)
+
+    async def embed_batch(self, texts, token_count):
+        self.batches.append(texts)
+        await asyncio.sleep(0)
+        if self.fail_on in texts:
+            raise ValueError(f"400 Bad Request: {self.fail_on}")
+        return [[float(len(text))] for text in texts]
+
+
+def chunked_file(index, *contents):
+    result = ChunkingResult(chunks=[Document(content=content) for content in contents], total_files=1,
+                            token_counts=[len(content) for content in contents])
+    return (index, f"file_{index}.txt", (result, False))
+
+
+async def run_embed_stage(service, items):
+    in_queue, out_queue = asyncio.Queue(), asyncio.Queue()
+
+    async def chunker():
+        ## files arrive over time, so batches finish while the stage still reads its input
+        for item in items + [None]:
+            await asyncio.sleep(0.01)
+            await in_queue.put(item)
+
+    await asyncio.gather(chunker(), embed_stage(service, in_queue, out_queue))
+    forwarded = []
+    while (item := out_queue.get_nowait()) is not None:
+        forwarded.append(item)
+    return forwarded
+
+
+@pytest.mark.asyncio
+async def test_embed_stage_forwards_files_once_all_chunks_have_vectors():
+    service = StubEmbeddingService()
+    forwarded = await run_embed_stage(service, [chunked_file(0, "a", "bb", "ccc"), chunked_file(1, "dddd")])
+
+    assert sorted(index for index, _, _ in forwarded) == [0, 1]
+    for _, _, (result, is_error) in forwarded:
+        assert not is_error
+        assert [document.contentVector for document in result.chunks] == [[float(len(d.content))] for d in result.chunks]
+    assert all(len(batch) <= service.max_inputs for batch in service.batches)
+
+
+@pytest.mark.asyncio
+async def test_embed_stage_raises_the_error_of_a_failed_batch():
+    service = StubEmbeddingService(fail_on="bb")
+    with pytest.raises(ValueError, match="400 Bad Request"):
+        await run_embed_stage(service, [chunked_file(0, "a", "bb", "ccc"), chunked_file(1, "dddd")])
+
+
+@pytest.mark.asyncio
+async def test_embed_stage_raises_a_failure_seen_while_waiting_on_the_backlog():
+    service = StubEmbeddingService(fail_on="x0", max_inputs=1, concurrency=1)
+    items = [chunked_file(index, f"x{index}") for index in range(10)]
+    with pytest.raises(ValueError, match="400 Bad Request"):
+        await run_embed_stage(service, items)
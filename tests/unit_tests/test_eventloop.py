@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+import pytest
+
+from backend.eventloop import (
+    BLOCKING_CALLS,
+    EVENT_LOOP_STALLS,
+    EventLoopWatchdog,
+    install_blocking_call_detector,
+    uninstall_blocking_call_detector,
+)
+
+
+def blocking_handler():
+    time.sleep(0.3)
+
+
+@pytest.mark.asyncio
+async def test_watchdog_logs_stack_of_blocking_code(caplog):
+    watchdog = EventLoopWatchdog(threshold=0.1, interval=0.02)
+    stalls_before = EVENT_LOOP_STALLS.values.get((), 0)
+    task = asyncio.create_task(watchdog.run())
+    await asyncio.sleep(0.05)
+
+    with caplog.at_level("WARNING"):
+        blocking_handler()
+        await asyncio.sleep(0.1)
+    task.cancel()
+
+    assert EVENT_LOOP_STALLS.values[()] == stalls_before + 1
+    assert "Event loop was blocked for" in caplog.text
+    assert "in blocking_handler" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_blocking_call_detector_flags_calls_on_the_loop_thread(caplog):
+    install_blocking_call_detector()
+    count_before = BLOCKING_CALLS.values.get(("time.sleep",), 0)
+
+    try:
+        with caplog.at_level("WARNING"):
+            time.sleep(0)
+            await asyncio.get_running_loop().run_in_executor(None, time.sleep, 0)
+    finally:
+        uninstall_blocking_call_detector()
+
+    assert BLOCKING_CALLS.values[("time.sleep",)] == count_before + 1
+    assert "Blocking call time.sleep on the event loop thread" in caplog.text
+    assert "test_blocking_call_detector_flags_calls_on_the_loop_thread" in caplog.text
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from backend.health import DEPENDENCY_UP, HealthMonitor
+
+
+@pytest.mark.asyncio
+async def test_ready_after_warm_up_even_if_a_dependency_fails():
+    calls = []
+
+    async def healthy():
+        calls.append("healthy")
+
+    async def broken():
+        raise ConnectionError("connection refused")
+
+    monitor = HealthMonitor()
+    monitor.register("openai", healthy)
+    monitor.register("history", broken)
+    assert monitor.ready is False
+
+    await monitor.warm_up()
+
+    snapshot = monitor.snapshot()
+    assert monitor.ready is True
+    assert snapshot["status"] == "degraded"
+    assert snapshot["dependencies"]["openai"]["status"] == "ok"
+    assert snapshot["dependencies"]["history"]["status"] == "error"
+    assert snapshot["dependencies"]["history"]["error"] == "ConnectionError: connection refused"
+    assert DEPENDENCY_UP.values[("history",)] == 0
+
+    ## probes read the cached status without running the checks again
+    monitor.snapshot()
+    assert calls == ["healthy"]
+
+
+@pytest.mark.asyncio
+async def test_slow_checks_time_out_and_the_status_is_refreshed():
+    state = {"delay": 1.0}
+
+    async def slow():
+        await asyncio.sleep(state["delay"])
+
+    monitor = HealthMonitor(timeout=0.05)
+    monitor.register("foundry", slow)
+    task = asyncio.create_task(monitor.run(interval=0.05, warmup_timeout=5))
+    try:
+        await asyncio.sleep(0.08)
+        assert monitor.ready is True
+        assert monitor.status["foundry"]["error"].startswith("TimeoutError")
+
+        state["delay"] = 0
+        await asyncio.sleep(0.1)
+        assert monitor.snapshot()["status"] == "ok"
+    finally:
+        task.cancel()
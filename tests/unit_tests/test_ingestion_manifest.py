@@ -0,0 +1,59 @@
+import os
+
+from ingestion_manifest import IngestionManifest
+
+
+def write(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+    return str(path)
+
+
+def test_plan_finds_added_changed_touched_and_removed_files(tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    kept = write(data / "kept.md", "kept")
+    touched = write(data / "touched.md", "touched")
+    changed = write(data / "changed.md", "before")
+    removed = write(data / "removed.md", "removed")
+    manifest_path = str(tmp_path / "manifest.json")
+
+    manifest = IngestionManifest(manifest_path)
+    plan = manifest.plan("data", str(data), [kept, touched, changed, removed])
+    assert sorted(plan.changed) == sorted([kept, touched, changed, removed])
+    for file_path in plan.changed:
+        rel_path = os.path.relpath(file_path, data)
+        assert manifest.record_file("data", rel_path, plan.states[rel_path], [f"{rel_path}-0", f"{rel_path}-1"]) == []
+    manifest.save()
+
+    write(changed, "after, and longer")
+    os.utime(touched, ns=(0, 0))
+    os.remove(removed)
+    added = write(data / "added.md", "added")
+
+    manifest = IngestionManifest(manifest_path)
+    plan = manifest.plan("data", str(data), [kept, touched, changed, added])
+    assert sorted(plan.changed) == sorted([changed, added])
+    ## kept is skipped on size and mtime, touched on its unchanged hash
+    assert plan.unchanged == 2
+    assert plan.removed == ["removed.md"]
+    assert manifest.chunk_ids("data", "touched.md") == ["touched.md-0", "touched.md-1"]
+
+    assert manifest.record_file("data", "changed.md", plan.states["changed.md"], ["changed.md-0"]) == ["changed.md-1"]
+    assert manifest.remove_files("data", plan.removed) == ["removed.md-0", "removed.md-1"]
+    assert manifest.chunk_ids("data", "removed.md") == []
+
+
+def test_sources_are_planned_separately(tmp_path):
+    file_path = write(tmp_path / "a.md", "a")
+    manifest = IngestionManifest(str(tmp_path / "manifest.json"))
+    plan = manifest.plan("first", str(tmp_path), [file_path])
+    manifest.record_file("first", "a.md", plan.states["a.md"], ["id"])
+
+    assert manifest.plan("first", str(tmp_path), [file_path]).changed == []
+    assert manifest.plan("second", str(tmp_path), [file_path]).changed == [file_path]
+
+
+def test_unsupported_manifest_version_is_ignored(tmp_path):
+    manifest_path = write(tmp_path / "manifest.json", '{"version": 0, "sources": {"data": {}}}')
+    assert IngestionManifest(manifest_path).sources == {}
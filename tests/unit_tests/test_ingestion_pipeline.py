@@ -0,0 +1,114 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from data_utils import ChunkingResult, Document, assign_chunk_ids
+from ingestion_pipeline import StageStats, chunk_stage, upload_stage
+
+
+@pytest.mark.asyncio
+async def test_chunk_stage_holds_at_most_max_pending_files_with_a_stalled_consumer():
+    processed = []
+
+    def process_file(file_path):
+        processed.append(file_path)
+        return file_path, False
+
+    out_queue = asyncio.Queue(maxsize=4)
+    with ThreadPoolExecutor(4) as executor:
+        stage = asyncio.create_task(chunk_stage([f"file_{i}" for i in range(1000)], process_file, executor, out_queue,
+                                                StageStats("Chunking", "files"), max_pending_files=4))
+        await asyncio.sleep(0.2)
+        ## four results in the queue and four chunked files waiting to be put on it
+        assert len(processed) <= 8
+        stage.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await stage
+
+
+@pytest.mark.asyncio
+async def test_chunk_stage_passes_on_every_file_and_its_errors():
+    def process_file(file_path):
+        if file_path == "file_3":
+            raise ValueError("unreadable")
+        return file_path, False
+
+    out_queue = asyncio.Queue(maxsize=2)
+    received = []
+
+    async def consume():
+        while (item := await out_queue.get()) is not None:
+            received.append(item)
+
+    with ThreadPoolExecutor(2) as executor:
+        await asyncio.gather(
+            chunk_stage([f"file_{i}" for i in range(20)], process_file, executor, out_queue,
+                        StageStats("Chunking", "files"), max_pending_files=3),
+            consume(),
+        )
+
+    assert sorted(index for index, _, _ in received) == list(range(20))
+    outcomes = {file_path: outcome for _, file_path, outcome in received}
+    assert isinstance(outcomes["file_3"], ValueError)
+    assert outcomes["file_4"] == ("file_4", False)
+
+
+def chunked(index, *contents, is_error=False):
+    result = ChunkingResult(chunks=[Document(content=content) for content in contents], total_files=1)
+    return (index, f"file_{index}", (result, is_error))
+
+
+async def run_upload_stage(items, send, batch_size=2, max_in_flight=2):
+    in_queue = asyncio.Queue()
+    for item in items + [None]:
+        in_queue.put_nowait(item)
+    done = {}
+    stats = StageStats("Uploading", "chunks")
+    await upload_stage(in_queue, send, stats, batch_size, prepare=lambda result: assign_chunk_ids(result.chunks),
+                       on_file_done=lambda file_path, outcome: done.__setitem__(file_path, outcome[1]), max_in_flight=max_in_flight)
+    return done, stats
+
+
+@pytest.mark.asyncio
+async def test_upload_stage_sends_batches_and_reports_files_with_failed_chunks():
+    sent = []
+    in_flight = 0
+    peak = 0
+
+    async def send(documents):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.001)
+        in_flight -= 1
+        sent.append([document.content for document in documents])
+        return ["rejected" if document.content == "bad" else None for document in documents]
+
+    done, stats = await run_upload_stage([
+        chunked(0, "a", "b", "c"), chunked(1, "bad", "d"), chunked(2, is_error=True), chunked(3, "e"),
+    ], send)
+
+    assert sorted(content for batch in sent for content in batch) == ["a", "b", "bad", "c", "d", "e"]
+    assert all(len(batch) <= 2 for batch in sent)
+    assert peak <= 2
+    assert done == {"file_0": False, "file_1": True, "file_2": True, "file_3": False}
+    assert stats.items == 6
+
+
+@pytest.mark.asyncio
+async def test_upload_stage_raises_the_error_of_a_failed_batch():
+    async def send(documents):
+        raise ConnectionError("search service unreachable")
+
+    with pytest.raises(ConnectionError):
+        await run_upload_stage([chunked(0, "a", "b"), chunked(1, "c")], send)
+
+
+@pytest.mark.asyncio
+async def test_upload_stage_raises_a_chunking_error():
+    async def send(documents):
+        return None
+
+    with pytest.raises(ValueError, match="unreadable"):
+        await run_upload_stage([(0, "file_0", ValueError("unreadable"))], send)
@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+
+import pytest
+
+from backend.metrics import MetricsRegistry
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value, route="/conversation")
+
+    rendered = registry.render()
+    assert 'latency_seconds_bucket{route="/conversation",le="0.1"} 2' in rendered
+    assert 'latency_seconds_bucket{route="/conversation",le="1"} 3' in rendered
+    assert 'latency_seconds_bucket{route="/conversation",le="+Inf"} 4' in rendered
+    assert 'latency_seconds_count{route="/conversation"} 4' in rendered
+
+
+def test_multiprocess_snapshots_are_merged(tmp_path):
+    registry = MetricsRegistry()
+    registry.enable_multiprocess(str(tmp_path))
+    registry.counter("requests_total", "Requests", ("route",)).inc(2, route="/conversation")
+    registry.gauge("streams_in_flight", "Streams").inc(1)
+
+    ## a snapshot left behind by another worker that has since exited
+    other = MetricsRegistry()
+    other.counter("requests_total", "Requests", ("route",)).inc(3, route="/conversation")
+    other.gauge("streams_in_flight", "Streams").inc(4)
+    snapshot = other.snapshot()
+    snapshot["pid"] = 2 ** 22 + 1
+    with open(os.path.join(tmp_path, f"metrics_{snapshot['pid']}.json"), "w") as f:
+        json.dump(snapshot, f)
+
+    rendered = registry.render()
+    assert 'requests_total{route="/conversation"} 5' in rendered
+    assert "streams_in_flight 1" in rendered
+
+
+@pytest.mark.asyncio
+async def test_render_async_merges_snapshots_in_a_thread(tmp_path, monkeypatch):
+    registry = MetricsRegistry()
+    registry.enable_multiprocess(str(tmp_path))
+    registry.counter("requests_total", "Requests").inc(2)
+    threads = []
+    merged_metrics = registry._merged_metrics
+
+    def tracking_merged_metrics(snapshot):
+        threads.append(threading.current_thread())
+        return merged_metrics(snapshot)
+
+    monkeypatch.setattr(registry, "_merged_metrics", tracking_merged_metrics)
+
+    assert "requests_total 2" in await registry.render_async()
+    assert threads and threads[0] is not threading.main_thread()
+    assert os.path.exists(os.path.join(tmp_path, f"metrics_{os.getpid()}.json"))
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_requires_the_token(monkeypatch):
+    from app import app_settings, create_app
+
+    client = create_app().test_client()
+    monkeypatch.setattr(app_settings.base_settings, "metrics_token", None)
+    assert (await client.get("/metrics")).status_code == 404
+
+    monkeypatch.setattr(app_settings.base_settings, "metrics_token", "scrape-secret")
+    assert (await client.get("/metrics")).status_code == 401
+    assert (await client.get("/metrics", headers={"Authorization": "Bearer wrong"})).status_code == 401
+    response = await client.get("/metrics", headers={"Authorization": "Bearer scrape-secret"})
+    assert response.status_code == 200
+    assert "# TYPE" in (await response.get_data(as_text=True))
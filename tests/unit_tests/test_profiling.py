@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+import pytest
+
+from backend.profiling import RequestProfilerMiddleware, sign_profile_request, verify_profile_request
+
+SECRET = "profiling-secret"
+
+
+async def streaming_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json-lines")]})
+    for i in range(3):
+        await asyncio.sleep(0.01)
+        sum(range(20000))
+        await send({"type": "http.response.body", "body": f"{i}\n".encode(), "more_body": True})
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def call(app, headers):
+    scope = {"type": "http", "method": "POST", "path": "/conversation", "headers": headers}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages
+
+
+def test_signature_is_bound_to_path_and_time():
+    header = sign_profile_request(SECRET, "/conversation", timestamp=1000)
+    assert verify_profile_request(SECRET, "/conversation", header, now=1100)
+    assert not verify_profile_request(SECRET, "/history/list", header, now=1100)
+    assert not verify_profile_request(SECRET, "/conversation", header, now=5000)
+    assert not verify_profile_request("other-secret", "/conversation", header, now=1100)
+    assert not verify_profile_request(SECRET, "/conversation", "garbage", now=1100)
+
+
+@pytest.mark.asyncio
+async def test_signed_request_is_profiled_for_the_whole_stream(tmp_path):
+    app = RequestProfilerMiddleware(streaming_app, secret=SECRET, output_dir=str(tmp_path))
+    header = sign_profile_request(SECRET, "/conversation")
+
+    messages = await call(app, [(b"x-profile-request", header.encode())])
+
+    response_headers = dict(messages[0]["headers"])
+    profile_id = response_headers[b"x-profile-id"].decode()
+    assert len(messages) == 5
+    profile = json.loads((tmp_path / profile_id).read_text())
+    assert profile["$schema"].startswith("https://www.speedscope.app")
+    assert profile["profiles"][0]["endValue"] >= 0.03
+
+
+@pytest.mark.asyncio
+async def test_unsigned_requests_are_not_profiled(tmp_path):
+    app = RequestProfilerMiddleware(streaming_app, secret=SECRET, output_dir=str(tmp_path), profiler="cprofile")
+
+    plain = await call(app, [])
+    forged = await call(app, [(b"x-profile-request", b"1.deadbeef")])
+
+    assert b"x-profile-id" not in dict(plain[0]["headers"])
+    assert b"x-profile-id" not in dict(forged[0]["headers"])
+    assert not tmp_path.exists() or not any(tmp_path.iterdir())
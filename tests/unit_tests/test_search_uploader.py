@@ -0,0 +1,66 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from search_uploader import SearchUploader, document_size
+
+
+def result(key, status_code=200, error_message=None):
+    return SimpleNamespace(key=key, succeeded=status_code in (200, 201), status_code=status_code, error_message=error_message)
+
+
+class StubSearchClient():
+    """Answers every request with the status codes queued for each key, 200 once they run out."""
+
+    def __init__(self, statuses=None):
+        self.statuses = {key: list(codes) for key, codes in (statuses or {}).items()}
+        self.requests = []
+
+    def merge_or_upload_documents(self, documents):
+        self.requests.append([document["id"] for document in documents])
+        results = []
+        for document in documents:
+            codes = self.statuses.get(document["id"])
+            status_code = codes.pop(0) if codes else 200
+            results.append(result(document["id"], status_code, None if status_code == 200 else f"status {status_code}"))
+        return results
+
+
+def test_record_retries_only_transient_failures():
+    uploader = SearchUploader(StubSearchClient(), max_in_flight=1)
+    documents = [{"id": key} for key in "abcd"]
+    retry, throttled = uploader._record(documents, [
+        result("a"), result("b", 503, "busy"), result("c", 400, "bad field"), result("d", 409, "conflict"),
+    ])
+
+    assert retry == [{"id": "b"}, {"id": "d"}]
+    assert throttled is True
+    assert uploader.stats.documents == 1
+    assert uploader.stats.failures == {"b": "busy", "c": "bad field", "d": "conflict"}
+
+    ## a later success clears the failure
+    uploader._record([{"id": "b"}], [result("b")])
+    assert "b" not in uploader.stats.failures
+
+
+def test_index_packs_requests_by_size_and_resends_failed_documents(monkeypatch):
+    monkeypatch.setattr("search_uploader.random.uniform", lambda low, high: 0)
+    client = StubSearchClient({"d1": [503], "d2": [400]})
+    documents = [{"id": f"d{i}", "content": "x" * 100} for i in range(6)]
+    uploader = SearchUploader(client, max_in_flight=2, max_request_bytes=2 * document_size(documents[0]))
+
+    errors = asyncio.run(uploader.index(documents))
+
+    assert errors == [None, None, "status 400", None, None, None]
+    assert client.requests[:3] == [["d0", "d1"], ["d2", "d3"], ["d4", "d5"]]
+    ## only the throttled document is sent again
+    assert client.requests[3:] == [["d1"]]
+    assert uploader.stats.documents == 5
+    assert uploader.stats.throttled == 1 and uploader.stats.retries == 1
+
+
+@pytest.mark.parametrize("max_request_documents", [None, 5000])
+def test_requests_never_exceed_the_service_document_limit(max_request_documents):
+    uploader = SearchUploader(StubSearchClient(), max_request_documents=max_request_documents)
+    assert uploader.max_request_documents == 1000
@@ -0,0 +1,85 @@
+import asyncio
+import pytest
+
+from backend.history.conversationstore import ConversationStore
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.sqlitedbservice import SqliteConversationClient
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "history.db")
+
+
+def test_clients_implement_conversation_store(db_path):
+    assert issubclass(CosmosConversationClient, ConversationStore)
+    assert isinstance(SqliteConversationClient(db_path), ConversationStore)
+
+
+@pytest.mark.asyncio
+async def test_sqlite_conversation_round_trip(db_path):
+    client = SqliteConversationClient(db_path, enable_message_feedback=True)
+    try:
+        success, _ = await client.ensure()
+        assert success
+
+        conversation = await client.create_conversation("user-1", title="hello")
+        await client.create_message("m1", conversation["id"], "user-1", {"role": "user", "content": "hi"})
+        await client.create_message("m2", conversation["id"], "user-1", {"role": "assistant", "content": "hey"})
+
+        messages = await client.get_messages("user-1", conversation["id"])
+        assert [m["id"] for m in messages] == ["m1", "m2"]
+        assert messages[0]["feedback"] == ""
+
+        updated = await client.get_conversation("user-1", conversation["id"])
+        assert updated["updatedAt"] == messages[-1]["createdAt"]
+        assert await client.get_conversation("user-2", conversation["id"]) is None
+
+        assert (await client.update_message_feedback("user-1", "m2", "positive"))["feedback"] == "positive"
+        assert await client.update_message_feedback("user-1", "missing", "positive") is False
+
+        assert await client.create_message("m3", "missing", "user-1", {"role": "user", "content": "x"}) == "Conversation not found"
+
+        await client.delete_messages(conversation["id"], "user-1")
+        assert await client.get_messages("user-1", conversation["id"]) == []
+        await client.delete_conversation("user-1", conversation["id"])
+        assert await client.get_conversations("user-1", limit=None) == []
+    finally:
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_concurrent_writes_are_batched(db_path):
+    client = SqliteConversationClient(db_path, write_batch_size=16)
+    try:
+        conversations = await asyncio.gather(
+            *[client.create_conversation("user-1", title=str(i)) for i in range(50)]
+        )
+        listed = await client.get_conversations("user-1", limit=25, offset="0")
+        assert len(listed) == 25
+        assert len(await client.get_conversations("user-1", limit=None)) == len(conversations)
+    finally:
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_export_resumes_from_continuation(db_path, tmp_path):
+    source = SqliteConversationClient(db_path)
+    target = SqliteConversationClient(str(tmp_path / "target.db"))
+    try:
+        for i in range(3):
+            conversation = await source.create_conversation("user-1", title=str(i))
+            await source.create_message(f"m{i}", conversation["id"], "user-1", {"role": "user", "content": "hi"})
+
+        pages = [page async for page in source.export_documents("user-1", page_size=2)]
+        resumed = [page async for page in source.export_documents("user-1", continuation=pages[0][1], page_size=2)]
+        assert resumed == pages[1:]
+
+        documents = [document for page, _ in pages for document in page]
+        assert len(documents) == 6
+        assert await target.import_documents("user-1", documents) == 6
+        assert len(await target.get_conversations("user-1", limit=None)) == 3
+        assert len(await target.get_messages("user-1", documents[0]["id"])) == 1
+    finally:
+        await source.close()
+        await target.close()
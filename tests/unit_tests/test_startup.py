@@ -0,0 +1,42 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+## several times what a cold import takes on a developer machine, so only a
+## real regression (an SDK imported eagerly again) trips it on a slow runner
+COLD_IMPORT_BUDGET_SECONDS = float(os.environ.get("COLD_IMPORT_BUDGET_SECONDS", "3.0"))
+DEFERRED_MODULES = [
+    "openai",
+    "azure.identity",
+    "azure.cosmos",
+    "requests",
+    "opentelemetry.sdk",
+    "opentelemetry.instrumentation.asgi",
+]
+
+
+def cold_import_app(tmp_path):
+    dotenv = tmp_path / ".env"
+    dotenv.write_text("AZURE_OPENAI_MODEL=test-model\nAZURE_OPENAI_ENDPOINT=https://test.openai.azure.com\n")
+    env = {**os.environ, "DOTENV_PATH": str(dotenv)}
+    script = (
+        "import sys, time; start = time.perf_counter(); import app; "
+        "print(time.perf_counter() - start); "
+        f"print(__import__('json').dumps([m for m in {DEFERRED_MODULES!r} if m in sys.modules]))"
+    )
+    completed = subprocess.run(
+        [sys.executable, "-c", script], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    seconds, loaded = completed.stdout.strip().splitlines()[-2:]
+    return float(seconds), json.loads(loaded)
+
+
+def test_cold_import_stays_within_budget(tmp_path):
+    seconds, loaded = cold_import_app(tmp_path)
+
+    assert loaded == [], f"imported at startup although unused: {loaded}"
+    assert seconds < COLD_IMPORT_BUDGET_SECONDS, (
+        f"import app took {seconds:.2f}s, budget {COLD_IMPORT_BUDGET_SECONDS}s; see python -m benchmarks.import_profile"
+    )
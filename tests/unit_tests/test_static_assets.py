@@ -0,0 +1,108 @@
+import gzip
+
+import pytest
+
+from backend.static_assets import (
+    IMMUTABLE_CACHE_CONTROL,
+    REVALIDATE_CACHE_CONTROL,
+    StaticAssets,
+    StaticFilesMiddleware,
+    precompress,
+)
+
+BUNDLE = b"console.log('chat');\n" * 200
+
+
+@pytest.fixture
+def static_dir(tmp_path):
+    (tmp_path / "assets").mkdir()
+    (tmp_path / "assets" / "index-8a2d939c.js").write_bytes(BUNDLE)
+    (tmp_path / "favicon.ico").write_bytes(b"\x00" * 100)
+    (tmp_path / "index.html").write_text("<title>{{ title }}</title>")
+    precompress(str(tmp_path))
+    return tmp_path
+
+
+async def fallback_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 404, "headers": []})
+    await send({"type": "http.response.body", "body": b"from the app"})
+
+
+async def call(app, path, method="GET", extensions=None, **headers):
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "headers": [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()],
+        "extensions": extensions or {},
+    }
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, None, send)
+    start = messages[0]
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    return start["status"], {k.decode(): v.decode() for k, v in start["headers"]}, body, messages
+
+
+def middleware(static_dir, **kwargs):
+    assets = StaticAssets(str(static_dir), **kwargs)
+    assets.add_rendered("/", "index.html", title="Contoso <Chat>")
+    return StaticFilesMiddleware(fallback_app, assets, files={"/favicon.ico": "favicon.ico"})
+
+
+@pytest.mark.asyncio
+async def test_serves_precompressed_variants_with_strong_etags(static_dir):
+    app = middleware(static_dir)
+
+    status, headers, body, _ = await call(app, "/assets/index-8a2d939c.js", accept_encoding="br;q=0, gzip")
+    assert status == 200
+    assert headers["content-encoding"] == "gzip"
+    assert gzip.decompress(body) == BUNDLE
+    assert headers["cache-control"] == IMMUTABLE_CACHE_CONTROL
+    assert headers["vary"] == "Accept-Encoding"
+
+    status, plain_headers, body, _ = await call(app, "/assets/index-8a2d939c.js")
+    assert body == BUNDLE and "content-encoding" not in plain_headers
+    assert plain_headers["etag"] != headers["etag"]
+
+    status, _, body, _ = await call(
+        app, "/assets/index-8a2d939c.js", accept_encoding="gzip", if_none_match=f'W/{headers["etag"]}'
+    )
+    assert (status, body) == (304, b"")
+
+
+@pytest.mark.asyncio
+async def test_index_is_rendered_once_and_revalidated(static_dir):
+    app = middleware(static_dir)
+
+    status, headers, body, _ = await call(app, "/")
+    assert body == b"<title>Contoso &lt;Chat&gt;</title>"
+    assert headers["cache-control"] == REVALIDATE_CACHE_CONTROL
+    assert (await call(app, "/", if_none_match=headers["etag"]))[0] == 304
+
+    status, headers, _, _ = await call(app, "/favicon.ico", method="HEAD")
+    assert (status, headers["content-length"]) == (200, "100")
+
+
+@pytest.mark.asyncio
+async def test_unknown_and_unsafe_paths_fall_through_to_the_app(static_dir):
+    app = middleware(static_dir)
+
+    for path in ["/assets/missing.js", "/assets/../index.html", "/conversation"]:
+        status, _, body, _ = await call(app, path)
+        assert (status, body) == (404, b"from the app")
+    assert (await call(app, "/assets/index-8a2d939c.js", method="POST"))[0] == 404
+
+
+@pytest.mark.asyncio
+async def test_large_files_are_streamed_or_sent_by_the_server(static_dir):
+    app = middleware(static_dir, memory_cache_max_bytes=0)
+
+    _, _, body, messages = await call(app, "/assets/index-8a2d939c.js")
+    assert body == BUNDLE
+
+    _, _, _, messages = await call(app, "/assets/index-8a2d939c.js", extensions={"http.response.pathsend": {}})
+    assert messages[-1] == {"type": "http.response.pathsend", "path": str(static_dir / "assets" / "index-8a2d939c.js")}
@@ -0,0 +1,42 @@
+import contextvars
+import time
+
+from backend.timing import RequestTimings, bind_timings, current_timings, timed
+
+
+@timed("groups")
+def lookup_groups(depth):
+    time.sleep(0.01)
+    if depth:
+        lookup_groups(depth - 1)
+
+
+def handle_request(timings):
+    bind_timings(timings)
+    lookup_groups(2)
+    with timed("history"):
+        time.sleep(0.01)
+
+
+def test_nested_stages_are_counted_once():
+    timings = RequestTimings()
+    contextvars.copy_context().run(handle_request, timings)
+
+    durations = timings.as_dict()
+    assert 30 <= durations["groups"] < 60
+    assert durations["total"] >= durations["groups"] + durations["history"]
+
+
+def test_timed_is_a_no_op_outside_a_request():
+    assert current_timings() is None
+    with timed("upstream"):
+        pass
+
+
+def test_server_timing_header_format():
+    timings = RequestTimings()
+    timings.durations = {"auth": 0.0012, "custom": 0.5}
+
+    header = timings.server_timing_header()
+
+    assert header.startswith('auth;dur=1.2;desc="Authentication", custom;dur=500.0, total;dur=')
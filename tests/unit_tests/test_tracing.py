@@ -0,0 +1,36 @@
+import json
+from types import SimpleNamespace
+
+from backend.tracing import configure_tracing, current_trace_id, inject_trace_headers, tracer
+
+
+def tracing_settings(**overrides):
+    settings = dict(enabled=True, exporter="console", file_path="traces.jsonl", service_name="test", sample_ratio=1.0)
+    settings.update(overrides)
+    return SimpleNamespace(**settings)
+
+
+def test_disabled_tracing_installs_nothing():
+    assert configure_tracing(tracing_settings(enabled=False)) is None
+    assert inject_trace_headers() == {}
+
+
+def test_file_exporter_writes_spans_and_propagates_context(tmp_path):
+    trace_file = tmp_path / "traces.jsonl"
+    provider = configure_tracing(
+        tracing_settings(exporter="file", file_path=str(trace_file))
+    )
+
+    with tracer.start_as_current_span("conversation_internal"):
+        with tracer.start_as_current_span("azure_openai.chat_completions"):
+            headers = inject_trace_headers({"Content-Type": "application/json"})
+            trace_id = current_trace_id()
+
+    assert headers["traceparent"].split("-")[1] == trace_id
+    assert headers["Content-Type"] == "application/json"
+
+    provider.force_flush()
+    spans = [json.loads(line) for line in trace_file.read_text().splitlines()]
+    by_name = {span["name"]: span for span in spans}
+    assert by_name["azure_openai.chat_completions"]["parent_id"] == by_name["conversation_internal"]["context"]["span_id"]
+    assert by_name["conversation_internal"]["context"]["trace_id"] == f"0x{trace_id}"
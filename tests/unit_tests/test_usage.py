@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+from backend.history.sqlitedbservice import SqliteConversationClient
+from backend.usage import UsageTracker, usage_day, usage_from_response
+
+NOW = 1_760_000_000.0
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+def test_budgets_apply_to_sliding_windows():
+    tracker = UsageTracker(daily_budget=1000, monthly_budget=3000)
+    tracker.record("alice", 300, 400, now=NOW - 25 * HOUR)
+    tracker.record("alice", 500, 200, now=NOW - 2 * HOUR)
+
+    assert tracker.usage("alice", "daily", now=NOW)["total_tokens"] == 700
+    assert tracker.usage("alice", "monthly", now=NOW)["total_tokens"] == 1400
+    assert tracker.exceeded_budget("alice", now=NOW) is None
+
+    tracker.record("alice", 200, 100, now=NOW)
+    assert tracker.exceeded_budget("alice", now=NOW) == "daily"
+    assert tracker.exceeded_budget("alice", now=NOW + DAY) is None
+    assert tracker.exceeded_budget("bob", now=NOW) is None
+
+
+def test_usage_from_response_accepts_chat_and_responses_api_usage():
+    class ChatUsage():
+        prompt_tokens = 10
+        completion_tokens = 5
+
+    assert usage_from_response(ChatUsage()) == (10, 5)
+    assert usage_from_response({"input_tokens": 7, "output_tokens": 3}) == (7, 3)
+    assert usage_from_response(None) is None
+    assert usage_from_response({}) is None
+
+
+@pytest.mark.asyncio
+async def test_usage_is_flushed_to_the_store_and_seeds_new_workers(tmp_path):
+    store = SqliteConversationClient(str(tmp_path / "history.db"))
+    try:
+        worker = UsageTracker(daily_budget=1000)
+        worker.record("alice", 100, 50)
+        worker.record("alice", 300, 150)
+        await worker.flush(store)
+        worker.record("alice", 1, 1)
+        await worker.flush(store)
+
+        [usage] = await store.get_usage(user_id="alice")
+        assert (usage["prompt_tokens"], usage["completion_tokens"], usage["requests"]) == (401, 201, 3)
+        assert worker.pending == {}
+
+        restarted = UsageTracker(daily_budget=600)
+        await restarted.seed("alice", store)
+        assert restarted.usage("alice", "monthly")["total_tokens"] == 602
+        assert restarted.exceeded_budget("alice") == "daily"
+    finally:
+        await store.close()
+
+
+@pytest.mark.asyncio
+async def test_usage_flushed_before_the_seed_is_not_counted_twice(tmp_path):
+    store = SqliteConversationClient(str(tmp_path / "history.db"))
+    try:
+        ## another worker's usage, which the seed has to add
+        await store.record_usage("alice", usage_day(time.time()), 1000, 0, 1)
+
+        worker = UsageTracker(daily_budget=2000)
+        ## e.g. a title generated by /history/generate before any budgeted request
+        worker.record("alice", 300, 200)
+        await worker.flush(store)
+        await worker.seed("alice", store)
+
+        assert worker.usage("alice", "daily")["total_tokens"] == 1500
+        assert worker.usage("alice", "daily")["requests"] == 2
+        assert worker.exceeded_budget("alice") is None
+
+        ## usage after the seed is only counted once as well
+        worker.record("alice", 100, 0)
+        await worker.flush(store)
+        await worker.seed("alice", store)
+        assert worker.usage("alice", "daily")["total_tokens"] == 1600
+        [usage] = await store.get_usage(user_id="alice")
+        assert usage["prompt_tokens"] + usage["completion_tokens"] == 1600
+    finally:
+        await store.close()
@@ -1,5 +1,5 @@
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+from backend.utils import format_as_ndjson, parse_multi_columns, parse_ndjson
 
 
 @pytest.mark.asyncio
@@ -20,6 +20,27 @@ async def test_format_as_ndjson_exception():
     async for event in format_as_ndjson(dummy_generator()):
         assert event == '{"error": "test exception"}'
 
+@pytest.mark.asyncio
+async def test_parse_ndjson_split_across_chunks():
+    async def dummy_body():
+        yield b'{"id": "1"}\n{"id"'
+        yield b': "2"}\n\n'
+        yield b'{"id": "3"}'
+
+    assert [doc async for doc in parse_ndjson(dummy_body())] == [{"id": "1"}, {"id": "2"}, {"id": "3"}]
+
+
+@pytest.mark.asyncio
+async def test_parse_ndjson_line_spanning_many_chunks():
+    line = b'{"content": "' + b"x" * 10000 + b'"}\n{"id": "2"}'
+
+    async def dummy_body():
+        for i in range(0, len(line), 7):
+            yield line[i:i + 7]
+
+    assert [doc async for doc in parse_ndjson(dummy_body())] == [{"content": "x" * 10000}, {"id": "2"}]
+
+
 def test_parse_multi_columns():
     test_pipes = "col1|col2|col3"
     test_commas = "col1,col2,col3"
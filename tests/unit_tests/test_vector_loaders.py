@@ -0,0 +1,120 @@
+import json
+import threading
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+import cosmos_mongo_vcore_data_preparation
+import pinecone_data_preparation
+from data_utils import ChunkingResult, Document
+
+
+def documents(count, content="text"):
+    return [Document(id=f"id{i}", content=content, title="t", filepath="f.md", contentVector=[0.5, 0.25])
+            for i in range(count)]
+
+
+class FakePineconeIndex():
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors):
+        with self._lock:
+            self.batches.append(vectors)
+        if self.fail_on in [id for id, _, _ in vectors]:
+            raise ValueError("request too large")
+
+
+def test_pinecone_upsert_packs_batches_by_payload_size(monkeypatch):
+    index = FakePineconeIndex()
+    monkeypatch.setattr(pinecone_data_preparation.pinecone, "Index", lambda name: index)
+    docs = documents(10)
+    size = len(json.dumps({"id": "id0", "values": [0.5, 0.25],
+                           "metadata": {"title": "t", "filepath": "f.md", "url": "", "content": "text"}})) + 1
+
+    failed_ids = pinecone_data_preparation.upsert_documents_to_index("index", docs, max_request_bytes=3 * size, max_request_vectors=100)
+
+    assert failed_ids == []
+    assert sorted(len(batch) for batch in index.batches) == [1, 3, 3, 3]
+    assert sorted(id for batch in index.batches for id, _, _ in batch) == sorted(doc.id for doc in docs)
+
+
+def test_pinecone_upsert_returns_the_ids_of_a_failed_batch(monkeypatch):
+    index = FakePineconeIndex(fail_on="id3")
+    monkeypatch.setattr(pinecone_data_preparation.pinecone, "Index", lambda name: index)
+
+    failed_ids = pinecone_data_preparation.upsert_documents_to_index("index", documents(6), max_request_vectors=2)
+
+    assert failed_ids == ["id2", "id3"]
+
+
+class FakeCollection():
+    def __init__(self, errors):
+        ## batch position -> exception to raise
+        self.errors = errors
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def bulk_write(self, operations, ordered):
+        assert not ordered
+        with self._lock:
+            position = len(self.batches)
+            self.batches.append(operations)
+        if position in self.errors:
+            raise self.errors[position]
+
+
+def mongo_client(collection):
+    return {"db": {"collection": collection}}
+
+
+def test_mongo_upsert_maps_write_errors_to_ids():
+    write_errors = BulkWriteError({"writeErrors": [{"index": 1, "errmsg": "duplicate key"}]})
+    collection = FakeCollection({0: write_errors})
+
+    failed_ids = cosmos_mongo_vcore_data_preparation.upsert_documents_to_index(
+        mongo_client(collection), "db", "collection", documents(5), batch_size=5, max_in_flight=1)
+
+    ## only the failed write, the rest of the unordered batch was written
+    assert failed_ids == ["doc:id1"]
+
+
+def test_mongo_upsert_fails_every_id_of_a_failed_batch():
+    collection = FakeCollection({1: ConnectionError("connection reset")})
+
+    failed_ids = cosmos_mongo_vcore_data_preparation.upsert_documents_to_index(
+        mongo_client(collection), "db", "collection", documents(5), batch_size=2, max_in_flight=1)
+
+    assert failed_ids == ["doc:id2", "doc:id3"]
+    assert [len(batch) for batch in collection.batches] == [2, 2, 1]
+
+
+def chunked(monkeypatch, module):
+    result = ChunkingResult(chunks=documents(2), total_files=1)
+    monkeypatch.setattr(module, "chunk_directory", lambda *args, **kwargs: result)
+    monkeypatch.setattr(module, "upsert_documents_to_index", lambda *args, **kwargs: ["id1"])
+    monkeypatch.setattr(module, "validate_index", lambda *args, **kwargs: pytest.fail("validated a partial index"))
+
+
+def test_pinecone_create_index_raises_on_failed_upserts(monkeypatch):
+    chunked(monkeypatch, pinecone_data_preparation)
+    monkeypatch.setattr(pinecone_data_preparation, "check_if_pinecone_environment_exists", lambda *args: True)
+    monkeypatch.setattr(pinecone_data_preparation, "create_or_update_vector_search_index", lambda *args: True)
+    config = {"environment": "env", "api_key": "key", "index_name": "index", "data_path": "data", "chunk_size": 100}
+
+    with pytest.raises(Exception, match="INDEXING FAILED for 1 documents"):
+        pinecone_data_preparation.create_index(config, credential=None)
+
+
+def test_mongo_create_index_raises_on_failed_upserts(monkeypatch):
+    chunked(monkeypatch, cosmos_mongo_vcore_data_preparation)
+    monkeypatch.setattr(cosmos_mongo_vcore_data_preparation, "check_if_cosmos_mongo_db_exists", lambda *args: True)
+    monkeypatch.setattr(cosmos_mongo_vcore_data_preparation, "initialize_mongo_client", lambda *args: None)
+    monkeypatch.setattr(cosmos_mongo_vcore_data_preparation, "create_or_update_vector_search_index", lambda *args: True)
+    config = {"account_name": "account", "database_name": "db", "collection_name": "collection", "subscription_id": "sub",
+              "resource_group": "rg", "index_name": "index", "vector_field": "contentvector", "data_path": "data", "chunk_size": 100}
+
+    with pytest.raises(Exception, match="INDEXING FAILED for 1 documents"):
+        cosmos_mongo_vcore_data_preparation.create_index(config, credential=None)